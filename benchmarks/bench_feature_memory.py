@@ -0,0 +1,52 @@
+# Memory used by the layers and features found by the layer scan. The scan is traced with tracemalloc so the peak and retained Python allocations and the number of allocated blocks are measured without the memory map of the G-code file.
+#python ./benchmarks/bench_feature_memory.py
+#python ./benchmarks/bench_feature_memory.py --gcode synthetic-many-features.gcode
+
+import argparse, contextlib, glob, gc, os, queue, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from mfm.map_post_process import *
+from bench_process import GCODE_FILES
+
+def countFeatures(layers: list[PrintState]) -> tuple[int, int]:
+  """Number of features and of toolchange and wipe end child features on the layers"""
+  features = 0
+  children = 0
+  for layer in layers:
+    features += len(layer.features)
+    children += sum((feat.toolchange != None) + (feat.wipeEnd != None) for feat in layer.features)
+  return features, children
+
+def measureLayerScan(gcodeFn: str) -> dict:
+  """Scan a G-code file with allocations traced and return the measurements"""
+  gc.collect()
+  tracemalloc.start()
+  start = time.perf_counter()
+  with GcodeReader(gcodeFn) as f, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    layerIndex = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, ProgressReporter(queue.Queue()), ProcessProfile(enabled=False))
+  elapsed = time.perf_counter() - start
+  gc.collect()
+  retained, peak = tracemalloc.get_traced_memory()
+  blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+  tracemalloc.stop()
+  features, children = countFeatures(layerIndex.layers)
+  return {
+    'layers': len(layerIndex.layers),
+    'features': features,
+    'child_features': children,
+    'retained_bytes': retained,
+    'peak_bytes': peak,
+    'retained_blocks': blocks,
+    'seconds': elapsed
+  }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Measure the memory used by the layers and features found by the layer scan.')
+  parser.add_argument('--gcode', nargs='+', default=sorted(glob.glob(GCODE_FILES)), help='G-code files to scan. Defaults to the dual color dice sample G-code files.')
+  args = parser.parse_args()
+
+  print(f"{'file':40} {'layers':>7} {'features':>9} {'retained KiB':>13} {'peak KiB':>10} {'blocks':>9} {'B/feature':>10} {'s':>7}")
+  for gcodeFn in args.gcode:
+    m = measureLayerScan(gcodeFn)
+    perFeature = m['retained_bytes'] / max(m['features'], 1)
+    print(f"{os.path.basename(gcodeFn)[:40]:40} {m['layers']:7} {m['features']:9} {m['retained_bytes']/1024:13.1f} {m['peak_bytes']/1024:10.1f} {m['retained_blocks']:9} {perFeature:10.1f} {m['seconds']:7.2f}")
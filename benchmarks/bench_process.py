@@ -0,0 +1,176 @@
+# Benchmark of process() over the sample G-code files with every premade options file and the sample model options. Each run is done in a new process so the peak RSS of each run is measured separately.
+#python ./benchmarks/bench_process.py
+#python ./benchmarks/bench_process.py --save_baseline ./benchmarks/baseline.json
+#python ./benchmarks/bench_process.py --baseline ./benchmarks/baseline.json --threshold 0.15
+#python ./benchmarks/bench_process.py --scale 1 10 100 --files "*prusa_prime*"
+#python ./benchmarks/bench_process.py --files none --gcode synthetic-bambu.gcode synthetic-prusa.gcode
+
+import argparse, concurrent.futures, fnmatch, glob, json, multiprocessing, os, queue, re, sys, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from mfm.batch import *
+from mfm.line_ending import *
+from mfm.map_post_process import *
+
+try:
+  import resource
+except ImportError:
+  # Peak RSS is not measured on Windows
+  resource = None
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+GCODE_FILES = os.path.join(REPO_DIR, 'sample_models', 'dual_color_dice', 'tests', '*.gcode')
+OPTIONS_FILES = [
+  os.path.join(REPO_DIR, 'premade_options', '*.json'),
+  os.path.join(REPO_DIR, 'sample_models', '*', 'config-*.json')
+]
+BAMBU_TOOLCHANGE_FILE = os.path.join(REPO_DIR, 'minimal_toolchanges', 'bambu-p1-series.gcode')
+PRUSA_TOOLCHANGE_FILE = os.path.join(REPO_DIR, 'minimal_toolchanges', 'prusa-xl-series.gcode')
+
+LAYER_CHANGE_LINE_RE = re.compile(LAYER_CHANGE.encode(), re.MULTILINE)
+LAYER_Z_HEIGHT_LINE_RE = re.compile(LAYER_Z_HEIGHT.encode(), re.MULTILINE)
+MOVEMENT_Z_RE = re.compile(rb'^(G[0-3] [^\n;]*?Z)(-?\d*\.?\d*)', re.MULTILINE)
+LAYER_Z_HEIGHT_VALUE_RE = re.compile(rb'^(;\s?(?:Z_HEIGHT|Z):\s?)(\d*\.?\d*)', re.MULTILINE)
+
+def formatZ(z: float) -> bytes:
+  return f'{z:.3f}'.rstrip('0').rstrip('.').encode()
+
+def shiftZ(data: bytes, dz: float) -> bytes:
+  """Raise every layer height tag and Z move in the G-code by dz"""
+  if dz == 0:
+    return data
+  def shift(m: re.Match) -> bytes:
+    if not m.group(2) or m.group(2) in (b'.', b'-'):
+      return m.group(0)
+    return m.group(1) + formatZ(float(m.group(2)) + dz)
+  data = MOVEMENT_Z_RE.sub(shift, data)
+  return LAYER_Z_HEIGHT_VALUE_RE.sub(shift, data)
+
+def replicateGcode(fn: str, scale: int, outFn: str):
+  """Write a G-code file with the layers of fn repeated scale times. Each copy of the layers is stacked on top of the previous copy. The last layer and the end G-code are written once after the last copy."""
+  with open(fn, mode='rb') as f:
+    data = f.read()
+  layerChangeStarts = [m.start() for m in LAYER_CHANGE_LINE_RE.finditer(data)]
+  if len(layerChangeStarts) < 2:
+    raise ValueError(f"{fn} does not have enough layers to replicate")
+  block = data[layerChangeStarts[0]:layerChangeStarts[-1]]
+  blockHeights = LAYER_Z_HEIGHT_LINE_RE.findall(block)
+  blockHeight = float(blockHeights[-1])
+
+  tempFn = outFn + '.tmp'
+  with open(tempFn, mode='wb') as out:
+    out.write(data[:layerChangeStarts[0]])
+    for i in range(scale):
+      out.write(shiftZ(block, i * blockHeight))
+    out.write(shiftZ(data[layerChangeStarts[-1]:], (scale - 1) * blockHeight))
+  os.replace(tempFn, outFn)
+
+def scaledGcodeFile(fn: str, scale: int, workDir: str) -> str:
+  """Path of fn replicated scale times. Replicated files are kept in workDir and only written once."""
+  if scale == 1:
+    return fn
+  base, ext = os.path.splitext(os.path.basename(fn))
+  scaledFn = os.path.join(workDir, f'{base}-x{scale}{ext}')
+  if not os.path.exists(scaledFn) or os.path.getmtime(scaledFn) < os.path.getmtime(fn):
+    print(f"Writing {scaledFn}")
+    replicateGcode(fn, scale, scaledFn)
+  return scaledFn
+
+def toolchangeFile(gcodeFn: str) -> str:
+  """Minimal toolchange for the slicer that wrote the G-code file"""
+  with open(gcodeFn, mode='rb') as f:
+    header = f.read(4096)
+  return PRUSA_TOOLCHANGE_FILE if b'PrusaSlicer' in header else BAMBU_TOOLCHANGE_FILE
+
+def peakRSS() -> int:
+  """Peak RSS in bytes of this process and its finished worker processes"""
+  if resource == None:
+    return 0
+  rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  # ru_maxrss is bytes on macOS and KiB on Linux
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+def runOnce(gcodeFn: str, optionsFn: str, outputFn: str, jobs: int) -> dict:
+  """Run process() in this (new) process and return its measurements"""
+  sys.stdout = open(os.devnull, 'w')
+  profile = process(configuration=batchJobConfiguration(BatchJob(gcodeFn, outputFn, optionsFn, toolchangeFile(gcodeFn)), LineEnding.AUTODETECT, False, jobs), statusQueue=queue.Queue())
+  result = profile.toDict()
+  result['peak_rss'] = peakRSS()
+  return result
+
+def benchCase(gcodeFn: str, optionsFn: str, outputFn: str, jobs: int, repeat: int) -> dict:
+  """Fastest of repeat runs, each in a new process"""
+  best = None
+  for _ in range(repeat):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+      result = executor.submit(runOnce, gcodeFn, optionsFn, outputFn, jobs).result()
+    if best == None or result['total_seconds'] < best['total_seconds']:
+      best = result
+  counts = best['counts']
+  return {
+    'seconds': best['total_seconds'],
+    'mb_per_second': best['input_mb_per_second'],
+    'lines_per_second': best['lines_per_second'],
+    'peak_rss_mb': best['peak_rss'] / 2**20,
+    'input_mb': counts.get(COUNT_INPUT_BYTES, 0) / 1e6,
+    'toolchanges': counts.get(COUNT_TOOLCHANGES_MINIMAL, 0) + counts.get(COUNT_TOOLCHANGES_FULL, 0)
+  }
+
+def compareToBaseline(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+  """Descriptions of cases that are slower, use more memory or insert a different number of toolchanges than the baseline"""
+  regressions = []
+  for key, r in results.items():
+    b = baseline.get(key)
+    if b == None:
+      continue
+    if r['mb_per_second'] < b['mb_per_second'] * (1 - threshold):
+      regressions.append(f"{key}: {r['mb_per_second']:.2f} MB/s is {1 - r['mb_per_second']/b['mb_per_second']:.0%} slower than baseline {b['mb_per_second']:.2f} MB/s")
+    if b['peak_rss_mb'] > 0 and r['peak_rss_mb'] > b['peak_rss_mb'] * (1 + threshold):
+      regressions.append(f"{key}: peak RSS {r['peak_rss_mb']:.1f} MB is {r['peak_rss_mb']/b['peak_rss_mb'] - 1:.0%} above baseline {b['peak_rss_mb']:.1f} MB")
+    if r['toolchanges'] != b['toolchanges']:
+      regressions.append(f"{key}: {r['toolchanges']} toolchanges inserted, baseline inserted {b['toolchanges']}")
+  return regressions
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='process() benchmark over the sample G-code files and options')
+  parser.add_argument('--files', default='*', help='Only benchmark sample G-code files matching this pattern')
+  parser.add_argument('--gcode', nargs='+', default=[], help='Additional G-code files to benchmark such as files written by synthetic_gcode.py')
+  parser.add_argument('--options', default='*', help='Only benchmark options files matching this pattern')
+  parser.add_argument('--scale', type=int, nargs='+', default=[1], help='Replicate the layers of each G-code file this many times. Several scales can be given.')
+  parser.add_argument('--jobs', type=int, default=1, help='Worker processes used by process()')
+  parser.add_argument('--repeat', type=int, default=3, help='Runs of each case. The fastest run is reported.')
+  parser.add_argument('--work_dir', default=os.path.join(tempfile.gettempdir(), 'mfm-bench'), help='Directory for replicated inputs and outputs')
+  parser.add_argument('--baseline', help='Baseline JSON to compare the results to')
+  parser.add_argument('--threshold', type=float, default=0.1, help='Fraction of baseline throughput lost or peak RSS gained that is reported as a regression')
+  parser.add_argument('--save_baseline', help='Write the results as a baseline JSON')
+  args = parser.parse_args()
+
+  os.makedirs(args.work_dir, exist_ok=True)
+  outputFn = os.path.join(args.work_dir, 'output.gcode')
+  gcodeFiles = [fn for fn in sorted(glob.glob(GCODE_FILES)) if fnmatch.fnmatch(os.path.basename(fn), args.files)] + args.gcode
+  optionsFiles = [fn for pattern in OPTIONS_FILES for fn in sorted(glob.glob(pattern)) if fnmatch.fnmatch(os.path.basename(fn), args.options)]
+
+  results: dict[str, dict] = {}
+  print(f"{'Case':<88}{'MB':>8}{'s':>8}{'MB/s':>8}{'lines/s':>10}{'RSS MB':>8}{'TCs':>6}")
+  for scale in args.scale:
+    for gcodeFn in gcodeFiles:
+      scaledFn = scaledGcodeFile(gcodeFn, scale, args.work_dir)
+      for optionsFn in optionsFiles:
+        key = f'{os.path.basename(gcodeFn)} {os.path.basename(optionsFn)} x{scale}'
+        r = results[key] = benchCase(scaledFn, optionsFn, outputFn, args.jobs, args.repeat)
+        print(f"{key:<88}{r['input_mb']:>8.1f}{r['seconds']:>8.2f}{r['mb_per_second']:>8.2f}{r['lines_per_second']:>10.0f}{r['peak_rss_mb']:>8.1f}{r['toolchanges']:>6}")
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2)
+    print(f"Wrote baseline {args.save_baseline}")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compareToBaseline(results, baseline, args.threshold)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      sys.exit(1)
+    print(f"No regressions beyond {args.threshold:.0%} of baseline")
@@ -0,0 +1,56 @@
+# Benchmark of the per line stop position check in the process() loop on a single layer with many small features.
+#python ./benchmarks/bench_stop_positions.py --features 2000 --lines_per_feature 6
+
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from mfm.printing_classes import StopPositions
+
+def layerOffsets(features: int, linesPerFeature: int, seed: int) -> tuple[list[int], list[int]]:
+  """Line start offsets of a layer and the start offsets of its features in print order"""
+  rng = random.Random(seed)
+  lineStarts = []
+  pos = 0
+  for _ in range(features * linesPerFeature):
+    lineStarts.append(pos)
+    pos += rng.randint(12, 40)
+  featureStarts = lineStarts[::linesPerFeature]
+  printOrder = featureStarts[:]
+  rng.shuffle(printOrder)
+  return lineStarts, printOrder
+
+def walkLayer(stops, lineStarts: list[int], printOrder: list[int]) -> int:
+  """Check every line against the stops and remove a stop when it is reached like the process() loop. Returns the number of stops hit."""
+  for start in printOrder:
+    stops.append(start)
+  hits = 0
+  for pos in lineStarts:
+    if pos in stops:
+      stops.remove(pos)
+      hits += 1
+  return hits
+
+def bench(name: str, makeStops, lineStarts: list[int], printOrder: list[int], repeat: int) -> float:
+  best = None
+  for _ in range(repeat):
+    stops = makeStops()
+    t = time.perf_counter()
+    hits = walkLayer(stops, lineStarts, printOrder)
+    elapsed = time.perf_counter() - t
+    best = elapsed if best == None else min(best, elapsed)
+  print(f"{name:<14} {best*1000:10.2f} ms  {len(lineStarts)/best/1e6:8.2f} M lines/s  {hits} stops")
+  return best
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Stop position lookup benchmark')
+  parser.add_argument('--features', type=int, default=2000, help='Features in the layer')
+  parser.add_argument('--lines_per_feature', type=int, default=6, help='G-code lines in each feature')
+  parser.add_argument('--repeat', type=int, default=3, help='Runs of each variant. The fastest run is reported.')
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  lineStarts, printOrder = layerOffsets(args.features, args.lines_per_feature, args.seed)
+  print(f"{args.features} features, {len(lineStarts)} lines")
+  listTime = bench('list', list, lineStarts, printOrder, args.repeat)
+  stopPositionsTime = bench('StopPositions', StopPositions, lineStarts, printOrder, args.repeat)
+  print(f"Speedup {listTime/stopPositionsTime:.1f}x")
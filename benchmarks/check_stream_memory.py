@@ -0,0 +1,81 @@
+# Check that post processing G-code from standard input uses memory bounded by the largest layers and not the file size. Two synthetic files with the same layers but different sizes are piped through mfm_cmd.py. The stream buffer must stay under the layer bound and the peak RSS of the larger file must be within a tolerance of the smaller file. The streamed output must also match the output of the same file post processed from disk.
+#python ./benchmarks/check_stream_memory.py
+#python ./benchmarks/check_stream_memory.py --flavor prusa --small_mb 20 --large_mb 500
+
+import argparse, filecmp, json, mmap, os, subprocess, sys, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from mfm.gcode_file import GCODE_STREAM_CHUNK_SIZE, STDIO_FILENAME
+from synthetic_gcode import *
+from bench_process import BAMBU_TOOLCHANGE_FILE, PRUSA_TOOLCHANGE_FILE, LAYER_CHANGE_LINE_RE, REPO_DIR
+
+MFM_CMD = os.path.join(REPO_DIR, 'src', 'mfm_cmd.py')
+OPTIONS_FILE = os.path.join(REPO_DIR, 'sample_models', 'dual_color_dice', 'config-dice-test.json')
+
+def streamBufferBound(fn: str, chunkSize: int = GCODE_STREAM_CHUNK_SIZE) -> int:
+  """Most bytes the stream reader should hold for a G-code file: the header and first layer or two consecutive layers, plus a read chunk"""
+  with open(fn, mode='rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+    starts = [0] + [match.start() for match in LAYER_CHANGE_LINE_RE.finditer(m)] + [len(m)]
+  # Header and the first layer are both held until the header is written
+  largest = max(starts[i+2] - starts[i] for i in range(len(starts) - 2)) if len(starts) > 2 else starts[-1]
+  return largest + chunkSize
+
+def runMfm(inputFn: str, outputFn: str, optionsFn: str, toolchangeFn: str, profileFn: str, stream: bool) -> int:
+  """Run mfm_cmd.py and return the peak RSS of the run in bytes"""
+  args = [sys.executable, MFM_CMD, STDIO_FILENAME if stream else inputFn, '-o', outputFn, '-c', optionsFn, '-t', toolchangeFn, '--profile', profileFn]
+  with open(inputFn, mode='rb') if stream else open(os.devnull, mode='rb') as stdin, open(os.devnull, mode='wb') as devnull:
+    p = subprocess.Popen(args, stdin=stdin, stdout=devnull, stderr=devnull)
+    _, status, rusage = os.wait4(p.pid, 0)
+  p.returncode = os.waitstatus_to_exitcode(status)
+  if p.returncode != 0:
+    raise RuntimeError(f"{' '.join(args)} exited with {p.returncode}")
+  # ru_maxrss is bytes on macOS and KiB on Linux
+  return rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Check memory use of post processing from standard input')
+  parser.add_argument('--flavor', choices=[BAMBU, PRUSA], default=BAMBU)
+  parser.add_argument('--small_mb', type=float, default=10)
+  parser.add_argument('--large_mb', type=float, default=100)
+  parser.add_argument('--tolerance_mb', type=float, default=16, help='Allowed peak RSS increase from the small file to the large file')
+  parser.add_argument('--work_dir', default=os.path.join(tempfile.gettempdir(), 'mfm-stream-check'))
+  args = parser.parse_args()
+
+  os.makedirs(args.work_dir, exist_ok=True)
+  toolchangeFn = PRUSA_TOOLCHANGE_FILE if args.flavor == PRUSA else BAMBU_TOOLCHANGE_FILE
+
+  failures = []
+  peakRSS = {}
+  for name, sizeMB in (('small', args.small_mb), ('large', args.large_mb)):
+    spec = SyntheticGcodeSpec()
+    spec.flavor = args.flavor
+    spec.sizeBytes = int(sizeMB * 1e6)
+    gcodeFn = os.path.join(args.work_dir, f'{name}.gcode')
+    layers = writeSyntheticGcode(gcodeFn, spec)
+
+    outputFn = os.path.join(args.work_dir, f'{name}-stream-output.gcode')
+    profileFn = os.path.join(args.work_dir, f'{name}-profile.json')
+    peakRSS[name] = runMfm(gcodeFn, outputFn, OPTIONS_FILE, toolchangeFn, profileFn, stream=True)
+    with open(profileFn) as f:
+      peakBuffer = json.load(f)['counts']['stream_peak_buffer_bytes']
+    bound = streamBufferBound(gcodeFn)
+    print(f"{name}: {os.path.getsize(gcodeFn)/1e6:.1f} MB {layers} layers, stream buffer peak {peakBuffer/1e6:.2f} MB (bound {bound/1e6:.2f} MB), peak RSS {peakRSS[name]/2**20:.1f} MiB")
+    if peakBuffer > bound:
+      failures.append(f"{name}: stream buffer peak {peakBuffer} bytes is over the bound of {bound} bytes")
+
+    if name == 'small':
+      fileOutputFn = os.path.join(args.work_dir, f'{name}-file-output.gcode')
+      runMfm(gcodeFn, fileOutputFn, OPTIONS_FILE, toolchangeFn, profileFn, stream=False)
+      if not filecmp.cmp(outputFn, fileOutputFn, shallow=False):
+        failures.append(f"{name}: streamed output is different from the output from the file")
+
+  growth = (peakRSS['large'] - peakRSS['small']) / 2**20
+  print(f"Peak RSS growth {growth:.1f} MiB for {args.large_mb/args.small_mb:.0f}x the input size")
+  if growth > args.tolerance_mb:
+    failures.append(f"Peak RSS grew {growth:.1f} MiB which is more than {args.tolerance_mb} MiB")
+
+  for failure in failures:
+    print(f"FAIL {failure}")
+  if failures:
+    sys.exit(1)
+  print("Stream memory is bounded by the layer size")
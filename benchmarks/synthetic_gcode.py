@@ -0,0 +1,320 @@
+# Generator of synthetic marked G-code in the layout written by Bambu Studio and PrusaSlicer with the MFM slicer setup. The same options and seed always write the same file.
+#python ./benchmarks/synthetic_gcode.py synthetic-bambu.gcode --flavor bambu --layers 500 --features_per_layer 20 --tools 4
+#python ./benchmarks/synthetic_gcode.py synthetic-prusa-1gb.gcode --flavor prusa --size_mb 1000 --adaptive_layer_height
+#python ./benchmarks/synthetic_gcode.py synthetic-many-features.gcode --features_per_layer 5000 --lines_per_feature 2 --layers 20
+
+import argparse, math, random
+
+BAMBU = 'bambu'
+PRUSA = 'prusa'
+
+BAMBU_FEATURE_TYPES = ['Inner wall', 'Outer wall', 'Overhang wall', 'Internal solid infill', 'Sparse infill', 'Top surface', 'Bottom surface', 'Gap infill']
+PRUSA_FEATURE_TYPES = ['Perimeter', 'External perimeter', 'Overhang perimeter', 'Solid infill', 'Internal infill', 'Top solid infill', 'Bridge infill', 'Gap fill']
+
+def fmt(v: float) -> str:
+  """Number formatted like slicer output with trailing zeros removed"""
+  s = f'{v:.3f}'.rstrip('0').rstrip('.')
+  return s if s not in ('', '-0') else '0'
+
+class SyntheticGcodeSpec:
+  """Options of a synthetic G-code file"""
+  def __init__(self):
+    self.flavor: str = BAMBU
+    """BAMBU or PRUSA layout"""
+    self.layers: int = 100
+    """Layers to write if sizeBytes is not set"""
+    self.sizeBytes: int = 0
+    """Write layers until the file is at least this large. Overrides layers."""
+    self.featuresPerLayer: int = 8
+    """Printing features on each layer not counting prime towers"""
+    self.linesPerFeature: int = 40
+    """Extrusion moves in each feature"""
+    self.tools: int = 2
+    """Tools the features are randomly assigned to"""
+    self.primeTower: bool = True
+    """Toolchanges are done in a prime tower feature and every layer has a prime tower. Otherwise toolchanges are at the end of the previous feature."""
+    self.adaptiveLayerHeight: bool = False
+    """Vary the layer height between layers"""
+    self.layerHeight: float = 0.2
+    """Layer height or the average layer height if adaptiveLayerHeight"""
+    self.seed: int = 1
+    """Random seed for feature types, tools and coordinates"""
+
+class _SyntheticGcodeWriter:
+  def __init__(self, spec: SyntheticGcodeSpec, out):
+    self.spec = spec
+    self.out = out
+    self.rng = random.Random(spec.seed)
+    self.bytesWritten = 0
+    self.tool = 0
+    self.toolchanges = 0
+    self.layerNum = 0
+    self.z = 0.0
+    self.height = spec.layerHeight
+    self.x = 100.0
+    self.y = 100.0
+    self.featureTypes = BAMBU_FEATURE_TYPES if spec.flavor == BAMBU else PRUSA_FEATURE_TYPES
+    self.totalLayers = spec.layers if spec.sizeBytes <= 0 else 0
+    self.pendingWipe = False
+
+  def write(self, lines: list[str]):
+    s = '\n'.join(lines) + '\n'
+    self.out.write(s.encode())
+    self.bytesWritten += len(s)
+
+  def moveTo(self) -> tuple[str, str]:
+    # Random walk that stays on the bed
+    self.x = min(max(self.x + self.rng.uniform(-8, 8), 20), 230)
+    self.y = min(max(self.y + self.rng.uniform(-8, 8), 20), 230)
+    return fmt(self.x), fmt(self.y)
+
+  def extrusionMoves(self, n: int) -> list[str]:
+    lines = []
+    for _ in range(n):
+      x, y = self.moveTo()
+      lines.append(f'G1 X{x} Y{y} E{fmt(self.rng.uniform(0.005, 0.08))}')
+    return lines
+
+  def wipe(self) -> list[str]:
+    x, y = self.moveTo()
+    if self.spec.flavor == BAMBU:
+      return ['; WIPE_START', 'G1 F24000', f'G1 X{x} Y{y} E-.76', '; WIPE_END', 'G1 E-.04 F1800']
+    return [';WIPE_START', 'G1 F24000', f'G1 X{x} Y{y} E-.76', ';WIPE_END', f'G1 Z{fmt(self.z + 0.3)} F720']
+
+  def nextHeight(self) -> float:
+    if not self.spec.adaptiveLayerHeight or self.layerNum == 0:
+      return self.spec.layerHeight
+    # Smooth variation like adaptive layer height on curved surfaces
+    h = self.spec.layerHeight * (1 + 0.6 * math.sin(self.layerNum / 7 + self.spec.seed))
+    return round(min(max(h, 0.08), 0.28), 2)
+
+  def toolchangeBlock(self, newTool: int) -> list[str]:
+    """Toolchange with the MFM toolchange tags from the MFM slicer setup"""
+    z = self.z
+    if self.spec.flavor == BAMBU:
+      return [
+        '; MFM TOOLCHANGE START',
+        f'M620 S{newTool}A',
+        'M204 S9000',
+        'G17',
+        f'G2 Z{fmt(z + 0.4)} I0.86 J0.86 P1 F10000 ; spiral lift a little from second lift',
+        f'G1 Z{fmt(z + 3)} F1200',
+        'G1 X70 F21000',
+        'G1 Y245',
+        'G1 Y265 F3000',
+        'M400',
+        'M106 P1 S0',
+        'M106 P2 S0',
+        'M104 S220',
+        'M620.1 E F523 T240',
+        f'T{newTool}',
+        'M620.1 E F523 T240',
+        'M400',
+        'G92 E0',
+        'G1 E18 F523',
+        'M400',
+        'G1 X80 F15000',
+        'G1 X60 F15000',
+        f'G1 Z{fmt(z + 3)} F3000',
+        'M204 S10000',
+        f'M621 S{newTool}A',
+        '; MFM TOOLCHANGE END'
+      ]
+    return [
+      '; MFM TOOLCHANGE START',
+      f'; Change Tool{self.tool} -> Tool{newTool} (layer {self.layerNum - 1})',
+      'G1 F21000',
+      'P0 S1 L2 D0',
+      '; 0',
+      f'M109 S230 T{newTool}',
+      f'T{newTool} S1 L0 D0',
+      '',
+      '; MFM TOOLCHANGE END',
+      'M900 K0.05 ; Filament gcode',
+      f'M109 S230 T{newTool} ; set temperature and wait for it to be reached'
+    ]
+
+  def primeTowerMoves(self, n: int) -> list[str]:
+    lines = []
+    for i in range(n):
+      lines.append(f'G1 X{fmt(125 + 35 * (i % 2))} Y{fmt(145 + 0.5 * i)} E{fmt(1.3)}')
+    return lines
+
+  def primeTower(self, newTool: int | None) -> list[str]:
+    """Prime tower feature with a toolchange to newTool or a sparse prime tower layer if newTool is None"""
+    h = fmt(self.height)
+    if self.spec.flavor == BAMBU:
+      lines = [f'; LAYER_HEIGHT: {h}', '; FEATURE: Prime tower', '; LINE_WIDTH: 0.5']
+      if newTool != None:
+        self.toolchanges += 1
+        lines += ['; CP TOOLCHANGE START', f'; toolchange #{self.toolchanges}', 'M220 S100', '; WIPE_TOWER_START', '; filament end gcode ', 'M106 P3 S0']
+        lines += self.wipe()
+        lines += self.toolchangeBlock(newTool)
+        lines += ['G1 X126.109 Y144.706 F30000', f'G1 Z{fmt(self.z)}', 'G1 E2 F1800', '; filament start gcode', 'G4 S0']
+        lines += self.primeTowerMoves(8)
+        lines += ['; CP TOOLCHANGE WIPE']
+        lines += self.primeTowerMoves(16)
+        lines += ['; WIPE_TOWER_END', 'G92 E0', '; CP TOOLCHANGE END', ';------------------', '', 'G1 X160.109 Y164.206 F7200']
+        # Bambu Studio starts another prime tower feature for the rest of the tower
+        lines += [f'; LAYER_HEIGHT: {h}', '; FEATURE: Prime tower', '; LINE_WIDTH: 0.5']
+      lines += ['; WIPE_TOWER_START']
+      lines += self.primeTowerMoves(12)
+      lines += ['; WIPE_TOWER_END']
+      lines += self.wipe()
+      return lines
+
+    lines = [f';HEIGHT:{h}', ';TYPE:Wipe tower', ';WIDTH:0.5']
+    if newTool != None:
+      self.toolchanges += 1
+      lines += [';--------------------', '; CP TOOLCHANGE START', f'; toolchange #{self.toolchanges}', '; material : PLA -> PLA', ';--------------------', 'M220 B', 'M220 S100', '; CP TOOLCHANGE UNLOAD']
+      lines += self.primeTowerMoves(4)
+      lines += ['G1 E-20 F2100', '; Filament-specific end gcode']
+      lines += self.toolchangeBlock(newTool)
+      lines += ['G1 F24000', 'G1 X187.037 Y220.801', f'G1 Z{fmt(self.z)} F720', 'G1 E1.2 F1500', 'G4 S0', '; CP TOOLCHANGE WIPE']
+      lines += self.primeTowerMoves(16)
+      lines += ['M220 R', 'G1 F24000', 'G4 S0', 'G92 E0', '; CP TOOLCHANGE END', ';------------------', '', '', 'G1 X187.537 Y214.293 F7200', f';HEIGHT:{h}', ';TYPE:Wipe tower', ';WIDTH:0.5']
+    lines += self.primeTowerMoves(12)
+    lines += self.wipe()
+    return lines
+
+  def toolchangeWithoutPrimeTower(self, newTool: int) -> list[str]:
+    self.toolchanges += 1
+    if self.spec.flavor == BAMBU:
+      return ['; filament end gcode ', 'M106 P3 S0'] + self.toolchangeBlock(newTool) + ['M106 S0', '; filament start gcode']
+    return ['; Filament-specific end gcode'] + self.toolchangeBlock(newTool)
+
+  def feature(self, featureType: str, wipe: bool) -> list[str]:
+    x, y = self.moveTo()
+    z = fmt(self.z)
+    if self.spec.flavor == BAMBU:
+      lines = [f'G1 X{x} Y{y} F30000', f'G1 Z{fmt(self.z + 0.4)}', f'G1 Z{z}', 'G1 E.8 F1800', f'; FEATURE: {featureType}', '; LINE_WIDTH: 0.45', f'; LAYER_HEIGHT: {fmt(self.height)}', 'G1 F3000']
+    else:
+      lines = [f'G1 X{x} Y{y} F24000', f'G1 Z{z} F720', 'G1 E.8 F1500', f';TYPE:{featureType}', ';WIDTH:0.45', f';HEIGHT:{fmt(self.height)}', 'G1 F2400']
+    lines += self.extrusionMoves(self.spec.linesPerFeature)
+    if wipe:
+      lines += self.wipe()
+    return lines
+
+  def layerChange(self) -> list[str]:
+    z = fmt(self.z)
+    h = fmt(self.height)
+    total = self.totalLayers if self.totalLayers else '?'
+    if self.spec.flavor == BAMBU:
+      lines = ['; CHANGE_LAYER', f'; Z_HEIGHT: {z}', f'; LAYER_HEIGHT: {h}']
+      # The last feature of the previous layer is wiped after the layer change tag like Bambu Studio
+      if self.pendingWipe:
+        lines += self.wipe()
+        self.pendingWipe = False
+      lines += [
+        f'; layer num/total_layer_count: {self.layerNum}/{total}',
+        'M622.1 S1 ; for prev firware, default turned on',
+        'M1002 judge_flag timelapse_record_flag',
+        'M622 J1',
+        ' ; timelapse without wipe tower',
+        'M971 S11 C10 O0',
+        '',
+        'M623',
+        '; update layer progress',
+        f'M73 L{self.layerNum}',
+        f'M991 S0 P{self.layerNum - 1} ;notify layer change',
+        '; MFM LAYER CHANGE END',
+        'M106 S255',
+        'M204 S10000',
+        'G1 E-.8'
+      ]
+      return lines
+    return [';LAYER_CHANGE', f';Z:{z}', f';HEIGHT:{h}', ';BEFORE_LAYER_CHANGE', 'G92 E0.0', f';{z}', '', '', ';AFTER_LAYER_CHANGE', f';{z}', '; MFM LAYER CHANGE END', 'M204 P500']
+
+  def layer(self):
+    self.layerNum += 1
+    self.height = self.nextHeight()
+    self.z = round(self.z + self.height, 3)
+
+    # Group features by tool starting with the loaded tool like a slicer minimizing toolchanges
+    featureTools = [self.rng.randrange(self.spec.tools) for _ in range(self.spec.featuresPerLayer)]
+    toolOrder = sorted(set(featureTools), key=lambda t: (t != self.tool, (t - self.tool) % self.spec.tools))
+    features = [(t, self.rng.choice(self.featureTypes)) for t in toolOrder for ft in featureTools if ft == t]
+
+    lines = self.layerChange()
+    primeTowerWritten = False
+    for i, (t, featureType) in enumerate(features):
+      if t != self.tool:
+        if self.spec.primeTower:
+          lines += self.primeTower(t)
+          primeTowerWritten = True
+        else:
+          lines += self.toolchangeWithoutPrimeTower(t)
+        self.tool = t
+      # Bambu Studio wipes the last feature of a layer after the next layer change tag
+      self.pendingWipe = self.spec.flavor == BAMBU and i == len(features) - 1 and (primeTowerWritten or not self.spec.primeTower)
+      lines += self.feature(featureType, wipe=not self.pendingWipe)
+    if self.spec.primeTower and not primeTowerWritten:
+      lines += self.primeTower(None)
+    self.write(lines)
+
+  def header(self):
+    if self.spec.flavor == BAMBU:
+      lines = ['; HEADER_BLOCK_START', '; BambuStudio synthetic', f'; total layer number: {self.totalLayers if self.totalLayers else "?"}', '; HEADER_BLOCK_END', '', '; EXECUTABLE_BLOCK_START', 'M73 P0 R0', 'G90', 'M83', 'M204 S500']
+      lines += self.toolchangeBlock(0)
+      lines += ['G1 Z.2 F30000']
+    else:
+      lines = ['; generated by PrusaSlicer synthetic', '', 'M73 P0', 'G21 ; set units to millimeters', 'G90 ; use absolute coordinates', 'M83 ; use relative distances for extrusion']
+      lines += ['; MFM TOOLCHANGE START', '; Change Tool-1 -> Tool0 (layer -1)', 'G1 F21000', 'T0 S1 L0 D0', '', '; MFM TOOLCHANGE END']
+      lines += ['G1 Z.2 F720', 'M107']
+    self.tool = 0
+    self.write(lines)
+
+  def footer(self):
+    if self.spec.flavor == BAMBU:
+      lines = self.wipe() if self.pendingWipe else []
+      lines += ['M106 S0', f'G1 Z{fmt(self.z + 0.5)} F900', 'M400', 'M104 S0', '; EXECUTABLE_BLOCK_END']
+    else:
+      lines = ['; Filament-specific end gcode', f'G1 Z{fmt(self.z + 1)} F720', 'M107', 'M84', '; prusaslicer_config = begin', f'; wipe_tower = {int(self.spec.primeTower)}', '; prusaslicer_config = end']
+    self.write(lines)
+
+  def run(self) -> int:
+    self.header()
+    if self.spec.sizeBytes > 0:
+      # The footer is small so it is not counted toward the size
+      while self.bytesWritten < self.spec.sizeBytes:
+        self.layer()
+    else:
+      for _ in range(self.spec.layers):
+        self.layer()
+    self.footer()
+    return self.layerNum
+
+def writeSyntheticGcode(fn: str, spec: SyntheticGcodeSpec) -> int:
+  """Write a synthetic G-code file and return the number of layers written"""
+  with open(fn, mode='wb') as out:
+    return _SyntheticGcodeWriter(spec, out).run()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Write deterministic synthetic marked G-code')
+  parser.add_argument('output_gcode', help='Output G-code file')
+  parser.add_argument('--flavor', choices=[BAMBU, PRUSA], default=BAMBU)
+  parser.add_argument('--layers', type=int, default=100, help='Layers to write')
+  parser.add_argument('--size_mb', type=float, default=0, help='Write layers until the file is this large instead of a fixed number of layers')
+  parser.add_argument('--features_per_layer', type=int, default=8)
+  parser.add_argument('--lines_per_feature', type=int, default=40)
+  parser.add_argument('--tools', type=int, default=2, help='Tools used by the features. The premade options files recolor to tools 2 and 3 so inputs for them should use 2 tools.')
+  parser.add_argument('--no_prime_tower', action='store_true', help='Do toolchanges at the end of features instead of in a prime tower')
+  parser.add_argument('--adaptive_layer_height', action='store_true')
+  parser.add_argument('--layer_height', type=float, default=0.2)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  spec = SyntheticGcodeSpec()
+  spec.flavor = args.flavor
+  spec.layers = args.layers
+  spec.sizeBytes = int(args.size_mb * 1e6)
+  spec.featuresPerLayer = args.features_per_layer
+  spec.linesPerFeature = args.lines_per_feature
+  spec.tools = max(1, args.tools)
+  spec.primeTower = not args.no_prime_tower
+  spec.adaptiveLayerHeight = args.adaptive_layer_height
+  spec.layerHeight = args.layer_height
+  spec.seed = args.seed
+
+  layers = writeSyntheticGcode(args.output_gcode, spec)
+  print(f"Wrote {layers} layers to {args.output_gcode}")
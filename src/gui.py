@@ -6,8 +6,7 @@ from tkinter import messagebox
 import json
 import os
 
-import threading
-import queue
+import multiprocessing
 
 import enum
 
@@ -15,6 +14,7 @@ import webbrowser
 
 from mfm.configuration import *
 from mfm.map_post_process import *
+from mfm.process_job import *
 
 # RUNTIME Flag
 TEST_MODE = False
@@ -22,6 +22,8 @@ TEST_MODE = False
 # UI Constants
 POST_PROCESS_BUTTON = 'Post Process'
 POST_PROCESS_BUTTON_PROCESSING = 'Processing'
+CANCEL_BUTTON = 'Cancel'
+PROCESS_JOB_POLL_INTERVAL = 100 # ms
 
 # Options keys
 #CONFIG_INPUT_FILE = 'importGcodeFilename'
@@ -61,14 +63,14 @@ def truncateMiddleLength(s, length):
   return s
 
 def addExportToFilename(fn):
-  fnSplit = os.path.splitext(fn)
+  fnSplit = splitGcodeExtension(fn)
   exportFn = f"{fnSplit[0]}-MFM-export"
   if len(fnSplit) > 1:
     exportFn += fnSplit[1]
   return exportFn
 
 class App(tk.Tk):
-  def __init__(self, queue: queue.Queue):
+  def __init__(self):
     super().__init__()
 
     self.title(f'{APP_NAME} {APP_VERSION}')
@@ -79,16 +81,36 @@ class App(tk.Tk):
     self.columnconfigure(0, weight=1)
     self.columnconfigure(1, weight=3)
 
-    self.queue = queue
-    self.postProcessThread: threading.Thread = None
+    self.processJob: ProcessJob = None
 
     # UI strings
     self.statusLeft = tk.StringVar()
     self.statusRight = tk.StringVar()
+    # Last right status message. Progress is shown after it.
+    self.statusRightMessage: str = ''
     self.progress = tk.DoubleVar()
     self.progressButtonString = tk.StringVar(value=POST_PROCESS_BUTTON)
 
     self.create_widgets()
+    self.protocol('WM_DELETE_WINDOW', self.close)
+
+  def close(self):
+    # A job left running would keep writing the output after the window is gone
+    if self.processJob:
+      self.processJob.terminate()
+    self.destroy()
+
+  def showStatus(self, item: StatusQueueItem):
+    if item.statusLeft != None:
+      self.statusLeft.set(item.statusLeft)
+    if item.statusRight != None:
+      self.statusRightMessage = item.statusRight
+    if item.bytesPerSecond != None:
+      self.statusRight.set(f"{self.statusRightMessage} {formatProgress(item)}".strip())
+    elif item.statusRight != None:
+      self.statusRight.set(item.statusRight)
+    if item.progress != None:
+      self.progress.set(item.progress)
 
   def create_widgets(self):
 
@@ -105,7 +127,7 @@ class App(tk.Tk):
     gcodeFlavorComboBox.grid(row=0, column=1, sticky=tk.EW, padx=10, pady=10)
 
     def selectImportGcodeFile():
-      fn = select_open_file([('G-code file', '*.gcode')])
+      fn = select_open_file([('G-code file', '*.gcode'), ('Compressed G-code file', f'*.gcode{GZIP_EXTENSION}'), ('Bambu G-code 3MF package', f'*{GCODE_3MF_EXTENSION}')])
       if fn:
         importGcodeButton.config(text=truncateMiddleLength(fn, 50))
         exportFn = addExportToFilename(fn)
@@ -126,7 +148,7 @@ class App(tk.Tk):
         userOptions[CONFIG_TOOLCHANGE_MINIMAL_FILE] = fn
 
     def selectExportGcodeFile():
-      fn = select_save_file([('G-code file', '*.gcode')])
+      fn = select_save_file([('G-code file', '*.gcode'), ('Compressed G-code file', f'*.gcode{GZIP_EXTENSION}'), ('Bambu G-code 3MF package', f'*{GCODE_3MF_EXTENSION}')])
       if fn:
         if fn == userOptions[CONFIG_INPUT_FILE]:
           fn = addExportToFilename(fn)
@@ -240,9 +262,10 @@ class App(tk.Tk):
 
     def startPostProcess():
       self.progress.set(0)
+      self.statusRightMessage = ''
       self.progressButtonString.set(POST_PROCESS_BUTTON_PROCESSING)
 
-      def postProcessTask():
+      def postProcessConfiguration() -> MFMConfiguration:
         global userOptions
         userOptions = {
           CONFIG_INPUT_FILE : userOptions.get(CONFIG_INPUT_FILE),
@@ -280,7 +303,7 @@ class App(tk.Tk):
                 title='Post Process Requirements',
                 message='Need Print G-code, Options, Toolchange G-code, and Exported G-code to be selected.'
             )
-            return
+            return None
           
         if readUserOptions(userOptions=userOptions, optionsFilename=userOptions.get(IMPORT_OPTIONS_FILENAME)) != None:
           messagebox.showerror(
@@ -296,7 +319,7 @@ class App(tk.Tk):
         lineEndingFlavor = userOptions[LINE_ENDING_FLAVOR] if userOptions[LINE_ENDING_FLAVOR] else LineEnding.AUTODETECT
         print(f"Selected {repr(lineEndingFlavor)} line ending.")
         if lineEndingFlavor == LineEnding.AUTODETECT:
-          lineEndingFlavor = determineLineEndingTypeInFile(userOptions[CONFIG_INPUT_FILE])
+          lineEndingFlavor = determineLineEndingTypeInGcodeFile(userOptions[CONFIG_INPUT_FILE])
           print(f"Detected {repr(lineEndingFlavor)} line ending in input G-code file.")
           if lineEndingFlavor == LineEnding.UNKNOWN:
             lineEndingFlavor = LineEnding.UNIX
@@ -312,26 +335,58 @@ class App(tk.Tk):
         mfmConfig[CONFIG_LINE_ENDING] = lineEndingFlavor.value
         mfmConfig[CONFIG_APP_NAME] = APP_NAME
         mfmConfig[CONFIG_APP_VERSION] = APP_VERSION
-        process(mfmConfig, statusQueue)
-
-      startPostProcessButton["state"] = "disabled"
+        return mfmConfig
 
-      postProcessThread = threading.Thread(target=postProcessTask)
-      postProcessThread.start()
-
-      # Wait on post process thread in another thread to reset UI
-      def resetButton():
-        postProcessThread.join()
-        startPostProcessButton["state"] = "normal"
+      mfmConfig = postProcessConfiguration()
+      if mfmConfig == None:
         self.progressButtonString.set(POST_PROCESS_BUTTON)
-      threading.Thread(target=resetButton).start()
+        return
+
+      startPostProcessButton["state"] = "disabled"
+      cancelPostProcessButton["state"] = "normal"
+
+      # Post process in a child process so the UI stays responsive. Status updates are read in batches from the Tk event loop.
+      self.processJob = ProcessJob(mfmConfig)
+      self.after(PROCESS_JOB_POLL_INTERVAL, pollPostProcess)
+
+    def pollPostProcess():
+      for item in self.processJob.poll():
+        self.showStatus(item)
+      if not self.processJob.done:
+        self.after(PROCESS_JOB_POLL_INTERVAL, pollPostProcess)
+        return
+
+      result = self.processJob.result
+      self.processJob = None
+      if result.cancelled:
+        self.progress.set(0)
+        self.statusRight.set('Cancelled. Partial export G-code deleted.')
+      elif result.error:
+        self.statusRight.set(result.error)
+      startPostProcessButton["state"] = "normal"
+      cancelPostProcessButton["state"] = "disabled"
+      self.progressButtonString.set(POST_PROCESS_BUTTON)
+
+    def cancelPostProcess():
+      if self.processJob:
+        self.processJob.cancel()
+        cancelPostProcessButton["state"] = "disabled"
+        self.statusRight.set('Cancelling')
 
     startPostProcessButton = tk.Button(
       master=self,
       textvariable=self.progressButtonString,
       command=startPostProcess
     )
-    startPostProcessButton.grid(row=9, column=0, sticky=tk.EW, columnspan=2, padx=10)
+    startPostProcessButton.grid(row=9, column=1, sticky=tk.EW, padx=10)
+
+    cancelPostProcessButton = tk.Button(
+      master=self,
+      text=CANCEL_BUTTON,
+      state='disabled',
+      command=cancelPostProcess
+    )
+    cancelPostProcessButton.grid(row=9, column=0, sticky=tk.EW, padx=10)
 
     infoButton = tk.Button(
       master=self,
@@ -359,20 +414,7 @@ class App(tk.Tk):
     infoLabel.grid(row=10, column=1, sticky=tk.E, padx=10)
 
 if __name__ == "__main__":
-  statusQueue: queue.Queue[StatusQueueItem] = queue.Queue()
-  app = App(queue=statusQueue)
-
-  def worker():
-    while True:
-      item = statusQueue.get()
-      statusQueue.task_done()
-      if item.statusLeft != None:
-        app.statusLeft.set(item.statusLeft)
-      if item.statusRight != None:
-        app.statusRight.set(item.statusRight)
-      if item.progress != None:
-        app.progress.set(item.progress)
-      
-  threading.Thread(target=worker, daemon=True).start()
-  
-  app.mainloop()
\ No newline at end of file
+  multiprocessing.freeze_support()
+
+  app = App()
+  app.mainloop()
@@ -0,0 +1,182 @@
+import concurrent.futures, contextlib, csv, glob, json, os, time, typing
+
+from .app_constants import *
+from .printing_constants import *
+from .line_ending import *
+from .configuration import *
+from .gcode_package import *
+from .process_profile import *
+from .map_post_process import *
+
+# Manifest columns
+MANIFEST_INPUT = 'input'
+MANIFEST_OUTPUT = 'output'
+MANIFEST_OPTIONS = 'options'
+MANIFEST_TOOLCHANGE = 'toolchange'
+
+BATCH_EXPORT_SUFFIX = '-MFM-export'
+"""Added to the input filename for the output filename of a job found by a glob"""
+
+class BatchManifestError(Exception):
+  pass
+
+class BatchJob:
+  """Files for post processing one G-code file in a batch"""
+  def __init__(self, inputFile: str, outputFile: str, optionsFile: str, toolchangeFile: str):
+    self.inputFile: str = inputFile
+    self.outputFile: str = outputFile
+    self.optionsFile: str = optionsFile
+    self.toolchangeFile: str = toolchangeFile
+
+class BatchJobResult:
+  """Outcome of one batch job"""
+  def __init__(self, job: BatchJob):
+    self.job: BatchJob = job
+    self.succeeded: bool = False
+    self.error: str = None
+    """Error that stopped the job"""
+    self.seconds: float = 0
+    """Seconds to run the job including loading the options"""
+    self.counts: dict[str, int] = {}
+    """Work counters of the job from ProcessProfile"""
+
+  def toDict(self) -> dict:
+    return {
+      MANIFEST_INPUT: self.job.inputFile,
+      MANIFEST_OUTPUT: self.job.outputFile,
+      MANIFEST_OPTIONS: self.job.optionsFile,
+      MANIFEST_TOOLCHANGE: self.job.toolchangeFile,
+      'succeeded': self.succeeded,
+      'seconds': round(self.seconds, 3),
+      'error': self.error,
+      COUNT_INPUT_BYTES: self.counts.get(COUNT_INPUT_BYTES, 0),
+      COUNT_OUTPUT_BYTES: self.counts.get(COUNT_OUTPUT_BYTES, 0),
+      COUNT_LAYERS: self.counts.get(COUNT_LAYERS, 0),
+      COUNT_TOOLCHANGES_FULL: self.counts.get(COUNT_TOOLCHANGES_FULL, 0),
+      COUNT_TOOLCHANGES_MINIMAL: self.counts.get(COUNT_TOOLCHANGES_MINIMAL, 0)
+    }
+
+def readBatchManifest(fn: str, optionsFile: str = None, toolchangeFile: str = None) -> list[BatchJob]:
+  """Read batch jobs from a CSV file with a header row or a JSON list of objects. Each job has an input and output file and optionally an options and toolchange file, which default to optionsFile and toolchangeFile. Relative paths are relative to the manifest."""
+  with open(fn, newline='') as f:
+    if fn.lower().endswith('.json'):
+      try:
+        rows = json.load(f)
+      except ValueError as e:
+        raise BatchManifestError(f"Manifest {fn} is not valid JSON. {e}")
+      if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise BatchManifestError(f"Manifest {fn} must be a JSON list of objects")
+    else:
+      rows = list(csv.DictReader(f))
+
+  baseDir = os.path.dirname(os.path.abspath(fn))
+  def manifestPath(path: str) -> str:
+    return os.path.join(baseDir, path) if path else None
+
+  jobs: list[BatchJob] = []
+  for i, row in enumerate(rows):
+    job = BatchJob(
+      inputFile=manifestPath(row.get(MANIFEST_INPUT)),
+      outputFile=manifestPath(row.get(MANIFEST_OUTPUT)),
+      optionsFile=manifestPath(row.get(MANIFEST_OPTIONS)) or optionsFile,
+      toolchangeFile=manifestPath(row.get(MANIFEST_TOOLCHANGE)) or toolchangeFile
+    )
+    missing = [column for column, value in ((MANIFEST_INPUT, job.inputFile), (MANIFEST_OUTPUT, job.outputFile), (MANIFEST_OPTIONS, job.optionsFile), (MANIFEST_TOOLCHANGE, job.toolchangeFile)) if not value]
+    if missing:
+      raise BatchManifestError(f"Manifest {fn} job {i+1} has no {', '.join(missing)}")
+    jobs.append(job)
+  return jobs
+
+def globBatchJobs(pattern: str, outputDir: str, optionsFile: str, toolchangeFile: str) -> list[BatchJob]:
+  """Batch jobs for the G-code files matching a glob pattern. Outputs are written to outputDir, or next to each input if there is no outputDir, with BATCH_EXPORT_SUFFIX added to the name. Outputs of a previous batch are not matched again."""
+  jobs: list[BatchJob] = []
+  for fn in sorted(glob.glob(pattern, recursive=True)):
+    name, extension = splitGcodeExtension(os.path.basename(fn))
+    if not os.path.isfile(fn) or name.endswith(BATCH_EXPORT_SUFFIX):
+      continue
+    outputFile = os.path.join(outputDir or os.path.dirname(fn), name + BATCH_EXPORT_SUFFIX + extension)
+    jobs.append(BatchJob(inputFile=fn, outputFile=outputFile, optionsFile=optionsFile, toolchangeFile=toolchangeFile))
+  return jobs
+
+def batchJobConfiguration(job: BatchJob, lineEnding: LineEnding, layerIndex: bool, jobs: int) -> MFMConfiguration:
+  userOptions = {}
+  if readUserOptions(userOptions=userOptions, optionsFilename=job.optionsFile) != None:
+    raise ValueError(f"Options file {job.optionsFile} could not be parsed")
+
+  if lineEnding == LineEnding.AUTODETECT:
+    lineEnding = determineLineEndingTypeInGcodeFile(job.inputFile)
+    if lineEnding == LineEnding.UNKNOWN:
+      lineEnding = LineEnding.UNIX
+
+  mfmConfig = MFMConfiguration()
+  mfmConfig[CONFIG_GCODE_FLAVOR] = MARLIN_2_BAMBU_PRUSA_MARKED_GCODE
+  mfmConfig[CONFIG_INPUT_FILE] = job.inputFile
+  mfmConfig[CONFIG_OUTPUT_FILE] = job.outputFile
+  mfmConfig[CONFIG_TOOLCHANGE_MINIMAL_FILE] = job.toolchangeFile
+  mfmConfig[CONFIG_PERIODIC_COLORS] = parsePeriodicColors(userOptions=userOptions)
+  mfmConfig[CONFIG_REPLACEMENT_COLORS] = parseReplacementColors(userOptions=userOptions)
+  mfmConfig[CONFIG_LINE_ENDING] = lineEnding.value
+  mfmConfig[CONFIG_LAYER_INDEX] = layerIndex
+  mfmConfig[CONFIG_JOBS] = jobs
+  mfmConfig[CONFIG_PROFILE] = True
+  mfmConfig[CONFIG_RAISE_ERRORS] = True
+  mfmConfig[CONFIG_APP_NAME] = APP_NAME
+  mfmConfig[CONFIG_APP_VERSION] = APP_VERSION
+  return mfmConfig
+
+def runBatchJob(job: BatchJob, lineEnding: LineEnding = LineEnding.AUTODETECT, layerIndex: bool = False, jobs: int = 1) -> BatchJobResult:
+  """Post process one batch job. Any error is recorded in the result instead of raised."""
+  result = BatchJobResult(job)
+  startTime = time.monotonic()
+  try:
+    # Per layer messages from hundreds of jobs are not useful
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      profile = process(configuration=batchJobConfiguration(job, lineEnding, layerIndex, jobs), statusQueue=None)
+    result.counts = profile.counts
+    result.succeeded = True
+  except Exception as e:
+    result.error = f"{type(e).__name__}: {e}"
+  result.seconds = time.monotonic() - startTime
+  return result
+
+def runBatch(jobs: list[BatchJob], workers: int, onResult: typing.Callable[[BatchJobResult], None] = None, lineEnding: LineEnding = LineEnding.AUTODETECT, layerIndex: bool = False, layerJobs: int = 1) -> list[BatchJobResult]:
+  """Run batch jobs in a pool of worker processes. Results are returned in job order and passed to onResult as each job finishes. A job that ends its worker process is failed without stopping the other jobs."""
+  results: list[BatchJobResult] = [None] * len(jobs)
+
+  def finish(i: int, result: BatchJobResult):
+    results[i] = result
+    if onResult:
+      onResult(result)
+
+  def runInPool(pending: list[int], poolWorkers: int) -> list[int]:
+    """Run jobs and return the jobs left unfinished by a worker process that ended"""
+    unfinished = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=poolWorkers) as pool:
+      futures = {pool.submit(runBatchJob, jobs[i], lineEnding, layerIndex, layerJobs): i for i in pending}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          finish(futures[future], future.result())
+        except concurrent.futures.process.BrokenProcessPool:
+          unfinished.append(futures[future])
+    return sorted(unfinished)
+
+  unfinished = runInPool(list(range(len(jobs))), workers)
+  # Find the job that ended the worker by running the unfinished jobs one at a time
+  for i in unfinished:
+    if not runInPool([i], 1):
+      continue
+    result = BatchJobResult(jobs[i])
+    result.error = 'Worker process ended while post processing'
+    finish(i, result)
+  return results
+
+def writeBatchSummary(fn: str, results: list[BatchJobResult]):
+  """Write the batch job results to a JSON file, or a CSV file for any other extension"""
+  rows = [result.toDict() for result in results]
+  with open(fn, 'w', newline='') as f:
+    if fn.lower().endswith('.json'):
+      json.dump(rows, f, indent=2)
+    elif rows:
+      writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+      writer.writeheader()
+      writer.writerows(rows)
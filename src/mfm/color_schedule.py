@@ -0,0 +1,140 @@
+import bisect, copy, itertools, json, math, typing
+
+from .printing_classes import *
+
+# Isoline state of a layer for a PeriodicColor
+ISOLINE_NONE = 0
+ISOLINE = 1
+ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR = 2
+"""The layer envelops an isoline but is not an isoline if the previous layer was thicker than the isoline and ended printing a periodic color. That previous layer already printed the whole isoline height so the isoline would be double thick."""
+
+ISOLINE_STATE_NAMES = {
+  ISOLINE_NONE: 'none',
+  ISOLINE: 'isoline',
+  ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR: 'isoline_unless_printing_periodic_color'
+}
+
+def isolineStates(pc: PeriodicColor, heights: typing.Sequence[float], layerHeights: typing.Sequence[float], previousLayerHeights: typing.Sequence[float]) -> list[int]:
+  """Isoline state of each layer for a PeriodicColor"""
+  states = []
+  for height, layerHeight, previousLayerHeight in zip(heights, layerHeights, previousLayerHeights):
+    state = ISOLINE_NONE
+    if height >= pc.startHeight and height <= pc.endHeight:
+      # current layer top is inside an isoline
+      if (height - pc.startHeight) % pc.period <= pc.height:
+        state = ISOLINE
+      # current layer is thicker than the isoline and envelops an isoline. The bottom is in the isoline or the top is above the next isoline.
+      elif layerHeight > pc.height:
+        if ((height - pc.startHeight) - layerHeight) % pc.period < pc.height or height - pc.startHeight > math.ceil(((height - pc.startHeight) - layerHeight) / pc.period) * pc.period + pc.height:
+          state = ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR if previousLayerHeight > pc.height else ISOLINE
+    states.append(state)
+  return states
+
+class ReplacementColorIntervals:
+  """Replacement color bands of one original color indexed by height. The band boundaries split the heights into segments, and each segment keeps the bands covering it in priority order, so finding the band on a layer is a binary search instead of a scan of every band."""
+
+  def __init__(self, rcs: list[ReplacementColorAtHeight]):
+    self.emptyBands: list[tuple[int, ReplacementColorAtHeight]] = [(priority, rc) for priority, rc in enumerate(rcs) if rc.endHeight <= rc.startHeight]
+    """Bands without a height range that are not in any segment but still overlap a layer that spans them"""
+    self.boundaries: list[float] = sorted({height for rc in rcs for height in (rc.startHeight, rc.endHeight)})
+    """Sorted start and end heights of the bands"""
+    self.segmentBands: list[list[tuple[int, ReplacementColorAtHeight]]] = []
+    """Bands covering each segment between boundaries with their priority, highest priority first. Bands later in the list have a higher priority."""
+    for bottom, top in zip(self.boundaries, self.boundaries[1:]):
+      self.segmentBands.append([(priority, rc) for priority, rc in reversed(list(enumerate(rcs))) if rc.startHeight <= bottom and rc.endHeight >= top])
+
+  def find(self, height: float, layerHeight: float) -> ReplacementColorAtHeight | None:
+    """Highest priority band overlapping a layer or None"""
+    bottom = height - layerHeight
+    first = max(bisect.bisect_right(self.boundaries, bottom) - 1, 0)
+    last = min(max(bisect.bisect_left(self.boundaries, height), first + 1), len(self.segmentBands))
+    found = None
+    for bands in itertools.chain(itertools.islice(self.segmentBands, first, last), ([band] for band in self.emptyBands)):
+      for priority, rc in bands:
+        # A thin layer on a boundary can be in a segment without overlapping every band covering it
+        if height > rc.startHeight and bottom < rc.endHeight:
+          if found == None or priority > found[0]:
+            found = (priority, rc)
+          break
+    return found[1] if found else None
+
+def replacementColorIntervals(rcs: list[ReplacementColorAtHeight]) -> dict[int, ReplacementColorIntervals]:
+  """Replacement color bands indexed by height for each original color"""
+  return {originalColorIndex: ReplacementColorIntervals([rc for rc in rcs if rc.originalColorIndex == originalColorIndex]) for originalColorIndex in sorted({rc.originalColorIndex for rc in rcs})}
+
+def replacementColorIndexSchedule(intervals: dict[int, ReplacementColorIntervals], heights: typing.Sequence[float], layerHeights: typing.Sequence[float], colorCount: int) -> list[tuple[int, ...]]:
+  """Replacement color index of each loaded color on each layer. A replacement color applies to a layer that overlaps its height range. Replacement colors later in the list take priority where they overlap."""
+  schedule = []
+  for height, layerHeight in zip(heights, layerHeights):
+    current = [-1] * colorCount
+    for originalColorIndex, index in intervals.items():
+      rc = index.find(height, layerHeight)
+      if rc:
+        current[originalColorIndex] = rc.colorIndex
+    schedule.append(tuple(current))
+  return schedule
+
+class ColorSchedule:
+  """Isoline and replacement color decisions for every layer of a print. The decisions only depend on the layer heights and the options so the schedule for the whole print can be found and inspected before any G-code is written. Layers are added in print order."""
+
+  def __init__(self, pcs: list[PeriodicColor], rcs: list[ReplacementColorAtHeight]):
+    self.periodicColors: list[PeriodicColor] = pcs
+    """Isolines in priority order. The first isoline on a layer is printed where isolines overlap."""
+    self.replacementColors: list[ReplacementColorAtHeight] = rcs
+    self.heights: list[float] = []
+    """Height of each layer"""
+    self.isolineStates: list[list[int]] = [[] for _ in pcs]
+    """Isoline state of each layer for each PeriodicColor"""
+    self.replacementColorIndexes: list[tuple[int, ...]] = []
+    """Replacement color index of each original color up to the highest replaced original color on each layer"""
+    self._colorCount = max((rc.originalColorIndex for rc in rcs), default=-1) + 1
+    self._replacementColorIntervals = replacementColorIntervals(rcs)
+
+  def __len__(self) -> int:
+    return len(self.heights)
+
+  def extend(self, heights: typing.Sequence[float], layerHeights: typing.Sequence[float], previousLayerHeights: typing.Sequence[float]):
+    """Add the decisions for the next layers"""
+    self.heights.extend(heights)
+    for pc, states in zip(self.periodicColors, self.isolineStates):
+      states.extend(isolineStates(pc, heights, layerHeights, previousLayerHeights))
+    self.replacementColorIndexes.extend(replacementColorIndexSchedule(self._replacementColorIntervals, heights, layerHeights, self._colorCount))
+
+  def periodicColor(self, layerNum: int, printingPeriodicColor: bool) -> PeriodicColor | None:
+    """PeriodicColor of the isoline on a layer or None. printingPeriodicColor is whether the previous layer ended printing a periodic color."""
+    for pc, states in zip(self.periodicColors, self.isolineStates):
+      state = states[layerNum]
+      if state == ISOLINE or (state == ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR and not printingPeriodicColor):
+        return pc
+    return None
+
+  def toolRemap(self, layerNum: int) -> list[int]:
+    """Printing tool index for each original tool index on a layer. A tool past the end of the table is not replaced."""
+    return [colorIndex if replacementColorIndex == -1 else replacementColorIndex for colorIndex, replacementColorIndex in enumerate(self.replacementColorIndexes[layerNum])]
+
+  def section(self, start: int, end: int) -> 'ColorSchedule':
+    """Schedule of the layers from start to end. Layer numbers in the section start at 0 so part of the print can be sent to another process."""
+    schedule = copy.copy(self)
+    schedule.heights = self.heights[start:end]
+    schedule.isolineStates = [states[start:end] for states in self.isolineStates]
+    schedule.replacementColorIndexes = self.replacementColorIndexes[start:end]
+    return schedule
+
+  def toDict(self) -> dict:
+    return {
+      'periodic_colors': [{'color_index': pc.colorIndex, 'start_height': pc.startHeight, 'end_height': pc.endHeight, 'height': pc.height, 'period': pc.period} for pc in self.periodicColors],
+      'layers': [{
+        'height': height,
+        'isolines': [ISOLINE_STATE_NAMES[states[layerNum]] for states in self.isolineStates],
+        'replacement_color_indexes': list(self.replacementColorIndexes[layerNum])
+      } for layerNum, height in enumerate(self.heights)]
+    }
+
+  def toJSON(self) -> str:
+    return json.dumps(self.toDict(), indent=2)
+
+def buildColorSchedule(layers: list[PrintState], pcs: list[PeriodicColor], rcs: list[ReplacementColorAtHeight]) -> ColorSchedule:
+  """Color schedule for all layers of a print found by the layer scan"""
+  schedule = ColorSchedule(pcs, rcs)
+  schedule.extend([layer.height for layer in layers], [layer.layerHeight for layer in layers], [layer.previousLayerHeight for layer in layers])
+  return schedule
@@ -1,9 +1,11 @@
-import typing, queue
+import typing, queue, logging
 
 import json
 
 from .printing_classes import PeriodicColor, ReplacementColorAtHeight
 
+log = logging.getLogger(__name__)
+
 # Only export MFMConfiguration and not any imported values
 #__all__ = ['MFMConfiguration']
 
@@ -17,11 +19,13 @@ REAL_WORLD_ISOLINE_ELEVATION_END = 'realWorldIsolineElevationEnd'
 MODEL_ISOLINE_HEIGHT = 'modelIsolineHeight' #in model units (mm)
 ISOLINE_COLOR_INDEX = 'isolineColorIndex'
 ISOLINE_ENABLED_FEATURES = 'isolineColorFeatureTypes'
+ISOLINES = 'isolines' # more isolines, each with the isoline options. Missing options are the same as the first isoline.
 
 REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START = 'realWorldElevationReplacementColorStart'
 REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END = 'realWorldElevationReplacementColorEnd'
 REPLACEMENT_COLOR_INDEX = 'replacementColorIndex'
 REPLACEMENT_ORIGINAL_COLOR_INDEX = 'replacementOriginalColorIndex'
+REPLACEMENT_COLORS = 'replacementColors' # more elevation replacement color bands, each with the replacement color options. Missing options are the same as the first band.
 
 periodicColorRequiredOptions = [
   MODEL_TO_REAL_WORLD_DEFAULT_UNITS,
@@ -53,6 +57,11 @@ class MFMConfiguration(typing.TypedDict):
   CONFIG_PERIODIC_COLORS: list[PeriodicColor]
   CONFIG_REPLACEMENT_COLORS: list[ReplacementColorAtHeight]
   CONFIG_LINE_ENDING: str
+  CONFIG_LAYER_INDEX: bool
+  CONFIG_JOBS: int
+  CONFIG_PROFILE: bool
+  CONFIG_PROGRESS_RATE: float
+  CONFIG_RAISE_ERRORS: bool
   CONFIG_APP_NAME: str
   CONFIG_APP_VERSION: str
 
@@ -87,38 +96,42 @@ def createReplacementColor(modelToRealWorldDefaultUnits: float, modelOneToNVerti
 
 def parsePeriodicColors(userOptions: dict) -> list[PeriodicColor] | bool:
   periodicColors: list[PeriodicColor] = []
-  if all (opt in userOptions for opt in periodicColorRequiredOptions):
-    periodicColors.append(
-      createIsoline(
-        modelToRealWorldDefaultUnits=userOptions[MODEL_TO_REAL_WORLD_DEFAULT_UNITS],
-        modelOneToNVerticalScale=userOptions[MODEL_ONE_TO_N_VERTICAL_SCALE],
-        modelSeaLevelBaseThickness=userOptions[MODEL_SEA_LEVEL_BASE_THICKNESS],
-        realWorldIsolineElevationInterval=userOptions[REAL_WORLD_ISOLINE_ELEVATION_INTERVAL],
-        realWorldIsolineElevationStart=userOptions[REAL_WORLD_ISOLINE_ELEVATION_START],
-        realWorldIsolineElevationEnd=userOptions[REAL_WORLD_ISOLINE_ELEVATION_END],
-        modelIsolineHeight=userOptions[MODEL_ISOLINE_HEIGHT],
-        colorIndex=userOptions[ISOLINE_COLOR_INDEX],
-        enabledFeatures=userOptions[ISOLINE_ENABLED_FEATURES]
+  # Isolines are in priority order where they overlap
+  for isolineOptions in [userOptions] + [userOptions | isoline for isoline in userOptions.get(ISOLINES, [])]:
+    if all (opt in isolineOptions for opt in periodicColorRequiredOptions):
+      periodicColors.append(
+        createIsoline(
+          modelToRealWorldDefaultUnits=isolineOptions[MODEL_TO_REAL_WORLD_DEFAULT_UNITS],
+          modelOneToNVerticalScale=isolineOptions[MODEL_ONE_TO_N_VERTICAL_SCALE],
+          modelSeaLevelBaseThickness=isolineOptions[MODEL_SEA_LEVEL_BASE_THICKNESS],
+          realWorldIsolineElevationInterval=isolineOptions[REAL_WORLD_ISOLINE_ELEVATION_INTERVAL],
+          realWorldIsolineElevationStart=isolineOptions[REAL_WORLD_ISOLINE_ELEVATION_START],
+          realWorldIsolineElevationEnd=isolineOptions[REAL_WORLD_ISOLINE_ELEVATION_END],
+          modelIsolineHeight=isolineOptions[MODEL_ISOLINE_HEIGHT],
+          colorIndex=isolineOptions[ISOLINE_COLOR_INDEX],
+          enabledFeatures=isolineOptions[ISOLINE_ENABLED_FEATURES]
+        )
       )
-    )
-    print("Added isoline based on options")
+      log.info("Added isoline based on options")
   return periodicColors
 
 def parseReplacementColors(userOptions: dict) -> list[ReplacementColorAtHeight] | bool:
   replacementColors: list[ReplacementColorAtHeight] = []
-  if all (opt in userOptions for opt in replacementColorRequiredOptions):
-    replacementColors.append(
-      createReplacementColor(
-        modelToRealWorldDefaultUnits=userOptions[MODEL_TO_REAL_WORLD_DEFAULT_UNITS],
-        modelOneToNVerticalScale=userOptions[MODEL_ONE_TO_N_VERTICAL_SCALE],
-        modelSeaLevelBaseThickness=userOptions[MODEL_SEA_LEVEL_BASE_THICKNESS],
-        realWorldElevationStart=userOptions[REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START],
-        realWorldElevationEnd=userOptions[REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END],
-        colorIndex=userOptions[REPLACEMENT_COLOR_INDEX],
-        originalColorIndex=userOptions[REPLACEMENT_ORIGINAL_COLOR_INDEX]
+  # Bands later in the list take priority where bands overlap
+  for replacementOptions in [userOptions] + [userOptions | replacement for replacement in userOptions.get(REPLACEMENT_COLORS, [])]:
+    if all (opt in replacementOptions for opt in replacementColorRequiredOptions):
+      replacementColors.append(
+        createReplacementColor(
+          modelToRealWorldDefaultUnits=replacementOptions[MODEL_TO_REAL_WORLD_DEFAULT_UNITS],
+          modelOneToNVerticalScale=replacementOptions[MODEL_ONE_TO_N_VERTICAL_SCALE],
+          modelSeaLevelBaseThickness=replacementOptions[MODEL_SEA_LEVEL_BASE_THICKNESS],
+          realWorldElevationStart=replacementOptions[REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START],
+          realWorldElevationEnd=replacementOptions[REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END],
+          colorIndex=replacementOptions[REPLACEMENT_COLOR_INDEX],
+          originalColorIndex=replacementOptions[REPLACEMENT_ORIGINAL_COLOR_INDEX]
+        )
       )
-    )
-    print("Added replacement color based on options")
+      log.info("Added replacement color based on options")
   return replacementColors
 
 
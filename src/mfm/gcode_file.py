@@ -0,0 +1,288 @@
+import hashlib, mmap, os, re, typing
+
+from .line_ending import *
+
+GCODE_ENCODING = 'utf-8'
+GCODE_ENCODING_ERRORS = 'surrogateescape' # Round trip any byte that is not valid UTF-8 unchanged
+
+STDIO_FILENAME = '-'
+"""Filename for standard input or standard output"""
+GCODE_STREAM_CHUNK_SIZE = 1 << 20
+
+_CRLF_RE = re.compile(rb'\r\n')
+_BARE_LF_RE = re.compile(rb'(?<!\r)\n')
+
+class GcodeReader:
+  """Memory mapped G-code file reader. Positions are exact byte offsets in the file and no newline translation is done on the bytes in the file."""
+
+  def __init__(self, fn: str):
+    self._file = open(fn, mode='rb')
+    stat = os.fstat(self._file.fileno())
+    self.size: int = stat.st_size
+    """Size of the file in bytes"""
+    self.mtime: int = stat.st_mtime_ns
+    """Last modification time of the file in nanoseconds"""
+    # mmap cannot map an empty file
+    self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+    # Position in the file of the first byte in the buffer
+    self._base: int = 0
+    self._pos: int = 0
+    self.lineStart: int = 0
+    """Byte offset of the start of the last line read"""
+    self.linesRead: int = 0
+    """Number of lines returned by readline()"""
+    self._lineEnding: str = None
+    self._lineEndingChecked: bool = False
+    # Start, end and text of the line read ahead by peekline()
+    self._peeked: tuple[int, int, str] = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._buffer:
+      self._buffer.close()
+      self._buffer = None
+    self._file.close()
+
+  def readline(self) -> str:
+    """Read the next line. A Windows line ending is returned as '\\n' so patterns can match the line the same way as a universal newlines text file. Returns an empty string at end of file."""
+    self.lineStart = self._pos
+    if self._peeked and self._peeked[0] == self._pos:
+      return self._readPeeked()
+    if self._pos >= self.size:
+      return ''
+    end = self._buffer.find(b'\n', self._pos)
+    end = self.size if end == -1 else end + 1
+    line = self._buffer[self._pos:end]
+    self._pos = end
+    self.linesRead += 1
+    if line[-2:] == b'\r\n':
+      line = line[:-2] + b'\n'
+    return line.decode(GCODE_ENCODING, GCODE_ENCODING_ERRORS)
+
+  def peekline(self) -> str:
+    """Next line returned the same way as readline() without moving the read position. The line is kept so the next readline() returns it without reading it again."""
+    if self._peeked and self._peeked[0] == self._pos:
+      return self._peeked[2]
+    lineStart, pos, linesRead = self.lineStart, self._pos, self.linesRead
+    line = self.readline()
+    if line:
+      self._peeked = (pos, self._pos, line)
+    self.lineStart, self._pos, self.linesRead = lineStart, pos, linesRead
+    return line
+
+  def _readPeeked(self) -> str:
+    _, self._pos, line = self._peeked
+    self._peeked = None
+    self.linesRead += 1
+    return line
+
+  @property
+  def lineEnding(self) -> str | None:
+    """Line ending used by every line in the file or None if line endings are mixed. Only checked when needed."""
+    if not self._lineEndingChecked:
+      self._lineEndingChecked = True
+      if self._buffer == None or _CRLF_RE.search(self._buffer) == None:
+        self._lineEnding = LineEnding.UNIX.value
+      elif _BARE_LF_RE.search(self._buffer) == None:
+        self._lineEnding = LineEnding.WINDOWS.value
+    return self._lineEnding
+
+  def previousLineStart(self, pos: int) -> int:
+    """Start of the line that ends right before pos"""
+    if pos <= 0 or self._buffer == None:
+      return 0
+    return self._buffer.rfind(b'\n', 0, pos-1) + 1
+
+  def tell(self) -> int:
+    """Byte offset of the next line to be read"""
+    return self._pos
+
+  def seek(self, pos: int, whence: int = os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      pos += self._pos
+    elif whence == os.SEEK_END:
+      pos += self.size
+    self._pos = pos
+
+  def lineAt(self, pos: int) -> str:
+    """Line that starts at pos returned the same way as readline() without moving the read position"""
+    i = pos - self._base
+    end = self._buffer.find(b'\n', i)
+    end = len(self._buffer) if end == -1 else end + 1
+    line = self._buffer[i:end]
+    if line[-2:] == b'\r\n':
+      line = line[:-2] + b'\n'
+    return line.decode(GCODE_ENCODING, GCODE_ENCODING_ERRORS)
+
+  def readRange(self, start: int, end: int) -> bytes:
+    """Raw bytes in the file between start and end byte offsets"""
+    if self._buffer == None:
+      return b''
+    return self._buffer[start:end]
+
+  def matchStarts(self, pattern: re.Pattern, start: int, end: int) -> list[int]:
+    """Start byte offsets of the matches of a bytes pattern in the file between start and end byte offsets"""
+    if self._buffer == None:
+      return []
+    return [m.start() for m in pattern.finditer(self._buffer, start, end)]
+
+  def searchStart(self, pattern: re.Pattern, start: int) -> int:
+    """Start byte offset of the first match of a bytes pattern in the file at or after start. -1 if there is no match."""
+    if self._buffer == None:
+      return -1
+    m = pattern.search(self._buffer, start)
+    return m.start() if m else -1
+
+  def contentHash(self) -> str:
+    """Hash of the entire file content"""
+    h = hashlib.blake2b(digest_size=16)
+    if self._buffer != None:
+      h.update(self._buffer)
+    return h.hexdigest()
+
+class GcodeStreamReader(GcodeReader):
+  """G-code read once from a stream such as a pipe. Only the bytes from the start of the kept window to the last line read are in memory. Positions are byte offsets in the whole stream and can only be read again until they are released."""
+
+  def __init__(self, stream: typing.BinaryIO, chunkSize: int = GCODE_STREAM_CHUNK_SIZE):
+    self._file = stream
+    self._chunkSize = chunkSize
+    self._buffer = bytearray()
+    self._base: int = 0
+    self._eof: bool = False
+    self.size: int = 0
+    """Bytes read from the stream so far. This is the size of the stream once the end is reached."""
+    self.mtime: int = 0
+    self._pos: int = 0
+    self.lineStart: int = 0
+    self.linesRead: int = 0
+    self.peakBufferSize: int = 0
+    """Most bytes held in memory at once"""
+    # Line endings are not known until the whole stream is read so copied lines are always converted
+    self._lineEnding: str = None
+    self._lineEndingChecked: bool = True
+    self._peeked: tuple[int, int, str] = None
+
+  def close(self):
+    # The stream is owned by the caller
+    pass
+
+  def _fill(self) -> bool:
+    """Read the next chunk of the stream into the buffer. Returns False at the end of the stream."""
+    if self._eof:
+      return False
+    chunk = self._file.read(self._chunkSize)
+    if not chunk:
+      self._eof = True
+      return False
+    self._buffer += chunk
+    self.size += len(chunk)
+    self.peakBufferSize = max(self.peakBufferSize, len(self._buffer))
+    return True
+
+  def readline(self) -> str:
+    self.lineStart = self._pos
+    if self._peeked and self._peeked[0] == self._pos:
+      return self._readPeeked()
+    i = self._pos - self._base
+    if i < 0:
+      raise ValueError(f"Stream position {self._pos} was already released")
+    while i >= len(self._buffer):
+      if not self._fill():
+        return ''
+    searchStart = i
+    end = self._buffer.find(b'\n', searchStart)
+    while end == -1:
+      searchStart = len(self._buffer)
+      if not self._fill():
+        break
+      end = self._buffer.find(b'\n', searchStart)
+    end = len(self._buffer) if end == -1 else end + 1
+    line = self._buffer[i:end]
+    self._pos = self._base + end
+    self.linesRead += 1
+    if line[-2:] == b'\r\n':
+      line = line[:-2] + b'\n'
+    return line.decode(GCODE_ENCODING, GCODE_ENCODING_ERRORS)
+
+  def previousLineStart(self, pos: int) -> int:
+    if pos <= self._base:
+      return self._base
+    return self._buffer.rfind(b'\n', 0, pos-1-self._base) + 1 + self._base
+
+  def readRange(self, start: int, end: int) -> bytes:
+    return bytes(self._buffer[start-self._base:end-self._base])
+
+  def matchStarts(self, pattern: re.Pattern, start: int, end: int) -> list[int]:
+    return [m.start() + self._base for m in pattern.finditer(self._buffer, start-self._base, end-self._base)]
+
+  def release(self, pos: int):
+    """Drop the bytes before pos from memory"""
+    if pos > self._base:
+      del self._buffer[:pos-self._base]
+      self._base = pos
+
+class GcodeWriter:
+  """Binary G-code output file. Text written is encoded with the G-code line ending and spans copied from a GcodeReader are written as raw bytes."""
+
+  def __init__(self, fn: str | typing.BinaryIO, lineEnding: str = LineEnding.UNIX.value):
+    # An already open binary file such as an in memory buffer can be written to instead of a filename
+    self._ownsFile = isinstance(fn, str)
+    self._file = open(fn, mode='wb') if self._ownsFile else fn
+    self.lineEnding: str = lineEnding
+    """Line ending that '\\n' in written text is converted to"""
+    self.bytesWritten: int = 0
+    """Bytes written from text or already encoded G-code"""
+    self.bytesCopied: int = 0
+    """Bytes copied from the input file"""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._ownsFile:
+      self._file.close()
+    else:
+      self._file.flush()
+
+  def write(self, s: str):
+    if self.lineEnding != LineEnding.UNIX.value:
+      s = s.replace(LineEnding.UNIX.value, self.lineEnding)
+    b = s.encode(GCODE_ENCODING, GCODE_ENCODING_ERRORS)
+    self.bytesWritten += len(b)
+    self._file.write(b)
+
+  def writeBytes(self, b: bytes):
+    self.bytesWritten += len(b)
+    self._file.write(b)
+
+  def writeRendered(self, b: bytes):
+    """Write G-code that was already counted by the writer that rendered it such as a writer in a worker process"""
+    self._file.write(b)
+
+  def copyRange(self, reader: GcodeReader, start: int, end: int):
+    """Copy a span of the input file to the output without decoding it"""
+    if reader._buffer == None or end <= start:
+      return
+    # Write straight from the memory map without an intermediate bytes copy
+    with memoryview(reader._buffer) as view, view[start-reader._base:end-reader._base] as span:
+      self._file.write(span)
+    self.bytesCopied += end - start
+
+  def copyLines(self, reader: GcodeReader, start: int, end: int):
+    """Copy whole lines of the input file to the output. Line endings are converted to the writer line ending the same as text written with write()."""
+    if reader.lineEnding == self.lineEnding:
+      self.copyRange(reader, start, end)
+      return
+    b = reader.readRange(start, end).replace(b'\r\n', b'\n')
+    if self.lineEnding != LineEnding.UNIX.value:
+      b = b.replace(b'\n', self.lineEnding.encode(GCODE_ENCODING))
+    self._file.write(b)
+    self.bytesCopied += len(b)
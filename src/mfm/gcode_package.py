@@ -0,0 +1,132 @@
+import contextlib, gzip, hashlib, os, re, sys, shutil, time, typing, zipfile
+
+from .line_ending import *
+from .gcode_file import *
+
+GZIP_EXTENSION = '.gz'
+"""Extension of a gzip compressed G-code file"""
+GCODE_3MF_EXTENSION = '.gcode.3mf'
+"""Extension of a Bambu Studio package with the G-code of a sliced plate"""
+GZIP_COMPRESS_LEVEL = 6
+PLATE_GCODE_MD5_EXTENSION = '.md5'
+"""Extension added to the plate G-code member name for the member with the MD5 of the plate G-code that the printer checks"""
+
+_PLATE_GCODE_RE = re.compile(r'^Metadata/plate_\d+\.gcode$')
+
+class GcodePackageError(Exception):
+  pass
+
+def isGzipFile(fn: str | typing.BinaryIO) -> bool:
+  return isinstance(fn, str) and fn.lower().endswith(GZIP_EXTENSION)
+
+def isGcode3mfFile(fn: str | typing.BinaryIO) -> bool:
+  return isinstance(fn, str) and fn.lower().endswith(GCODE_3MF_EXTENSION)
+
+def isStreamedGcodeFile(fn: str) -> bool:
+  """Input G-code that can only be read once from start to end"""
+  return fn == STDIO_FILENAME or isGzipFile(fn) or isGcode3mfFile(fn)
+
+def splitGcodeExtension(fn: str) -> tuple[str, str]:
+  """Split a G-code filename into the name and the extension. A package extension such as .gcode.3mf is kept whole."""
+  for extension in (GCODE_3MF_EXTENSION, '.gcode' + GZIP_EXTENSION):
+    if fn.lower().endswith(extension):
+      return fn[:-len(extension)], fn[-len(extension):]
+  return os.path.splitext(fn)
+
+def plateGcodeMember(package: zipfile.ZipFile) -> zipfile.ZipInfo:
+  """Plate G-code member of a .gcode.3mf package"""
+  members = [info for info in package.infolist() if _PLATE_GCODE_RE.match(info.filename)]
+  if len(members) != 1:
+    raise GcodePackageError(f"{package.filename} has {len(members)} plate G-code files. Only a package with 1 sliced plate can be post processed.")
+  return members[0]
+
+@contextlib.contextmanager
+def openGcodeInputStream(fn: str) -> typing.Iterator[typing.BinaryIO]:
+  """Open the G-code in a file, gzip file, or .gcode.3mf package plate as a binary stream"""
+  if fn == STDIO_FILENAME:
+    yield sys.stdin.buffer
+  elif isGzipFile(fn):
+    with gzip.open(fn, mode='rb') as f:
+      yield f
+  elif isGcode3mfFile(fn):
+    with zipfile.ZipFile(fn) as package, package.open(plateGcodeMember(package)) as f:
+      yield f
+  else:
+    with open(fn, mode='rb') as f:
+      yield f
+
+@contextlib.contextmanager
+def openGcodeReader(fn: str) -> typing.Iterator[GcodeReader]:
+  """Open an input G-code file. Standard input and packages are read as a stream and other files are memory mapped."""
+  if isStreamedGcodeFile(fn):
+    with openGcodeInputStream(fn) as stream, GcodeStreamReader(stream) as f:
+      yield f
+  else:
+    with GcodeReader(fn) as f:
+      yield f
+
+class _MD5Writer:
+  """Binary stream that writes through to another stream and hashes every byte written"""
+
+  def __init__(self, stream: typing.BinaryIO):
+    self._stream = stream
+    self.md5 = hashlib.md5()
+
+  def write(self, b: bytes) -> int:
+    self.md5.update(b)
+    return self._stream.write(b)
+
+  def flush(self):
+    self._stream.flush()
+
+def _newZipInfo(info: zipfile.ZipInfo, filename: str = None, dateTime: tuple = None) -> zipfile.ZipInfo:
+  newInfo = zipfile.ZipInfo(filename or info.filename, dateTime or info.date_time)
+  newInfo.compress_type = info.compress_type
+  newInfo.external_attr = info.external_attr
+  return newInfo
+
+def _copyZipMember(source: zipfile.ZipFile, package: zipfile.ZipFile, info: zipfile.ZipInfo):
+  with source.open(info) as src, package.open(_newZipInfo(info), mode='w', force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as dst:
+    shutil.copyfileobj(src, dst, GCODE_STREAM_CHUNK_SIZE)
+
+@contextlib.contextmanager
+def openGcodeWriter(fn: str | typing.BinaryIO, lineEnding: str, inputFn: str) -> typing.Iterator[GcodeWriter]:
+  """Open an output G-code file. A .gcode.3mf output is a copy of the .gcode.3mf input package with the plate G-code replaced by the G-code written, and the plate G-code MD5 hashed while it is written."""
+  if isGzipFile(fn):
+    with gzip.open(fn, mode='wb', compresslevel=GZIP_COMPRESS_LEVEL) as stream, GcodeWriter(stream, lineEnding) as out:
+      yield out
+  elif isGcode3mfFile(fn):
+    if not isGcode3mfFile(inputFn):
+      raise GcodePackageError(f"Output {fn} is a {GCODE_3MF_EXTENSION} package so the input G-code must also be a {GCODE_3MF_EXTENSION} package to copy the rest of the package from.")
+    with zipfile.ZipFile(inputFn) as source, zipfile.ZipFile(fn, mode='w') as package:
+      plate = plateGcodeMember(source)
+      md5Filename = plate.filename + PLATE_GCODE_MD5_EXTENSION
+      md5Info = source.getinfo(md5Filename) if md5Filename in source.namelist() else None
+      # Keep the case of the MD5 in the input package. Bambu Studio writes it in uppercase.
+      lowercaseMD5 = md5Info != None and source.read(md5Info).decode().strip().islower()
+
+      # The MD5 member is written right after the plate G-code it hashes
+      members = [info for info in source.infolist() if info != md5Info]
+      plateIndex = members.index(plate)
+      for info in members[:plateIndex]:
+        _copyZipMember(source, package, info)
+
+      modified = time.localtime()[:6]
+      # Post processed G-code is usually larger than the input so allow for growth past the zip size limit
+      with package.open(_newZipInfo(plate, dateTime=modified), mode='w', force_zip64=plate.file_size * 2 >= zipfile.ZIP64_LIMIT) as stream:
+        hashed = _MD5Writer(stream)
+        with GcodeWriter(hashed, lineEnding) as out:
+          yield out
+      md5 = hashed.md5.hexdigest()
+      package.writestr(_newZipInfo(md5Info or plate, filename=md5Filename, dateTime=modified), md5 if lowercaseMD5 else md5.upper())
+
+      for info in members[plateIndex+1:]:
+        _copyZipMember(source, package, info)
+  else:
+    with GcodeWriter(fn, lineEnding) as out:
+      yield out
+
+def determineLineEndingTypeInGcodeFile(fn: str) -> LineEnding:
+  """Line ending of the G-code in a file or package"""
+  with openGcodeInputStream(fn) as f:
+    return determineLineEndingTypeInStream(f)
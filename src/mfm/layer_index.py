@@ -0,0 +1,141 @@
+import json, logging, os, sys, zlib
+
+from .printing_constants import *
+from .printing_classes import *
+from .gcode_file import *
+
+log = logging.getLogger(__name__)
+
+LAYER_INDEX_EXTENSION = '.mfmidx'
+LAYER_INDEX_VERSION = 3
+
+class LayerIndex:
+  """Layers and features of a G-code file found in a single scan. The index does not depend on the options so it can be reused for any options on the same G-code file."""
+  def __init__(self, f: GcodeReader = None):
+    self.fileSize: int = f.size if f else 0
+    """Size of the indexed G-code file"""
+    self.fileMtime: int = f.mtime if f else 0
+    """Modification time of the indexed G-code file"""
+    self._fileHash: str = None
+    self._file: GcodeReader = f
+    self.layers: list[PrintState] = []
+    """Layers in file order"""
+    self.layerChangeStarts: list[int] = []
+    """Start position of the layer change line of each layer"""
+    self._layersByLayerChangeStart: dict[int, PrintState] = {}
+
+  @property
+  def fileHash(self) -> str:
+    """Content hash of the indexed G-code file. Only computed when needed."""
+    if self._fileHash == None and self._file:
+      self._fileHash = self._file.contentHash()
+    return self._fileHash
+
+  def __getstate__(self):
+    # The open file cannot be sent to another process
+    state = self.__dict__.copy()
+    state['_file'] = None
+    return state
+
+  def addLayer(self, layerChangeStart: int, layer: PrintState):
+    self.layers.append(layer)
+    self.layerChangeStarts.append(layerChangeStart)
+    self._layersByLayerChangeStart[layerChangeStart] = layer
+
+  def layerAt(self, pos: int) -> PrintState | None:
+    """Layer whose layer change line starts at pos"""
+    return self._layersByLayerChangeStart.get(pos)
+
+def layerIndexFilename(gcodeFilename: str) -> str:
+  return gcodeFilename + LAYER_INDEX_EXTENSION
+
+def _encodeFeature(feat: Feature) -> list:
+  return [
+    feat.featureType,
+    feat.start,
+    feat.end,
+    feat.originalColor,
+    feat.isContinued,
+    feat.joinIfContinuedPrimeTower,
+    [feat.toolchange.start, feat.toolchange.end, feat.toolchange.printingColor] if feat.toolchange else None,
+    feat.wipeEnd.start if feat.wipeEnd else None
+  ]
+
+def _decodeFeature(values: list) -> Feature:
+  feat = Feature()
+  featureType, feat.start, feat.end, feat.originalColor, feat.isContinued, feat.joinIfContinuedPrimeTower, toolchange, wipeEndStart = values
+  feat.featureType = sys.intern(featureType) if featureType != None else None
+  if toolchange:
+    feat.toolchange = Feature()
+    feat.toolchange.featureType = TOOLCHANGE
+    feat.toolchange.start, feat.toolchange.end, feat.toolchange.printingColor = toolchange
+  if wipeEndStart != None:
+    feat.wipeEnd = Feature()
+    feat.wipeEnd.featureType = WIPE_END
+    feat.wipeEnd.start = wipeEndStart
+  return feat
+
+def saveLayerIndex(layerIndex: LayerIndex, fn: str):
+  """Write the layer index to a compressed sidecar file. A failed write only means the next run scans the file again."""
+  data = {
+    'version': LAYER_INDEX_VERSION,
+    'size': layerIndex.fileSize,
+    'mtime': layerIndex.fileMtime,
+    'hash': layerIndex.fileHash,
+    'layers': [
+      [
+        layerChangeStart,
+        layer.layerStart,
+        layer.layerEnd,
+        layer.height,
+        layer.layerHeight,
+        layer.previousLayerHeight,
+        layer.originalColor,
+        layer.layerEndOriginalColor,
+        layer.featureScanStart,
+        [_encodeFeature(feat) for feat in layer.features],
+        layer.toolCommandStarts
+      ] for layerChangeStart, layer in zip(layerIndex.layerChangeStarts, layerIndex.layers)
+    ]
+  }
+  tempFn = fn + '.tmp'
+  try:
+    with open(tempFn, mode='wb') as f:
+      f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode()))
+    os.replace(tempFn, fn)
+  except OSError as e:
+    log.warning("Failed to save layer index %s: %s", fn, e)
+
+def loadLayerIndex(fn: str, f: GcodeReader) -> LayerIndex | None:
+  """Load the layer index sidecar file for the G-code file. Returns None if there is no index or the index does not match the G-code file."""
+  try:
+    with open(fn, mode='rb') as indexFile:
+      data = json.loads(zlib.decompress(indexFile.read()))
+  except (OSError, ValueError, zlib.error):
+    return None
+
+  if not isinstance(data, dict) or data.get('version') != LAYER_INDEX_VERSION or data.get('size') != f.size:
+    return None
+  layerIndex = LayerIndex(f)
+  # Only hash the G-code file if the modification time changed
+  if data.get('mtime') != f.mtime and data.get('hash') != layerIndex.fileHash:
+    return None
+  layerIndex._fileHash = data.get('hash')
+
+  try:
+    for layerChangeStart, layerStart, layerEnd, height, layerHeight, previousLayerHeight, originalColor, layerEndOriginalColor, featureScanStart, features, toolCommandStarts in data['layers']:
+      layer = PrintState()
+      layer.layerStart = layerStart
+      layer.layerEnd = layerEnd
+      layer.height = height
+      layer.layerHeight = layerHeight
+      layer.previousLayerHeight = previousLayerHeight
+      layer.originalColor = originalColor
+      layer.layerEndOriginalColor = layerEndOriginalColor
+      layer.featureScanStart = featureScanStart
+      layer.features = [_decodeFeature(feat) for feat in features]
+      layer.toolCommandStarts = toolCommandStarts
+      layerIndex.addLayer(layerChangeStart, layer)
+  except (KeyError, TypeError, ValueError):
+    return None
+  return layerIndex
@@ -0,0 +1,151 @@
+import enum
+
+from .printing_classes import *
+from .line_classifier import *
+from .gcode_file import *
+from .toolchange_template import *
+from .process_profile import *
+
+class EditType(enum.Enum):
+  COPY = enum.auto()
+  """Copy a span of original lines"""
+  SKIP = enum.auto()
+  """Span of original lines that is not written"""
+  TEXT = enum.auto()
+  """Write G-code text such as a comment or placeholder"""
+  TOOLCHANGE = enum.auto()
+  """Insert a minimal toolchange or a full toolchange with a relocated prime tower"""
+  RESTORE_POSITION = enum.auto()
+  """Restore the position, acceleration and prime before a feature"""
+  SUBSTITUTE_TOOL = enum.auto()
+  """Write an original tool command line with a different tool index"""
+
+class LayerEdit:
+  """One edit of a layer plan. Only the fields used by the edit type are set."""
+  __slots__ = ('type', 'start', 'end', 'text', 'colorIndex', 'toolchangeType')
+
+  def __init__(self, type: EditType, start: int = -1, end: int = -1, text: str = None, colorIndex: int = -1, toolchangeType: ToolchangeType = None):
+    self.type: EditType = type
+    self.start: int = start
+    """Start of the original span or line. The feature start for RESTORE_POSITION."""
+    self.end: int = end
+    """End of the original span or line"""
+    self.text: str = text
+    """G-code written by TEXT and RESTORE_POSITION"""
+    self.colorIndex: int = colorIndex
+    """Printing tool index of TOOLCHANGE and SUBSTITUTE_TOOL"""
+    self.toolchangeType: ToolchangeType = toolchangeType
+    """MINIMAL or FULL for TOOLCHANGE. The relocated prime tower of a FULL toolchange follows as separate edits."""
+
+  def toDict(self) -> dict:
+    d = {'edit': self.type.name.lower()}
+    if self.start != -1:
+      d['start'] = self.start
+    if self.end != -1:
+      d['end'] = self.end
+    if self.toolchangeType:
+      d['toolchange'] = self.toolchangeType.name.lower()
+    if self.colorIndex != -1:
+      d['color_index'] = self.colorIndex
+    if self.text != None:
+      d['text'] = self.text
+    return d
+
+class LayerPlan:
+  """Edits that write a layer in order. Planned from the features of the layer before any output is written so the plan can be checked or written by executeLayerPlan()."""
+  keepsEdits = True
+  """Edits are kept. The planner can skip work that only finds edits if they are not kept."""
+
+  def __init__(self, height: float, start: int):
+    self.height: float = height
+    """Printing height of the layer. -1 for the header before the first layer."""
+    self.start: int = start
+    """Position the layer was planned from"""
+    self.end: int = start
+    """Position the input is left at after the layer. The next layer change or the end of the file."""
+    self.reachedNextLayer: bool = False
+    """The layer ended at the next layer change instead of the end of the file"""
+    self.edits: list[LayerEdit] = []
+
+  def _span(self, type: EditType, start: int, end: int):
+    if end <= start:
+      return
+    # Spans that continue the last span are joined
+    if self.edits and self.edits[-1].type == type and self.edits[-1].end == start:
+      self.edits[-1].end = end
+    else:
+      self.edits.append(LayerEdit(type, start, end))
+
+  def copy(self, start: int, end: int):
+    self._span(EditType.COPY, start, end)
+
+  def skip(self, start: int, end: int):
+    self._span(EditType.SKIP, start, end)
+
+  def text(self, s: str):
+    if self.edits and self.edits[-1].type == EditType.TEXT:
+      self.edits[-1].text += s
+    else:
+      self.edits.append(LayerEdit(EditType.TEXT, text=s))
+
+  def toolchange(self, toolchangeType: ToolchangeType, colorIndex: int, primeTower: Feature = None):
+    self.edits.append(LayerEdit(EditType.TOOLCHANGE, primeTower.start if primeTower else -1, primeTower.end if primeTower else -1, colorIndex=colorIndex, toolchangeType=toolchangeType))
+
+  def restorePosition(self, featureStart: int, s: str):
+    self.edits.append(LayerEdit(EditType.RESTORE_POSITION, featureStart, text=s))
+
+  def substituteTool(self, start: int, end: int, colorIndex: int):
+    self.edits.append(LayerEdit(EditType.SUBSTITUTE_TOOL, start, end, colorIndex=colorIndex))
+
+  def toDict(self) -> dict:
+    return {
+      'height': self.height,
+      'start': self.start,
+      'end': self.end,
+      'reached_next_layer': self.reachedNextLayer,
+      'edits': [edit.toDict() for edit in self.edits]
+    }
+
+class StateOnlyLayerPlan(LayerPlan):
+  """Layer plan that keeps no edits. Planning a layer into it only finds the print state at the end of the layer."""
+  keepsEdits = False
+
+  def _span(self, type: EditType, start: int, end: int):
+    pass
+
+  def text(self, s: str):
+    pass
+
+  def toolchange(self, toolchangeType: ToolchangeType, colorIndex: int, primeTower: Feature = None):
+    pass
+
+  def restorePosition(self, featureStart: int, s: str):
+    pass
+
+  def substituteTool(self, start: int, end: int, colorIndex: int):
+    pass
+
+def substituteNewColor(cl, newColorIndex: int):
+  cl = M620_RE.sub(f"M620 S{newColorIndex}A", cl)
+  cl = TOOLCHANGE_T_RE.sub(f"T{newColorIndex}", cl)
+  cl = M621_RE.sub(f"M621 S{newColorIndex}A", cl)
+  return cl
+
+def executeLayerPlan(f: GcodeReader, out: GcodeWriter, plan: LayerPlan, toolchangeTemplate: ToolchangeTemplate, profile: ProcessProfile):
+  """Write the edits of a layer plan and leave the input at the end of the layer"""
+  for edit in plan.edits:
+    if edit.type == EditType.COPY:
+      out.copyLines(f, edit.start, edit.end)
+    elif edit.type == EditType.SUBSTITUTE_TOOL:
+      out.write(substituteNewColor(f.lineAt(edit.start), edit.colorIndex))
+    elif edit.type == EditType.TEXT or edit.type == EditType.RESTORE_POSITION:
+      out.write(edit.text)
+    elif edit.type == EditType.TOOLCHANGE:
+      if edit.toolchangeType == ToolchangeType.FULL:
+        profile.count(COUNT_TOOLCHANGES_FULL)
+        profile.count(COUNT_PRIME_TOWERS_RELOCATED)
+      else:
+        profile.count(COUNT_TOOLCHANGES_MINIMAL)
+        with profile.phase(PHASE_TOOLCHANGE_INSERTION):
+          out.writeBytes(toolchangeTemplate.render(edit.colorIndex))
+  f.seek(plan.end)
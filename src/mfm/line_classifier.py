@@ -0,0 +1,99 @@
+import enum, re
+
+from .printing_constants import *
+
+class LineKind(enum.Enum):
+  """Token kind of a single G-code line"""
+  OTHER = enum.auto()
+  """Any line that is not interesting to the post processor"""
+  COMMENT = enum.auto()
+  """Comment line without a known tag"""
+  MOVE = enum.auto()
+  """G0/G1/G2/G3 movement"""
+  ACCELERATION = enum.auto()
+  """M204 acceleration"""
+  LAYER_CHANGE = enum.auto()
+  """Slicer layer change tag"""
+  LAYER_CHANGE_END = enum.auto()
+  """MFM layer change end tag"""
+  FEATURE = enum.auto()
+  """Slicer feature/line type tag"""
+  TOOLCHANGE_START = enum.auto()
+  """MFM toolchange start tag"""
+  TOOLCHANGE_END = enum.auto()
+  """MFM toolchange end tag"""
+  TOOL = enum.auto()
+  """T tool select command"""
+  M620 = enum.auto()
+  """Bambu M620 AMS toolchange start command"""
+  M621 = enum.auto()
+  """Bambu M621 AMS toolchange end command"""
+  WIPE_END = enum.auto()
+  """Slicer wipe end tag"""
+  FILAMENT_END = enum.auto()
+  """Slicer filament end gcode tag"""
+  LINE_WIDTH = enum.auto()
+  """Slicer line width tag"""
+
+# Precompiled patterns for lines that need values extracted
+MOVEMENT_G_RE = re.compile(MOVEMENT_G)
+ACCELERATION_M_RE = re.compile(ACCELERATION_M)
+LAYER_CHANGE_RE = re.compile(LAYER_CHANGE)
+LAYER_Z_HEIGHT_RE = re.compile(LAYER_Z_HEIGHT)
+LAYER_HEIGHT_RE = re.compile(LAYER_HEIGHT)
+FEATURE_TYPE_RE = re.compile(FEATURE_TYPE)
+M204_RE = re.compile(M204)
+FILAMENT_END_GCODE_RE = re.compile(FILAMENT_END_GCODE)
+LINE_WIDTH_RE = re.compile(LINE_WIDTH)
+M620_RE = re.compile(M620)
+TOOLCHANGE_T_RE = re.compile(TOOLCHANGE_T)
+M621_RE = re.compile(M621)
+
+# Comment tags are combined into a single alternation so a comment line is matched once. The named group that matched identifies the kind.
+_COMMENT_TAGS: list[tuple[LineKind, str]] = [
+  (LineKind.LAYER_CHANGE, LAYER_CHANGE),
+  (LineKind.LAYER_CHANGE_END, UNIVERSAL_LAYER_CHANGE_END),
+  (LineKind.FEATURE, FEATURE_TYPE),
+  (LineKind.TOOLCHANGE_START, UNIVERSAL_TOOLCHANGE_START),
+  (LineKind.TOOLCHANGE_END, UNIVERSAL_TOOLCHANGE_END),
+  (LineKind.WIPE_END, WIPE_END),
+  (LineKind.FILAMENT_END, FILAMENT_END_GCODE),
+  (LineKind.LINE_WIDTH, LINE_WIDTH)
+]
+_COMMENT_TAGS_RE = re.compile('|'.join(f"(?P<{kind.name}>{pattern.lstrip('^')})" for kind, pattern in _COMMENT_TAGS))
+
+TOOL_COMMAND_KINDS = (LineKind.TOOL, LineKind.M620, LineKind.M621)
+"""Kinds of lines that have a tool index to substitute"""
+
+# Finds the lines in a span of raw file bytes that could be tool commands (M620, T, M621). Each candidate line still needs classifyLine() to confirm it.
+TOOL_COMMAND_LINE_RE = re.compile(rb'^(?:M62[01] |[^\S\n]*T)', re.MULTILINE)
+
+# Finds the lines in raw file bytes that could be layer changes. Each candidate line still needs the layer scan to confirm it.
+LAYER_CHANGE_LINE_RE = re.compile(LAYER_CHANGE.encode(), re.MULTILINE)
+
+_MOVE_PREFIXES = ('G0 ', 'G1 ', 'G2 ', 'G3 ')
+
+def classifyLine(cl: str) -> LineKind:
+  """Tag a line with a single LineKind. The first character decides which (if any) pattern is tried so plain movement lines never run a regex."""
+  c = cl[:1]
+  if c == 'G':
+    if cl.startswith(_MOVE_PREFIXES):
+      return LineKind.MOVE
+    return LineKind.OTHER
+  if c == ';':
+    m = _COMMENT_TAGS_RE.match(cl)
+    if m:
+      return LineKind[m.lastgroup]
+    return LineKind.COMMENT
+  if c == 'M':
+    if cl.startswith('M204'):
+      return LineKind.ACCELERATION
+    if cl.startswith('M620 '):
+      return LineKind.M620 if M620_RE.match(cl) else LineKind.OTHER
+    if cl.startswith('M621 '):
+      return LineKind.M621 if M621_RE.match(cl) else LineKind.OTHER
+    return LineKind.OTHER
+  if c == 'T' or c.isspace():
+    if TOOLCHANGE_T_RE.match(cl):
+      return LineKind.TOOL
+  return LineKind.OTHER
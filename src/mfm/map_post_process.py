@@ -1,225 +1,162 @@
-import re, os, typing, queue, time, datetime, math, enum, copy
+import re, os, sys, io, bisect, typing, queue, time, datetime, math, enum, copy, multiprocessing, multiprocessing.pool, contextlib, logging
 
 from .app_constants import *
 from .printing_constants import *
 from .printing_classes import *
 from .line_ending import *
 from .configuration import *
-
-def shouldLayerBePeriodicLine(printState: PrintState, periodicLine: PeriodicColor):
-  if printState.height >= periodicLine.startHeight and printState.height <= periodicLine.endHeight:
-    # current layer top is inside an isoline
-    if (printState.height - periodicLine.startHeight) % periodicLine.period <= periodicLine.height:
-      #start isoline
-      #print(f"({printState.height} - {periodicLine.startHeight}) % {periodicLine.period} so start isoline")
-      return True
-    #current layer envelopes an isoline
-    #is thicker than 1 isoline AND bottom is in isoline OR top is above next isoline (top of next isoline)
-    elif printState.layerHeight > periodicLine.height:
-      #If previous layer was periodic line and previous layer height was greater than periodic line height then this layer should not a periodic color even if periodic layer range is sandwiched between current layer and previous layer boundary. Previous layer being periodic color and greather than periodic line height already exceeded total periodic line height so we don't need a double thick periodic line.
-      if printState.printingPeriodicColor == True and printState.previousLayerHeight > periodicLine.height:
-        return False
-
-      if ((printState.height - periodicLine.startHeight) - printState.layerHeight) % periodicLine.period < periodicLine.height:
-        #print(f"{printState.layerHeight} > {periodicLine.height} and (({printState.height} - {periodicLine.startHeight}) - {printState.layerHeight}) % {periodicLine.period} < {periodicLine.height} so start isoline")
-        #start isoline
-        return True
-      elif printState.height - periodicLine.startHeight > math.ceil(((printState.height - periodicLine.startHeight) - printState.layerHeight) / periodicLine.period) * periodicLine.period + periodicLine.height:
-      #start isoline
-        return True
-  return False
-
-def updateReplacementColors(printState: PrintState, rcs: list[ReplacementColorAtHeight]):
-  for rc in rcs:
-    if printState.height > rc.startHeight and printState.height - printState.layerHeight < rc.endHeight:
-      loadedColors[rc.originalColorIndex].replacementColorIndex = rc.colorIndex
-    elif loadedColors[rc.originalColorIndex].replacementColorIndex == rc.colorIndex:
-      loadedColors[rc.originalColorIndex].replacementColorIndex = -1
-
-def findChangeLayer(f: typing.TextIO, lastPrintState: PrintState, gf: str, pcs: list[PeriodicColor], rcs: list[ReplacementColorAtHeight], le: str):
+from .line_classifier import *
+from .gcode_file import *
+from .gcode_package import *
+from .layer_index import *
+from .toolchange_template import *
+from .process_profile import *
+from .color_schedule import *
+from .position_resolver import *
+from .layer_plan import *
+from .progress import *
+
+# Per layer and per feature trace. Only logged at the DEBUG log level.
+log = logging.getLogger(__name__)
+
+def findChangeLayer(f: GcodeReader, lastPrintState: PrintState, gf: str):
   cl = f.readline()
   # Look for start of layer
-  changeLayerMatch = re.match(LAYER_CHANGE, cl)
-  if changeLayerMatch:
-    # Create new print state for the new found layer and carry over some state that should be preserved between layers.
+  if classifyLine(cl) == LineKind.LAYER_CHANGE:
+    # Create new print state for the new found layer and carry over the original G-code state that should be preserved between layers. State that depends on the options is set in newLayerPrintState().
     printState = PrintState()
     printState.previousLayerHeight = lastPrintState.layerHeight
     printState.originalColor = lastPrintState.layerEndOriginalColor if lastPrintState.layerEndOriginalColor > -1 else lastPrintState.originalColor
-    printState.printingColor = lastPrintState.printingColor
-    printState.printingPeriodicColor = lastPrintState.printingPeriodicColor
     printState.layerStart = f.tell()
-
-    printState.prevLayerLastFeature = lastPrintState.lastFeature
-    printState.featureWipeEndPrime = lastPrintState.featureWipeEndPrime
+    printState.toolCommandStarts = []
 
     # Find Z_HEIGHT value
     cl = f.readline()
-    zHeightMatch = re.match(LAYER_Z_HEIGHT, cl)
+    if classifyLine(cl) in TOOL_COMMAND_KINDS:
+      printState.toolCommandStarts.append(f.lineStart)
+    zHeightMatch = LAYER_Z_HEIGHT_RE.match(cl)
     if zHeightMatch:
-      if zHeightMatch:
-        printState.height = float(zHeightMatch.groups()[0])
-        #print(f"{Z_HEIGHT} {cl.groups()[0]}")
-      print(f"\nProcessing height {printState.height}")
+      printState.height = float(zHeightMatch.groups()[0])
+      log.debug("Analyzing height %s", printState.height)
 
     # Find LAYER_HEIGHT value
     cl = f.readline()
-    layerHeightMatch = re.match(LAYER_HEIGHT, cl)
+    if classifyLine(cl) in TOOL_COMMAND_KINDS:
+      printState.toolCommandStarts.append(f.lineStart)
+    layerHeightMatch = LAYER_HEIGHT_RE.match(cl)
     if layerHeightMatch:
-      if layerHeightMatch:
-        printState.layerHeight = float(layerHeightMatch.groups()[0])
-
-    #update loaded colors replacement color data based on current height
-    updateReplacementColors(printState, rcs)
-    print(f"pos {f.tell()} before call findLayerFeatures")
+      printState.layerHeight = float(layerHeightMatch.groups()[0])
 
-    # determine periodic line status
-    printState.isPeriodicLine = shouldLayerBePeriodicLine(printState, pcs[0]) if len(pcs) > 0 else False
-    print(f"Is printing periodic color {printState.printingPeriodicColor}")
-    print(f"Is periodic line {printState.isPeriodicLine}")
+    log.debug("pos %d before call findLayerFeatures", f.tell())
     
     return printState
   return None
 
-def findLayerFeatures(f: typing.TextIO, gf: str, printState: PrintState, pcs: list[PeriodicColor], le: str):
+# Find all features of the layer in original file order. Features are not split or marked for periodic colors here so the result does not depend on the options.
+def findLayerFeatures(f: GcodeReader, gf: str, printState: PrintState):
   if gf == MARLIN_2_BAMBU_PRUSA_MARKED_GCODE:
     cl = True
     curFeature = None
-    curStartPosition = printState.originalPosition #last position before entering feature
+    printState.featureScanStart = f.tell() # feature start positions are found from the lines after this when they are needed
     curOriginalColor = printState.originalColor # original color at start of layer
 
     def addFeatureToList(ps: PrintState, cf: Feature):
-      if cf.featureType == PRIME_TOWER and cf.toolchange: # only add prime tower to available prime tower list if it has a toolchange
-        if ps.isPeriodicLine:
-          ps.primeTowerFeatures.append(cf)
-        else:
-          ps.features.append(cf)
-      else:
-        ps.features.append(cf)
+      ps.features.append(cf)
 
-    # Enable after lookahead if a feature spans a layer change
+    # Set once the first marker after UNIVERSAL LAYER CHANGE END shows a feature spans the layer change
     useFirstSpecialGcodeAsFeature = None
+    # UNIVERSAL LAYER CHANGE END was found before any feature so the next marker decides how the first feature starts
+    findingFirstFeatureMarker = False
 
     while cl:
       cl = f.readline()
-      # next layer marker
-      changeLayerMatch = re.match(LAYER_CHANGE, cl)
-
-      # end of layer_change
-      layerChangeEndMatch = re.match(UNIVERSAL_LAYER_CHANGE_END, cl)
-
-      # start marker for non prime tower features
-      featureTypeMatch = re.match(FEATURE_TYPE, cl)
+      # Tag the line once and dispatch on the kind instead of trying every marker pattern
+      kind = classifyLine(cl)
+
+      # Remember where tool commands are so unmodified layers only rewrite these lines
+      if kind in TOOL_COMMAND_KINDS:
+        printState.toolCommandStarts.append(f.lineStart)
+
+      # The first marker is found as the lines are read. A new feature is the first thing on this layer if FEATURE comes first. Otherwise the previous feature is continued and starts at the first special G-code found.
+      if findingFirstFeatureMarker:
+        if kind == LineKind.FEATURE:
+          findingFirstFeatureMarker = False
+          log.debug('found feature at start of layer at %d', f.lineStart)
+        elif kind == LineKind.ACCELERATION and M204_RE.match(cl): #secondary check for M204 S to look for continued feature
+          findingFirstFeatureMarker = False
+          log.debug('found M204 S at start of layer at %d', f.lineStart)
+          # If no FEATURE found right after M204, treat M204 as the first feature
+          if classifyLine(f.peekline()) != LineKind.FEATURE:
+            useFirstSpecialGcodeAsFeature = M204_RE
+        elif kind == LineKind.FILAMENT_END:
+          findingFirstFeatureMarker = False
+          log.debug('found FILAMENT_END_GCODE at start of layer at %d', f.lineStart)
+          useFirstSpecialGcodeAsFeature = FILAMENT_END_GCODE_RE
+        elif kind == LineKind.LINE_WIDTH:
+          findingFirstFeatureMarker = False
+          log.debug('found LINE_WIDTH at start of layer at %d', f.lineStart)
+          useFirstSpecialGcodeAsFeature = LINE_WIDTH_RE
+        elif kind == LineKind.LAYER_CHANGE or not cl:
+          #No feature found before next layer!
+          log.debug('Found no feature or M204 tag at start of layer at %d', printState.featureScanStart)
+          # The layer end is not known so the next layer is looked for from the layer start
+          printState.toolCommandStarts = None
+          return
 
       # FILAMENT_END_GCODE signals TC after layer_change or M204 S signals start of printing moves after layer_change. FILAMENT_END_GCODE comes before the early toolchange start. M204 S may come on line before FEATURE if FEATURE exists at start
       specialGcodeMatch = None
       if useFirstSpecialGcodeAsFeature:
-        specialGcodeMatch = re.match(useFirstSpecialGcodeAsFeature, cl)
-
-      # toolchange start/end and index
-      univeralToolchangeStartMatch = re.match(UNIVERSAL_TOOLCHANGE_START, cl)
-      toolchangeMatch = re.match(TOOLCHANGE_T, cl)
-      univeralToolchangeEndMatch = re.match(UNIVERSAL_TOOLCHANGE_END, cl)
-
-      # wipe_end marker for normal printing features to skip
-      wipeEndMatch = re.match(WIPE_END, cl)
-
-      #Debug
-      if f.tell() == 155194:
-        0==0
+        specialGcodeMatch = useFirstSpecialGcodeAsFeature.match(cl)
 
       # end if we find next layer marker
-      if changeLayerMatch:
-        printState.layerEnd = f.tell() - len(cl) - (len(le)-1)
+      if kind == LineKind.LAYER_CHANGE:
+        printState.layerEnd = f.lineStart
         #print('got new layer at ',f.tell())
-        curFeature.end = f.tell() - len(cl) - (len(le)-1)
+        curFeature.end = f.lineStart
         addFeatureToList(printState, curFeature)
         curFeature = None
         printState.layerEndOriginalColor = curOriginalColor
         break
       
-      checkAndUpdatePosition(cl=cl, pp=curStartPosition)
-
-      # If UNIVERSAL LAYER CHANGE END found first, look ahead to see if a new feature is the first thing on this layer or previous feature is continued.
-      if len(printState.features) == 0 and layerChangeEndMatch:
-        cp = f.tell()
-        lookaheadLines = 200
-        foundFeatureInLookahead = False
-        i = 0
-        fl = True
-        while fl:
-          fl = f.readline()
-          i += 1
-          if re.match(FEATURE_TYPE, fl):
-            foundFeatureInLookahead = True
-            print(f'found feature during lookahead line distance {i} {f.tell()}')
-            break
-          if re.match(M204, fl): #secondary check for M204 S to look for continued feature
-            print(f'found M204 S during lookahead line distance {i} {f.tell()}')
-            fl = f.readline()
-            # If no FEATURE found right after M204, treat M204 as the first feature
-            if re.match(FEATURE_TYPE, fl):
-              foundFeatureInLookahead = True
-              print(f'found feature after M204 S during lookahead line distance {i} {f.tell()}')
-              break
-            else:
-              useFirstSpecialGcodeAsFeature = M204
-            break
-          if re.match(FILAMENT_END_GCODE, fl):
-            print(f'found FILAMENT_END_GCODE during lookahead line distance {i} {f.tell()}')
-            useFirstSpecialGcodeAsFeature = FILAMENT_END_GCODE
-            break
-          if re.match(LINE_WIDTH, fl):
-            print(f'found LINE_WIDTH during lookahead line distance {i} {f.tell()}')
-            useFirstSpecialGcodeAsFeature = LINE_WIDTH
-            break
-          if re.match(LAYER_CHANGE, fl):
-            #No feature found before next layer!
-            break
-        f.seek(cp, os.SEEK_SET)
-        if foundFeatureInLookahead or useFirstSpecialGcodeAsFeature:
-          # a new feature is found soon so continue looking for features like normal
-          # a line width tag was found so look for line width tag as if it is a feature tag
-          continue
-        else:
-          print(f'Found no feature or M204 tag in lookahead of {lookaheadLines} at start of layer at {f.tell()}')
-          break
+      # If UNIVERSAL LAYER CHANGE END found first, look at the next markers to see if a new feature is the first thing on this layer or previous feature is continued.
+      if len(printState.features) == 0 and kind == LineKind.LAYER_CHANGE_END:
+        findingFirstFeatureMarker = True
+        continue
 
       # Look for FEATURE to find feature type
+      featureTypeMatch = FEATURE_TYPE_RE.match(cl) if kind == LineKind.FEATURE else None
       if featureTypeMatch or (len(printState.features) == 0 and useFirstSpecialGcodeAsFeature and specialGcodeMatch):
-        print(f"found FEATURE match {featureTypeMatch.groups()[0] if featureTypeMatch else 'None'} at {f.tell() - len(cl) - (len(le)-1)}")
+        log.debug("found FEATURE match %s at %d", featureTypeMatch.groups()[0] if featureTypeMatch else None, f.lineStart)
 
         # Don't end prime tower if we found prime tower feature for Bambu
         if curFeature and curFeature.featureType == PRIME_TOWER and featureTypeMatch and (featureTypeMatch.groups()[0] == PRIME_TOWER or featureTypeMatch.groups()[0] == WIPE_TOWER):
           continue
 
+        # The continued feature type is only known once the previous layer is printed. Split here and join the prime tower back in newLayerPrintState() if the continued feature turns out to be a prime tower.
+        joinIfContinuedPrimeTower = curFeature != None and curFeature.isContinued and featureTypeMatch != None and (featureTypeMatch.groups()[0] == PRIME_TOWER or featureTypeMatch.groups()[0] == WIPE_TOWER)
+
         if curFeature:
-          curFeature.end = f.tell() - len(cl) - (len(le)-1)
+          curFeature.end = f.lineStart
           addFeatureToList(printState, curFeature)
           curFeature = None
 
         # Create new feature 
         if curFeature == None:
           curFeature = Feature()
-          curFeature.start = f.tell() - len(cl) - (len(le)-1)
-          curFeature.startPosition = copy.copy(curStartPosition) # save last position state as start position for this feature
+          curFeature.start = f.lineStart
           curFeature.originalColor = curOriginalColor # save current original color as color for this feature
+          curFeature.joinIfContinuedPrimeTower = joinIfContinuedPrimeTower
         if featureTypeMatch:
-          curFeature.featureType = featureTypeMatch.groups()[0]
+          # Features of the same type share one string
+          curFeature.featureType = sys.intern(featureTypeMatch.groups()[0])
           if featureTypeMatch.groups()[0] == WIPE_TOWER: #Rename wipe tower to prime tower
             curFeature.featureType = PRIME_TOWER
         # If not a feature Type Match, try to see if line width matches
+        # The feature type is set to the previous layer last feature type when the layer is printed
         elif specialGcodeMatch:
           useFirstSpecialGcodeAsFeature = False
-          if printState.prevLayerLastFeature:
-            curFeature.featureType = printState.prevLayerLastFeature.featureType
-            printState.prevLayerLastFeature = None # clear reference to prev layer last feature
-          else:
-            curFeature.featureType = UNKNOWN_CONTINUED
-
-        # mark feature as periodic color if needed
-        if printState.isPeriodicLine and (curFeature.featureType in pcs[0].enabledFeatures or len(pcs[0].enabledFeatures) == 0):
-          curFeature.isPeriodicColor = True
-          curFeature.printingColor = pcs[0].colorIndex
+          curFeature.featureType = UNKNOWN_CONTINUED
+          curFeature.isContinued = True
 
         #print(f"feature is of type {curFeature.featureType}")
         continue
@@ -229,16 +166,16 @@ def findLayerFeatures(f: typing.TextIO, gf: str, printState: PrintState, pcs: li
         continue
 
       # A toolchange is found UNIVERSAL_TOOLCHANGE_START
-      elif univeralToolchangeStartMatch: 
+      elif kind == LineKind.TOOLCHANGE_START:
         curFeature.toolchange = Feature()
         curFeature.toolchange.featureType = TOOLCHANGE                                                 
-        curFeature.toolchange.start = f.tell() - len(cl) - (len(le)-1)
-        print(f"found toolchange start at {curFeature.toolchange.start}")
+        curFeature.toolchange.start = f.lineStart
+        log.debug("found toolchange start at %d", curFeature.toolchange.start)
         continue
 
       # Look for TXX if we already found the toolchange start
-      elif toolchangeMatch:
-        nextTool = int(toolchangeMatch.groups()[0])
+      elif kind == LineKind.TOOL:
+        nextTool = int(TOOLCHANGE_T_RE.match(cl).groups()[0])
         curOriginalColor = nextTool
         #print(f'toolchangeMatch at {f.tell()}')
         curFeature.toolchange.printingColor = nextTool
@@ -246,32 +183,158 @@ def findLayerFeatures(f: typing.TextIO, gf: str, printState: PrintState, pcs: li
         continue
 
       # Look for UNIVERSAL_TOOLCHANGE_END if we already found the toolchange start
-      elif univeralToolchangeEndMatch:
+      elif kind == LineKind.TOOLCHANGE_END:
         if curFeature.toolchange == None:
-          print(f"toolchange end found before toolchange start at {f.tell()} set .end to {f.tell() - len(cl) - (len(le)-1)}")
-          1==0 # assert crash
+          log.debug("toolchange end found before toolchange start at %d set .end to %d", f.tell(), f.lineStart)
           break
-        curFeature.toolchange.end = f.tell() - len(cl) - (len(le)-1)
+        curFeature.toolchange.end = f.lineStart
         #print(f"found toolchange end at {curFeature.toolchange.end}")
         continue
 
       # Look for wipe_end on normal features. Overwrite previous found wipe end with last wipe end
-      if wipeEndMatch:
+      if kind == LineKind.WIPE_END:
           curFeature.wipeEnd = Feature()
           curFeature.wipeEnd.featureType = WIPE_END
-          curFeature.wipeEnd.start = f.tell() - len(cl) - (len(le)-1)
+          curFeature.wipeEnd.start = f.lineStart
 
     #if reach end of file
     if not cl and curFeature:
-      print(f"reached end of file at {f.tell()}")
+      log.debug("reached end of file at %d", f.tell())
       curFeature.end = f.tell()
       addFeatureToList(printState, curFeature)
 
-def reorderFeatures(ps: PrintState):
-  #Debug breakpoint before layer feature cataloging
-  if ps.height == 12.0:
-    0==0
+# Scan the whole file once and find every layer and its features.
+def buildLayerIndex(f: GcodeReader, gf: str, statusQueue: ProgressReporter, profile: ProcessProfile) -> LayerIndex:
+  with profile.phase(PHASE_LAYER_DISCOVERY):
+    return _buildLayerIndex(f, gf, statusQueue, profile)
+
+def _buildLayerIndex(f: GcodeReader, gf: str, statusQueue: ProgressReporter, profile: ProcessProfile) -> LayerIndex:
+  layerIndex = LayerIndex(f)
+  for layerChangeStart, layer in scanLayers(f, gf, statusQueue, profile):
+    layerIndex.addLayer(layerChangeStart, layer)
+  return layerIndex
+
+# Find each layer and its features in file order. The position of the reader is restored after each layer is returned so the caller can read other parts of the file in between. A scan can start at the layer change line of a layer found by a scan from the start of the file with the state at the end of the layer before it. The scan stops before the first layer at or after end and returns where that layer starts.
+def scanLayers(f: GcodeReader, gf: str, statusQueue: ProgressReporter, profile: ProcessProfile, start: int = 0, end: int = None, lastPrintState: PrintState = None) -> typing.Generator[tuple[int, PrintState], None, int | None]:
+  # State before the first layer
+  if lastPrintState == None:
+    lastPrintState = PrintState()
+  foundLayer = start > 0
+
+  f.seek(start, os.SEEK_SET)
+  # A scan from a layer change line checks that line for a layer change first
+  cl = f.readline() if start == 0 else True
+  while cl:
+    # Toolchanges before the first layer set the original color of the first layer
+    if not foundLayer and classifyLine(cl) == LineKind.TOOL:
+      lastPrintState.originalColor = int(TOOLCHANGE_T_RE.match(cl).groups()[0])
+
+    # The line right after the current line is checked for a layer change the same way the process loop looks for a new layer
+    cp = f.tell()
+    # end is a layer change line so it is not read again
+    if end != None and cp >= end:
+      return cp
+    printState = findChangeLayer(f, lastPrintState=lastPrintState, gf=gf)
+    if printState:
+      if statusQueue:
+        # The size of a stream is not known until it is read
+        if isinstance(f, GcodeStreamReader):
+          item = StatusQueueItem()
+          item.statusLeft = f"Current Layer {printState.height}"
+          item.statusRight = f"Analyzing"
+          statusQueue.put(item=item)
+        else:
+          statusQueue.progress(cp, f.size, f"Current Layer {printState.height}", "Analyzing")
 
+      with profile.phase(PHASE_FEATURE_SCAN):
+        findLayerFeatures(f=f, gf=gf, printState=printState)
+      yield cp, printState
+      lastPrintState = printState
+      foundLayer = True
+
+      # The next layer is looked for at the layer end if it was found. Otherwise it is looked for on each line after the layer change.
+      f.seek(printState.layerEnd if printState.layerEnd > 0 else printState.layerStart, os.SEEK_SET)
+      continue
+
+    f.seek(cp, os.SEEK_SET)
+    cl = f.readline()
+  return None
+
+# Create the print state for printing a layer found by buildLayerIndex(). State carried over from printing the last layer and the options decide which features are periodic color and which prime towers are available for relocation.
+def newLayerPrintState(layer: PrintState, layerNum: int, lastPrintState: PrintState, colorSchedule: ColorSchedule) -> PrintState:
+  printState = PrintState()
+  printState.height = layer.height
+  printState.layerHeight = layer.layerHeight
+  printState.previousLayerHeight = layer.previousLayerHeight
+  printState.layerStart = layer.layerStart
+  printState.layerEnd = layer.layerEnd
+  printState.originalColor = layer.originalColor
+  printState.layerEndOriginalColor = layer.layerEndOriginalColor
+  printState.featurePositions = LayerPositions(layer.featureScanStart, [feat.start for feat in layer.features])
+  printState.toolCommandStarts = layer.toolCommandStarts
+
+  printState.printingColor = lastPrintState.printingColor
+  printState.printingPeriodicColor = lastPrintState.printingPeriodicColor
+  printState.prevLayerLastFeature = lastPrintState.lastFeature
+  printState.featureWipeEndPrime = lastPrintState.featureWipeEndPrime
+
+  log.debug("Processing height %s", printState.height)
+
+  # replacement colors based on current height
+  printState.toolRemap = colorSchedule.toolRemap(layerNum)
+
+  # determine periodic line status
+  printState.periodicColor = colorSchedule.periodicColor(layerNum, printState.printingPeriodicColor)
+  printState.isPeriodicLine = printState.periodicColor != None
+  log.debug("Is printing periodic color %s", printState.printingPeriodicColor)
+  log.debug("Is periodic line %s", printState.isPeriodicLine)
+
+  def addFeatureToList(ps: PrintState, cf: Feature):
+    if cf.featureType == PRIME_TOWER and cf.toolchange: # only add prime tower to available prime tower list if it has a toolchange
+      if ps.isPeriodicLine:
+        ps.primeTowerFeatures.append(cf)
+      else:
+        ps.features.append(cf)
+    else:
+      ps.features.append(cf)
+
+  curFeature = None
+  for layerFeature in layer.features:
+    # Join a prime tower that was split from a continued prime tower
+    if curFeature and curFeature.featureType == PRIME_TOWER and layerFeature.joinIfContinuedPrimeTower:
+      curFeature.end = layerFeature.end
+      if layerFeature.toolchange:
+        curFeature.toolchange = layerFeature.toolchange
+      if layerFeature.wipeEnd:
+        curFeature.wipeEnd = layerFeature.wipeEnd
+      continue
+
+    if curFeature:
+      addFeatureToList(printState, curFeature)
+
+    curFeature = copy.copy(layerFeature)
+    if curFeature.isContinued:
+      if printState.prevLayerLastFeature:
+        curFeature.featureType = printState.prevLayerLastFeature.featureType
+        printState.prevLayerLastFeature = None # clear reference to prev layer last feature
+      else:
+        curFeature.featureType = UNKNOWN_CONTINUED
+
+    # mark feature as periodic color if needed
+    if printState.isPeriodicLine and (curFeature.featureType in printState.periodicColor.enabledFeatures or len(printState.periodicColor.enabledFeatures) == 0):
+      curFeature.isPeriodicColor = True
+      curFeature.printingColor = printState.periodicColor.colorIndex
+
+  if curFeature:
+    addFeatureToList(printState, curFeature)
+
+  # Save reference to last original feature in case it originally continues to next layer
+  if len(printState.features) > 0:
+    printState.lastFeature = printState.features[len(printState.features)-1]
+
+  return printState
+
+def reorderFeatures(ps: PrintState):
   #rearrange features
   if ps.isPeriodicLine:
     insertIdx = 0
@@ -288,490 +351,933 @@ def reorderFeatures(ps: PrintState):
   for feat in ps.primeTowerFeatures:
     ps.stopPositions.append(feat.start)
   ps.stopPositions.append(ps.layerEnd) #add layer end as a stop position
+  ps.nextFeatureColors = nextFeaturePrintingColors(ps.features)
+
+  if log.isEnabledFor(logging.DEBUG):
+    log.debug("%d printing features and %d reusable prime towers found", len(ps.features), len(ps.primeTowerFeatures))
+
+    #print rearranged features
+    log.debug("%d printing features found", len(ps.features))
+    fi = 0
+    for feat in ps.features:
+      log.debug("%d %s start: %d end: %d originalcolor: %d isPeriodicColor:%s printingColor:%d", fi, feat.featureType, feat.start, feat.end, feat.originalColor, feat.isPeriodicColor, feat.printingColor)
+      if feat.toolchange:
+        log.debug("toolchange.start: %d end: %d printingColor:%d", feat.toolchange.start, feat.toolchange.end, feat.toolchange.printingColor)
+      if feat.wipeEnd:
+        log.debug("wipeEnd.start: %d", feat.wipeEnd.start)
+      fi += 1
+
+    #print prime tower features (only filled when periodic layer)
+    log.debug("%d prime tower features found", len(ps.primeTowerFeatures))
+    for feat in ps.primeTowerFeatures:
+      log.debug("%s start: %d end: %d originalcolor: %d isPeriodicColor:%s printingColor:%d", feat.featureType, feat.start, feat.end, feat.originalColor, feat.isPeriodicColor, feat.printingColor)
+      if feat.toolchange:
+        log.debug("toolchange.start: %d end: %d printingColor:%d", feat.toolchange.start, feat.toolchange.end, feat.toolchange.printingColor)
+      if feat.wipeEnd:
+        log.debug("wipeEnd.start: %d", feat.wipeEnd.start)
+
+def featurePrintingColor(feat: Feature) -> int:
+  """Target printing color of a feature. The periodic color if the feature is periodic color or its original color."""
+  return feat.printingColor if feat.printingColor > -1 else feat.originalColor
+
+# Target printing color of the next printing feature for every suffix of the layer features. Prime towers are passed over. Features are only taken from the front of the list while the layer is printed so one scan from the back finds the color for every remaining list.
+def nextFeaturePrintingColors(features: list[Feature]) -> list[int]:
+  colors = [-1]
+  for feat in reversed(features):
+    colors.append(colors[-1] if feat.featureType == PRIME_TOWER else featurePrintingColor(feat))
+  colors.reverse()
+  return colors
+
+def nextFeaturePrintingColor(ps: PrintState) -> int:
+  """Target printing color of the next printing feature left on the layer or -1"""
+  return ps.nextFeatureColors[-1-len(ps.features)]
+
+# Check if next feature needs a toolchange and the next toolchange color
+def determineIfNextFeatureNeedsToolchange(ps: PrintState) -> tuple[bool, int]:
+  printingToolchangeNewColorIndex = currentPrintingColorIndexForColorIndex(nextFeaturePrintingColor(ps), ps.toolRemap)
+  return ps.printingColor != printingToolchangeNewColorIndex, printingToolchangeNewColorIndex
+
+# return the current printing color index that should be used for a given color index. Returns the replacement color index for a color index if there is a replacement assigned. toolRemap is the table of the layer from ColorSchedule.toolRemap() and a tool past its end has no replacement.
+def currentPrintingColorIndexForColorIndex(colorIndex: int, toolRemap: list[int]):
+  if 0 <= colorIndex < len(toolRemap):
+    return toolRemap[colorIndex]
+  else:
+    return colorIndex
 
-  print(f"{len(ps.features)} printing features and {len(ps.primeTowerFeatures)} reusable prime towers found")
+def toolCommandIndex(cl: str, kind: LineKind) -> int:
+  """Tool index of a M620, T or M621 line"""
+  if kind == LineKind.M620:
+    return int(M620_RE.match(cl).groups()[0])
+  elif kind == LineKind.M621:
+    return int(M621_RE.match(cl).groups()[0])
+  return int(TOOLCHANGE_T_RE.match(cl).groups()[0])
 
-  
-  #print rearranged features
-  print(f"{len(ps.features)} printing features found")
-  fi = 0
-  for feat in ps.features:
-    print(f"{fi} {feat.featureType} start: {feat.start} end: {feat.end} originalcolor: {feat.originalColor} isPeriodicColor:{feat.isPeriodicColor} printingColor:{feat.printingColor}")
-    if feat.toolchange:
-      print(f"toolchange.start: {feat.toolchange.start} end: {feat.toolchange.end} printingColor:{feat.toolchange.printingColor}")
-    if feat.wipeEnd:
-      print(f"wipeEnd.start: {feat.wipeEnd.start}")
-    fi += 1
-
-  #print prime tower features (only filled when periodic layer)
-  print(f"{len(ps.primeTowerFeatures)} prime tower features found")
-  for feat in ps.primeTowerFeatures:
-    print(f"{feat.featureType} start: {feat.start} end: {feat.end} originalcolor: {feat.originalColor} isPeriodicColor:{feat.isPeriodicColor} printingColor:{feat.printingColor}")
-    if feat.toolchange:
-      print(f"toolchange.start: {feat.toolchange.start} end: {feat.toolchange.end} printingColor:{feat.toolchange.printingColor}")
-    if feat.wipeEnd:
-      print(f"wipeEnd.start: {feat.wipeEnd.start}")
-  
-  #Debug breakpoint after layer feature cataloging
-  if ps.height == 7.8:
-    0==0
-
-def checkAndInsertToolchange(ps: PrintState, f: typing.TextIO, out: typing.TextIO, cl: str, toolchangeBareFile: str, pcs: list[PeriodicColor]) -> ToolchangeType:
-  # Check if we are at toolchange insertion point. This point could be active when no more features are remaining and before any features are found (TC can be inserted after change_layer found)
-  insertedToolchangeTypeAtCurrentPosition = ToolchangeType.NONE
-  if f.tell() == ps.toolchangeInsertionPoint:
-    # Write out the current line read that is before the toolchange insert. We will be inserting toolchange code after this line. Temporarily set skipWrite to true for this loop
-    writeWithFilters(out, cl, loadedColors)
-    #skipWrite = True
+def restorePositionGcode(startPosition: Position, extraPrimeGcode: str) -> str:
+  """G-code that restores the position, feedrate and acceleration at the start of a feature followed by any prime needed"""
+  gcode = "; MFM Pre-Feature Restore Positions\n"
+
+  # Restore acceleration
+  restoreCmd = ACCELERATION_M204
+  try:
+    getattr(startPosition, "P")
+    restoreCmd += f" P{startPosition.P}"
+    getattr(startPosition, "R")
+    restoreCmd += f" R{startPosition.R}"
+    getattr(startPosition, "T")
+    restoreCmd += f" T{startPosition.T}"
+  except AttributeError as e:
+    log.debug("Restore acceleration did not find axis %s yet", e)
+  if len(restoreCmd) > len(ACCELERATION_M204):
+    gcode += f"{restoreCmd}\n"
+
+  # Restore position and feedrate
+  restoreCmd = MOVEMENT_G0
+  try:
+    getattr(startPosition, "X")
+    restoreCmd += f" X{startPosition.X}"
+    getattr(startPosition, "Y")
+    restoreCmd += f" Y{startPosition.Y}"
+    getattr(startPosition, "Z")
+    restoreCmd += f" Z{startPosition.Z}"
+    getattr(startPosition, "F")
+    restoreCmd += f" F{startPosition.FTravel}"
+  except AttributeError as e:
+    log.debug("Restore position did not find axis %s yet", e)
+  if len(restoreCmd) > len(MOVEMENT_G0):
+    gcode += f"{restoreCmd}\n"
+
+  if extraPrimeGcode:
+    gcode += f"{extraPrimeGcode}\n" #Extrude a bit for minimal toolchange
+  return gcode
+
+def startLayer(layer: PrintState, layerNum: int, lastPrintState: PrintState, colorSchedule: ColorSchedule, profile: ProcessProfile) -> PrintState:
+  """Create the print state for a layer found in the layer index and plan its feature order and first toolchange"""
+  with profile.phase(PHASE_REORDER):
+    return _startLayer(layer, layerNum, lastPrintState, colorSchedule)
+
+def _startLayer(layer: PrintState, layerNum: int, lastPrintState: PrintState, colorSchedule: ColorSchedule) -> PrintState:
+  currentPrint = newLayerPrintState(layer=layer, layerNum=layerNum, lastPrintState=lastPrintState, colorSchedule=colorSchedule)
+
+  reorderFeatures(ps=currentPrint)
+
+  currentPrint.skipWrite = False
+
+  # Check if toolchange needed for "next" feature which is index 0
+  nextFeatureNeedsToolchange, _ = determineIfNextFeatureNeedsToolchange(ps=currentPrint)
+  if nextFeatureNeedsToolchange: #if printing color before and printing color in next feature do not match, insert a toolchange at start of next feature (or at layer end if there are no features)
+    if len(currentPrint.features) > 0:
+      currentPrint.toolchangeInsertionPoint = currentPrint.features[0].start
+    else:
+      currentPrint.toolchangeInsertionPoint = currentPrint.layerEnd
+
+  return currentPrint
+
+def toolCommandStartsInRange(f: GcodeReader, ps: PrintState, start: int, end: int) -> list[int]:
+  """Start positions of the lines between start and end that could be tool commands. Uses the positions found by the layer scan if it read the whole layer."""
+  if ps.toolCommandStarts != None:
+    return ps.toolCommandStarts[bisect.bisect_left(ps.toolCommandStarts, start):bisect.bisect_left(ps.toolCommandStarts, end)]
+  return f.matchStarts(TOOL_COMMAND_LINE_RE, start, end)
+
+class LayerPlanner:
+  """Plans the edits that write a layer in the same order the process loop read it. The loop only did more than write or skip a line at a feature stop position, the next layer change, or the original toolchange and WIPE_END of a feature that skips them. Only the lines that end at those positions are planned one at a time. The lines between them are planned as copied or skipped spans with their tool command lines found from the layer scan."""
+
+  def __init__(self, f: GcodeReader, ps: PrintState, nextLayerChangeStart: int, configuration: MFMConfiguration, profile: ProcessProfile, statusQueue: ProgressReporter, keepEdits: bool = True):
+    self.f: GcodeReader = f
+    self.ps: PrintState = ps
+    self.nextLayerChangeStart: int = nextLayerChangeStart
+    self.pcs: list[PeriodicColor] = configuration[CONFIG_PERIODIC_COLORS]
+    self.profile: ProcessProfile = profile
+    self.statusQueue: ProgressReporter = statusQueue
+    self.plan: LayerPlan = LayerPlan(ps.height, f.tell()) if keepEdits else StateOnlyLayerPlan(ps.height, f.tell())
+    self.curFeature: Feature = None
+    self.curFeatureIdx: int = -1
+    # Tool command lines already read by their start
+    self._toolCommandLines: dict[int, tuple[int, int, str, LineKind]] = {}
+    # Spans of the input in the order they were read. The original position is only parsed from them when the WIPE_END prime needs it.
+    self._readSpans: list[list[int]] = []
+    self._resolvedSpan: int = 0
+    self._resolvedEnd: int = 0
+    # Line that ends at the current stop
+    self._lineStart: int = 0
+    self._lineEnd: int = 0
+    self._lineWritten: bool = False
+
+  def planLayer(self) -> LayerPlan:
+    f, ps, plan = self.f, self.ps, self.plan
+    pos = plan.start
+    while pos < f.size:
+      lineEnd = self._nextStop(pos)
+      lineStart = f.previousLineStart(lineEnd)
+      if lineStart > pos:
+        self._read(pos, lineStart)
+        if ps.skipWrite:
+          plan.skip(pos, lineStart)
+        else:
+          self._copy(pos, lineStart)
+      pos = self._planLine(lineStart, lineEnd)
+      if pos == None:
+        plan.end = self.nextLayerChangeStart
+        plan.reachedNextLayer = True
+        break
+    else:
+      plan.end = pos
+
+    # The next layer uses the WIPE_END prime values at the end of this layer
+    if ps.featureWipeEndPrime is ps.originalPosition:
+      self._resolveOriginalPosition()
+    return plan
+
+  def planPassthroughLayer(self) -> LayerPlan:
+    """Plan a layer that isPassthroughLayer() accepted. Gives the same plan as planLayer() but only the first feature and a feature with an inserted toolchange are started like the process loop. Other feature starts only write the original line before the feature."""
+    f, ps, plan = self.f, self.ps, self.plan
+    end = self.nextLayerChangeStart if self.nextLayerChangeStart != None else f.size
+    pos = plan.start
+    while len(ps.features) > 0:
+      curFeature = ps.features.pop(0)
+      ps.stopPositions.remove(curFeature.start)
+      self.curFeatureIdx += 1
+      if self.curFeatureIdx > 0 and curFeature.start != ps.toolchangeInsertionPoint:
+        continue
+
+      self.curFeature = curFeature
+      lineStart = f.previousLineStart(curFeature.start)
+      self._read(pos, lineStart)
+      self._copy(pos, lineStart)
+      self._lineStart, self._lineEnd, self._lineWritten = lineStart, curFeature.start, False
+      self._read(lineStart, curFeature.start)
+      self._startNewFeature(curFeature.start)
+      ps.skipWriteForCurrentLine = False
+      if not self._lineWritten:
+        plan.skip(lineStart, curFeature.start)
+      pos = curFeature.start
+
+    self._read(pos, end)
+    self._copy(pos, end)
+    plan.end = end
+    plan.reachedNextLayer = self.nextLayerChangeStart != None
+    return plan
+
+  def _nextStop(self, pos: int) -> int:
+    """End of the first line after pos that the process loop did more than write or skip"""
+    ps = self.ps
+    end = self.f.size
+    stop = ps.stopPositions.nextAfter(pos)
+    if stop != None and stop < end:
+      end = stop
+    if self.nextLayerChangeStart != None and pos < self.nextLayerChangeStart < end:
+      end = self.nextLayerChangeStart
+    curFeature = self.curFeature
+    if curFeature and curFeature.skipType == SkipType.FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END:
+      if curFeature.toolchange and pos < curFeature.toolchange.start < end:
+        end = curFeature.toolchange.start
+      if curFeature.wipeEnd and pos < curFeature.wipeEnd.start < end:
+        end = curFeature.wipeEnd.start
+    return end
+
+  def _planLine(self, lineStart: int, lineEnd: int) -> int | None:
+    """Plan the line the same as the process loop body. Returns the position the loop continued reading from or None if the next layer change was reached."""
+    ps, plan = self.ps, self.plan
+    self._lineStart, self._lineEnd, self._lineWritten = lineStart, lineEnd, False
+    self._read(lineStart, lineEnd)
+    ps.skipWriteForCurrentLine = False
+    pos = lineEnd
+
+    if len(ps.features) == 0:
+      # Write the last line of the last feature and jump to layer end
+      if lineEnd in ps.stopPositions:
+        if not ps.skipWrite:
+          self._writeLine()
+        pos = ps.layerEnd
+      if pos == self.nextLayerChangeStart:
+        if not self._lineWritten:
+          plan.skip(lineStart, lineEnd)
+        return None
+    elif lineEnd in ps.stopPositions: # find a stop position to "start" a new feature
+      ps.stopPositions.remove(lineEnd)
+      self.curFeature = ps.features.pop(0)
+      self.curFeatureIdx += 1
+
+      if self.statusQueue:
+        item = StatusQueueItem()
+        item.statusRight = f"{self.curFeature.featureType} Writing"
+        self.statusQueue.put(item=item)
+
+      pos = self.curFeature.start
+      self._startNewFeature(pos)
+
+    # Start skip if feature.toolchange is reached and we marked feature as needing original toolchange skipped
+    curFeature = self.curFeature
+    if curFeature and curFeature.skipType == SkipType.FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END:
+      if curFeature.toolchange and pos == curFeature.toolchange.start:
+        plan.text("; MFM Original Feature Toolchange skipped\n")
+        ps.skipWrite = True
+
+      if curFeature.wipeEnd and pos == curFeature.wipeEnd.start and curFeature.featureType not in RETAIN_WIPE_END_FEATURE_TYPES:
+        self._writeLine()
+        plan.text(";WIPE_END placeholder for PrusaSlicer Gcode Viewer\n")
+        plan.text("; WIPE_END placeholder for BambuStudio Gcode Preview\n")
+        plan.text("; MFM Original WIPE_END skipped\n")
+        ps.skipWrite = True
+        # Reference original pos as last wipe end pos for next layer
+        ps.featureWipeEndPrime = ps.originalPosition
+
+    if not ps.skipWrite and not ps.skipWriteForCurrentLine:
+      self._writeLine()
+
+    if ps.skipWriteForCurrentLine:
+      ps.skipWrite = False
+      ps.skipWriteForCurrentLine = False
+
+    if not self._lineWritten:
+      plan.skip(lineStart, lineEnd)
+    return pos
+
+  def _startNewFeature(self, pos: int):
+    ps, curFeature = self.ps, self.curFeature
+    # remember if last line from last feature was supposed to be skipped
+    prevFeatureSkip = ps.skipWrite
+
+    #stop any skip write when starting new feature
+    ps.skipWrite = False
+
+    insertedToolchangeTypeAtCurrentPosition = self._insertToolchange(pos)
+    if insertedToolchangeTypeAtCurrentPosition == ToolchangeType.NONE and not prevFeatureSkip:
+      self._writeLine() # write current line read in (before seek to new feature location) before we restore position
+    ps.skipWriteForCurrentLine = True
+
+    # Restore pre-feature position state before entering a new feature on periodic layer (but not if it is a prime tower on periodic line) or first feature on layer anywhere and prime if toolchange was inserted at start of feature.
+    if (ps.isPeriodicLine == True and not (curFeature.featureType == PRIME_TOWER and curFeature.toolchange)) or self.curFeatureIdx == 0:
+      # Restore any prime needed
+      extraPrimeGcode = None
+      if insertedToolchangeTypeAtCurrentPosition == ToolchangeType.FULL:
+        extraPrimeGcode = FULL_TOOLCHANGE_PRIME
+      elif insertedToolchangeTypeAtCurrentPosition == ToolchangeType.MINIMAL:
+        extraPrimeGcode = MINIMAL_TOOLCHANGE_PRIME
+      elif ps.featureWipeEndPrime:
+        if ps.featureWipeEndPrime is ps.originalPosition:
+          self._resolveOriginalPosition()
+        if hasattr(ps.featureWipeEndPrime, 'E') and hasattr(ps.featureWipeEndPrime, 'F'):
+          extraPrimeGcode = f"G1 E{ps.featureWipeEndPrime.E} F{ps.featureWipeEndPrime.F}"
+          ps.featureWipeEndPrime = None # clear feature wipe end prime position which had prev feature wipe values
+      if self.plan.keepsEdits:
+        startPosition = ps.featurePositions.positionAt(self.f, curFeature.start)
+        self.plan.restorePosition(curFeature.start, restorePositionGcode(startPosition, extraPrimeGcode))
+
+    # All other processing below is for periodic
+    if not ps.isPeriodicLine:
+      return
+
+    # We should not run into this older prime tower check because we separate prime towers into another feature list for periodic lines
+    # If current feature is the prime tower with toolchange. Do not write prime tower. Skip past this prime tower feature. We may find use for prime tower later. If prime tower does not have toolchange, do not skip it.
+    if curFeature.featureType == PRIME_TOWER and curFeature.toolchange:
+      log.debug("Current feature is prime tower (with toolchange) and it is available for use/relocation. Skipping prime tower.")
+      self.plan.text("; MFM Original Prime Tower skipped\n")
+      curFeature.skipType = SkipType.PRIME_TOWER_FEATURE
+      ps.skipWrite = True
+      ps.skipWriteForCurrentLine = False #don't reset skipwrite at end of loop
+      log.debug("start Prime Tower skip %d", pos)
+      return
+    #If prime tower is not available for relocation, it should be in the printing features list and just written as usual
+
+    # Check if next feature needs a toolchange. Don't check on last feature because we check for the first feature in next layer when we find next layer. We do not know target printing color of first feature on next layer yet.
+    if len(ps.features) > 0:
+      nextFeatureNeedsToolchange, _ = determineIfNextFeatureNeedsToolchange(ps)
+      if nextFeatureNeedsToolchange: #if printing color before and printing color in next feature do not match, insert a toolchange at start of next feature (or at layer end if this is the last feature)
+        ps.toolchangeInsertionPoint = ps.features[0].start
+
+    # Check if this is the last feature and all available prime towers have not been used yet. Set toolchange insert to be at layer end
+    if len(ps.features) == 0 and len(ps.primeTowerFeatures) > 0:
+      log.debug("On last feature and %d available prime towers not used. Set toolchange insert at layer end %d", len(ps.primeTowerFeatures), ps.layerEnd)
+      ps.toolchangeInsertionPoint = ps.layerEnd
+
+    # skip feature original toolchanges and WIPE_END () to end of feature
+    curFeature.skipType = SkipType.FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END
+
+  def _insertToolchange(self, pos: int) -> ToolchangeType:
+    # Check if we are at toolchange insertion point. This point could be active when no more features are remaining and before any features are found (TC can be inserted after change_layer found)
+    ps, plan = self.ps, self.plan
+    if pos != ps.toolchangeInsertionPoint:
+      return ToolchangeType.NONE
+    # Write out the current line read that is before the toolchange insert. We will be inserting toolchange code after this line.
+    self._writeLine()
 
     # find the correct color for the toolchange
-    nextFeatureColor, _ = determineNextFeaturePrintingColor(ps.features, -1, -1, False)
-    printingToolchangeNewColorIndex = currentPrintingColorIndexForColorIndex(nextFeatureColor, loadedColors)
+    nextFeatureColor = nextFeaturePrintingColor(ps)
+    if nextFeatureColor == -1:
+      log.debug("No printing feature left for toolchange at %d. Skipping toolchange.", pos)
+      ps.toolchangeInsertionPoint = 0
+      return ToolchangeType.NONE
+    printingToolchangeNewColorIndex = currentPrintingColorIndexForColorIndex(nextFeatureColor, ps.toolRemap)
 
     # Check if full toolchange is available
     if len(ps.primeTowerFeatures) > 0:
       insertedToolchangeTypeAtCurrentPosition = ToolchangeType.FULL
-      
-      #insert toolchange full
-      out.write(f"; MFM Prime Tower and Toolchange (full) inserted to {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}\n")
-
-      # Skip write for toolchange
-      skipWriteToolchange = False
-      wipeStartFoundCount = 0
-
-      # Seek to original prime tower and toolchange position. Write prime tower to output. Seek back to while loop reading position.
-      nextAvailablePrimeTowerFeature = ps.primeTowerFeatures.pop(0)
-      cp = f.tell()
-      f.seek(nextAvailablePrimeTowerFeature.start, os.SEEK_SET)
-      # We check if the position is != instead of <= because readline() with the next line being empty meaning it looks like double line endings leads to high tell() values that do not make sense but still seek to the correct position anyways.
-      while f.tell() != nextAvailablePrimeTowerFeature.end:
-        cl = f.readline()
-
-        if f.tell() == 155194:
-          0==0
-
-        # Skip WIPE_END of the nserted prime tower
-        if nextAvailablePrimeTowerFeature.wipeEnd and f.tell() == nextAvailablePrimeTowerFeature.wipeEnd.start:
-          writeWithFilters(out, cl, loadedColors)
-          out.write(";WIPE_END placeholder for PrusaSlicer Gcode Viewer\n")
-          out.write("; WIPE_END placeholder for BambuStudio Gcode Preview\n")
-          out.write("; MFM Original WIPE_END skipped for inserted Prime Tower\n")
-          skipWriteToolchange = True
-
-        if skipWriteToolchange == False:
-          cl = substituteNewColor(cl, nextFeatureColor)
-          writeWithFilters(out, cl, loadedColors)
-      f.seek(cp, os.SEEK_SET)
-
-      print(f"added full toolchange {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}")
-    
+      plan.text(f"; MFM Prime Tower and Toolchange (full) inserted to {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}\n")
+      # The original prime tower and toolchange is written here
+      with self.profile.phase(PHASE_PRIME_TOWER_REPLAY):
+        nextAvailablePrimeTowerFeature = ps.primeTowerFeatures.pop(0)
+        plan.toolchange(ToolchangeType.FULL, printingToolchangeNewColorIndex, nextAvailablePrimeTowerFeature)
+        self._planPrimeTower(nextAvailablePrimeTowerFeature, nextFeatureColor)
+      log.debug("added full toolchange %d --replacement--> %d", nextFeatureColor, printingToolchangeNewColorIndex)
     else:
       insertedToolchangeTypeAtCurrentPosition = ToolchangeType.MINIMAL
-      #add minimal toolchange
-      out.write(f"; MFM Toolchange (minimal) inserted to {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}\n")
-      # normally we would replace the color with replacement color in writeWithColorFilter() but we are replacing multiple lines so this will write directly
-      with open(toolchangeBareFile, mode='r') as tc_bare:
-        tc_bare_code = tc_bare.read().replace('XX', str(printingToolchangeNewColorIndex))
-        out.write(tc_bare_code)
-
-      print(f"added minimal toolchange {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}")
-      
+      plan.text(f"; MFM Toolchange (minimal) inserted to {nextFeatureColor} --replacement--> {printingToolchangeNewColorIndex}\n")
+      plan.toolchange(ToolchangeType.MINIMAL, printingToolchangeNewColorIndex)
+      log.debug("added minimal toolchange %d --replacement--> %d", nextFeatureColor, printingToolchangeNewColorIndex)
+
     ps.printingColor = printingToolchangeNewColorIndex
-    ps.printingPeriodicColor = ps.printingColor == pcs[0].colorIndex if len(pcs) > 0 else False
+    ps.printingPeriodicColor = any(pc.colorIndex == ps.printingColor for pc in self.pcs)
 
     ps.toolchangeInsertionPoint = 0 # clear toolchange insertion point
-  return insertedToolchangeTypeAtCurrentPosition
-
-
-# Get the actual processed printing color before next printing feature (our current code recoloring state+target color)
-def determineBeforeNextFeaturePrintingColor(features: list[Feature], curFeatureIdx: int, lastPrintingColor: int, passedNonTCPrimeTowers: int) -> tuple[int, bool]:
-  if curFeatureIdx > -1:
-    curFeature = features[curFeatureIdx]
-    if curFeature.printingColor > -1: # Only set if periodic feature
-      lastPrintingColor = curFeature.printingColor
-    # Do not check toolchange at end of current feature because we skip all toolchanges in features and insert our own
-  if curFeatureIdx+1 < len(features): # If we have additional features after this
-    nextFeature = features[curFeatureIdx+1]
-    if nextFeature.featureType == PRIME_TOWER: # If next feature is non-toolchange prime tower, keep looking
-      return lastPrintingColor, passedNonTCPrimeTowers+1
-  return lastPrintingColor, passedNonTCPrimeTowers
-
-# Get the target printing color of next printing feature (based on original code state and next feature target printing color (if set if periodic))
-def determineNextFeaturePrintingColor(features: list[Feature], curFeatureIdx: int, lastPrintingColor: int, passedNonTCPrimeTowers: int) -> tuple[int, bool]:
-  if curFeatureIdx+1 < len(features): # If we have additional features after this
-    nextFeature = features[curFeatureIdx+1]
-    if nextFeature.featureType == PRIME_TOWER: # If next feature is non-toolchange prime tower, keep looking
-      return determineNextFeaturePrintingColor(features, curFeatureIdx+1, lastPrintingColor, passedNonTCPrimeTowers)
+    return insertedToolchangeTypeAtCurrentPosition
+
+  def _planPrimeTower(self, primeTower: Feature, newColorIndex: int):
+    """Copy a relocated prime tower with its toolchange changed to newColorIndex. The prime tower WIPE_END and the lines after it are skipped."""
+    if not self.plan.keepsEdits:
+      return
+    end = primeTower.end
+    # The line before WIPE_END keeps its original color
+    lastLineStart = -1
+    if primeTower.wipeEnd:
+      end = primeTower.wipeEnd.start
+      lastLineStart = self.f.previousLineStart(end)
+    pos = primeTower.start
+    for lineStart, lineEnd, cl, kind in self._toolCommands(primeTower.start, end):
+      self.plan.copy(pos, lineStart)
+      colorIndex = toolCommandIndex(cl, kind) if lineStart == lastLineStart else newColorIndex
+      self.plan.substituteTool(lineStart, lineEnd, currentPrintingColorIndexForColorIndex(colorIndex, self.ps.toolRemap))
+      pos = lineEnd
+    self.plan.copy(pos, end)
+    if primeTower.wipeEnd:
+      self.plan.text(";WIPE_END placeholder for PrusaSlicer Gcode Viewer\n")
+      self.plan.text("; WIPE_END placeholder for BambuStudio Gcode Preview\n")
+      self.plan.text("; MFM Original WIPE_END skipped for inserted Prime Tower\n")
+
+  def _toolCommands(self, start: int, end: int) -> list[tuple[int, int, str, LineKind]]:
+    """Start, end, text and kind of the tool command lines between start and end"""
+    lines = []
+    for lineStart in toolCommandStartsInRange(self.f, self.ps, start, end):
+      line = self._toolCommandLines.get(lineStart)
+      if line == None:
+        self.f.seek(lineStart, os.SEEK_SET)
+        cl = self.f.readline()
+        line = self._toolCommandLines[lineStart] = (lineStart, self.f.tell(), cl, classifyLine(cl))
+      if line[3] in TOOL_COMMAND_KINDS:
+        lines.append(line)
+    return lines
+
+  def _read(self, start: int, end: int):
+    """Lines between start and end are read next. Only T lines change the print state when they are read."""
+    ps = self.ps
+    if self._readSpans and self._readSpans[-1][1] == start:
+      self._readSpans[-1][1] = end
     else:
-      lastPrintingColor = nextFeature.originalColor
-      if nextFeature.printingColor > -1: # Check next feature target printing color (only set if periodic feature)
-        lastPrintingColor = nextFeature.printingColor
-  return lastPrintingColor, passedNonTCPrimeTowers
-
-# Check if next layer needs a toolchange and the next toolchange color
-def determineIfNextFeatureNeedsToolchange(ps: PrintState, cfi: int) -> tuple[bool, int, int] :
-  # the active printing color before starting the next feature
-  beforeNextFeaturePrintingColor, _ = determineBeforeNextFeaturePrintingColor(features=ps.features, curFeatureIdx=cfi, lastPrintingColor=ps.printingColor, passedNonTCPrimeTowers=0)
-  # the correct target printing color for the next feature
-  nextFeaturePrintingColor, passedNonTCPrimeTowers = determineNextFeaturePrintingColor(features=ps.features, curFeatureIdx=cfi, lastPrintingColor=-1, passedNonTCPrimeTowers=0)
-  printingToolchangeNewColorIndex = currentPrintingColorIndexForColorIndex(nextFeaturePrintingColor, loadedColors)
-
-  #debug breakpoints
-  if ps.height == 0.6:
-    0==0
-
-  return beforeNextFeaturePrintingColor != printingToolchangeNewColorIndex, printingToolchangeNewColorIndex, passedNonTCPrimeTowers
-
-# Update position state
-def checkAndUpdatePosition(cl: str, pp: Position):
-  # look for movement gcode and record last position before entering a feature
-  movementMatch = re.match(MOVEMENT_G, cl)
-  if movementMatch:
-    m = 0
-    travelMove = True
-    while m+1 < len(movementMatch.groups()):
-      if movementMatch.groups()[m] == None:
-        break
-      axis = str(movementMatch.groups()[m])
-      axisValue = float(movementMatch.groups()[m+1])
-      m += 2
-      if axis == 'X':
-        pp.X = axisValue
-      elif axis == 'Y':
-        pp.Y = axisValue
-      elif axis == 'Z':
-        pp.Z = axisValue
-      elif axis == 'I' or axis == 'J' or axis == 'P' or axis == 'R':
-        continue
-      elif axis == 'E':
-        pp.E = axisValue
-        travelMove = False
-      elif axis == 'F':
-        pp.F = axisValue
-      else:
-        print(f"Unknown movement/feedrate axis {axis} {axisValue} for input {cl}")
-      
-    # If this move did not have extrusion, save the Feedrate as last travel speed
-    if travelMove:
-      if hasattr(pp, 'F'):
-        pp.FTravel = pp.F
+      self._readSpans.append([start, end])
 
-  else:
-    #look for acceleration gcode
-    accelerationMatch = re.match(ACCELERATION_M, cl)
-    if accelerationMatch:
-      m = 0
-      while m+1 < len(accelerationMatch.groups()):
-        if accelerationMatch.groups()[m] == None:
+    for _, lineEnd, cl, kind in self._toolCommands(start, end):
+      if kind != LineKind.TOOL:
+        continue
+      colorIndex = int(TOOLCHANGE_T_RE.match(cl).groups()[0])
+      log.debug("found toolchange to %d at %d", colorIndex, lineEnd)
+      # Only update printstatus.originalcolor until we find the first layer. Toolchanges we find after wards are out of order due to rearranged features. We should use layerendoriginalcolor after first layer.
+      if ps.height == -1:
+        ps.originalColor = colorIndex
+      if not ps.skipWrite:
+        ps.printingColor = ps.originalColor
+        log.debug("found printing color toolchange to %d", colorIndex)
+
+  def _copy(self, start: int, end: int):
+    """Copy the lines between start and end with the tool commands changed to the printing tool"""
+    if not self.plan.keepsEdits:
+      return
+    pos = start
+    for lineStart, lineEnd, cl, kind in self._toolCommands(start, end):
+      self.plan.copy(pos, lineStart)
+      self.plan.substituteTool(lineStart, lineEnd, currentPrintingColorIndexForColorIndex(toolCommandIndex(cl, kind), self.ps.toolRemap))
+      pos = lineEnd
+    self.plan.copy(pos, end)
+
+  def _writeLine(self):
+    self._copy(self._lineStart, self._lineEnd)
+    self._lineWritten = True
+
+  def _resolveOriginalPosition(self):
+    """Set the last extrusion and feedrate read on the original position. Only the spans read since the last time are parsed from their end until both are found."""
+    f, pp = self.f, self.ps.originalPosition
+    needE = needF = True
+    i = len(self._readSpans) - 1
+    while i >= self._resolvedSpan and (needE or needF):
+      start, end = self._readSpans[i]
+      if i == self._resolvedSpan:
+        start = max(start, self._resolvedEnd)
+      for lineStart in reversed(f.matchStarts(POSITION_LINE_RE, start, end)):
+        cl = f.lineAt(lineStart)
+        kind = classifyLine(cl)
+        if kind != LineKind.MOVE:
+          continue
+        position = Position()
+        checkAndUpdatePosition(cl=cl, pp=position, kind=kind)
+        if needE and hasattr(position, 'E'):
+          pp.E = position.E
+          needE = False
+        if needF and hasattr(position, 'F'):
+          pp.F = position.F
+          needF = False
+        if not needE and not needF:
           break
-        axis = str(accelerationMatch.groups()[m])
-        axisValue = float(accelerationMatch.groups()[m+1])
-        m += 2
-        if axis == 'P':
-          pp.P = axisValue
-        elif axis == 'R':
-          pp.R = axisValue
-        elif axis == 'T':
-          pp.T = axisValue
-        elif axis == 'S':
-          pp.P = pp.T = axisValue
-        else:
-          print(f"Unknown accleration axis {axis} {axisValue} for input {cl}")
-  
-# Update states for movment POSITION and TOOL
-def updatePrintState(ps: PrintState, cl: str, sw: bool, cp: int):
-  # look for movement gcode and record last position
-  checkAndUpdatePosition(cl=cl, pp=ps.originalPosition)
-  # look for toolchange T
-  toolchangeMatch = re.match(TOOLCHANGE_T, cl)
-
-  # Only update printstatus.originalcolor until we find the first layer. Toolchanges we find after wards are out of order due to rearranged features. We should use layerendoriginalcolor after first layer.
-  if toolchangeMatch:
-    print(f"found toolchange to {int(toolchangeMatch.groups()[0])} at {cp}")
-    if ps.height == -1:
-      ps.originalColor = int(toolchangeMatch.groups()[0])
-    if sw == False:
-      ps.printingColor = ps.originalColor
-      print(f"found printing color toolchange to {int(toolchangeMatch.groups()[0])}")
-
-def substituteNewColor(cl, newColorIndex: int):
-  cl = re.sub(M620, f"M620 S{newColorIndex}A", cl)
-  cl = re.sub(TOOLCHANGE_T, f"T{newColorIndex}", cl)
-  cl = re.sub(M621, f"M621 S{newColorIndex}A", cl)
-  return cl
-
-def startNewFeature(gf: str, ps: PrintState, f: typing.TextIO, out: typing.TextIO, cl: str, toolchangeBareFile: str, pcs: list[PeriodicColor], curFeature: Feature, curFeatureIdx: int):
-  # remember if last line from last feature was supposed to be skipped
-  prevFeatureSkip = False
-  if ps.skipWrite:
-    prevFeatureSkip = True
-
-  #stop any skip write when starting new feature
-  #re-enable extrude
-  #print(f"End previous feature skip at feature {f.tell()}")
-  ps.skipWrite = False
-
-  insertedToolchangeTypeAtCurrentPosition = checkAndInsertToolchange(ps=ps, f=f, out=out, cl=cl, toolchangeBareFile=toolchangeBareFile, pcs=pcs)
-  if insertedToolchangeTypeAtCurrentPosition == ToolchangeType.NONE and not prevFeatureSkip:
-    writeWithFilters(out, cl, loadedColors) # write current line read in (before seek to new feature location) before we restore position
-  ps.skipWriteForCurrentLine = True
-  
-  # Restore pre-feature position state before entering a new feature on periodic layer (but not if it is a prime tower on periodic line) or first feature on layer anywhere and prime if toolchange was inserted at start of feature.
-  if (ps.isPeriodicLine == True and not (curFeature.featureType == PRIME_TOWER and curFeature.toolchange)) or curFeatureIdx == 0:
-    out.write("; MFM Pre-Feature Restore Positions\n")
-
-    # Restore acceleration
-    restoreCmd = ACCELERATION_M204
-    try:
-      getattr(curFeature.startPosition, "P")
-      restoreCmd += f" P{curFeature.startPosition.P}"
-      getattr(curFeature.startPosition, "R")
-      restoreCmd += f" R{curFeature.startPosition.R}"
-      getattr(curFeature.startPosition, "T")
-      restoreCmd += f" T{curFeature.startPosition.T}"
-    except AttributeError as e:
-      print(f"Restore acceleration did not find axis {e} yet")
-    if len(restoreCmd) > len(ACCELERATION_M204):
-      out.write(f"{restoreCmd}\n")
-
-    # Restore position and feedrate
-    restoreCmd = MOVEMENT_G0
-    try:
-      getattr(curFeature.startPosition, "X")
-      restoreCmd += f" X{curFeature.startPosition.X}"
-      getattr(curFeature.startPosition, "Y")
-      restoreCmd += f" Y{curFeature.startPosition.Y}"
-      getattr(curFeature.startPosition, "Z")
-      restoreCmd += f" Z{curFeature.startPosition.Z}"
-      getattr(curFeature.startPosition, "F")
-      restoreCmd += f" F{curFeature.startPosition.FTravel}"
-    except AttributeError as e:
-      print(f"Restore position did not find axis {e} yet")
-    if len(restoreCmd) > len(MOVEMENT_G0):
-      out.write(f"{restoreCmd}\n")
-    #out.write(f"G0 X{curFeature.startPosition.X} Y{curFeature.startPosition.Y} Z{curFeature.startPosition.Z} F{curFeature.startPosition.F}\n")
-    # Restore any prime needed
-    extraPrimeGcode = None
-    if insertedToolchangeTypeAtCurrentPosition == ToolchangeType.FULL:
-      extraPrimeGcode = FULL_TOOLCHANGE_PRIME
-    elif insertedToolchangeTypeAtCurrentPosition == ToolchangeType.MINIMAL:
-      extraPrimeGcode = MINIMAL_TOOLCHANGE_PRIME
-    elif ps.featureWipeEndPrime:
-      extraPrimeGcode = f"G1 E{ps.featureWipeEndPrime.E} F{ps.featureWipeEndPrime.F}"
-      ps.featureWipeEndPrime = None # clear feature wipe end prime position which had prev feature wipe values
-    #elif gf == MARLIN_2_BAMBU_PRUSA_MARKED_GCODE:
-    #  extraPrimeGcode = FEATURE_START_DEFAULT_PRIME
-    if extraPrimeGcode:
-      out.write(f"{extraPrimeGcode}\n") #Extrude a bit for minimal toolchange
-
-  # All other processing below is for periodic
-  if not ps.isPeriodicLine:
-    return 
-  
-  # We should not run into this older prime tower check because we separate prime towers into another feature list for periodic lines
-  # If current feature is the prime tower with toolchange. Do not write prime tower. Skip past this prime tower feature. We may find use for prime tower later. If prime tower does not have toolchange, do not skip it.
-  if curFeature.featureType == PRIME_TOWER and curFeature.toolchange:
-    print(f"Current feature is prime tower (with toolchange) and it is available for use/relocation. Skipping prime tower.")
-    out.write("; MFM Original Prime Tower skipped\n")
-    curFeature.skipType = SkipType.PRIME_TOWER_FEATURE
-    ps.skipWrite = True
-    ps.skipWriteForCurrentLine = False #don't reset skipwrite at end of loop
-    print(f"start Prime Tower skip {f.tell()}")
-    return
-  #If prime tower is not available for relocation, it should be in the printing features list and just written as usual
-
-  # Check if next feature needs a toolchange. Don't check on last feature because we check for the first feature in next layer when we find next layer. We do not know target printing color of first feature on next layer yet. 
-  if len(ps.features) > 0:
-    
-    nextFeatureNeedsToolchange, _, _ = determineIfNextFeatureNeedsToolchange(ps, -1)
-    if nextFeatureNeedsToolchange: #if printing color before and printing color in next feature do not match, insert a toolchange at start of next feature (or at layer end if this is the last feature)
-      ps.toolchangeInsertionPoint = ps.features[0].start
-
-  # Check if this is the last feature and all available prime towers have not been used yet. Set toolchange insert to be at layer end
-  if len(ps.features) == 0 and len(ps.primeTowerFeatures) > 0:
-    print(f"On last feature and {len(ps.primeTowerFeatures)} available prime towers not used. Set toolchange insert at layer end {ps.layerEnd}")
-    ps.toolchangeInsertionPoint = ps.layerEnd
-
-  if ps.height == 0.6 and curFeatureIdx == 5:
-    0==0
-
-  # skip feature original toolchanges and WIPE_END () to end of feature
-  curFeature.skipType = SkipType.FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END
-
-
-# return the current printing color index that should be used for a given color index. Returns the replacement color index for a color index if there is a replacement assigned.
-def currentPrintingColorIndexForColorIndex(colorIndex: int, lc: list[PrintColor]):
-  #print(colorIndex)
-  if lc[colorIndex].replacementColorIndex != -1:
-    return lc[colorIndex].replacementColorIndex
-  else:
-    return colorIndex
+      i -= 1
+    if self._readSpans:
+      self._resolvedSpan = len(self._readSpans) - 1
+      self._resolvedEnd = self._readSpans[-1][1]
+
+def planLayer(f: GcodeReader, currentPrint: PrintState, nextLayerChangeStart: int, configuration: MFMConfiguration, profile: ProcessProfile, statusQueue: ProgressReporter, passthrough: bool = False, keepEdits: bool = True) -> LayerPlan:
+  """Plan the edits that write the current layer from the current file position until the start of the next layer change line. The print state is left the same as after writing the layer. passthrough plans a layer that isPassthroughLayer() accepted without starting every feature. Without keepEdits only the print state is found and the plan has no edits."""
+  with profile.phase(PHASE_PLAN):
+    planner = LayerPlanner(f, currentPrint, nextLayerChangeStart, configuration, profile, statusQueue, keepEdits)
+    return planner.planPassthroughLayer() if passthrough else planner.planLayer()
+
+def renderLayer(f: GcodeReader, out: GcodeWriter, currentPrint: PrintState, nextLayerChangeStart: int, configuration: MFMConfiguration, toolchangeTemplate: ToolchangeTemplate, profile: ProcessProfile, statusQueue: ProgressReporter, passthrough: bool = False) -> bool:
+  """Write the current layer from the current file position until the start of the next layer change line. Returns False if the end of the file was reached instead."""
+  plan = planLayer(f, currentPrint, nextLayerChangeStart, configuration, profile, statusQueue, passthrough)
+  executeLayerPlan(f, out, plan, toolchangeTemplate, profile)
+  return plan.reachedNextLayer
+
+def isPassthroughLayer(ps: PrintState, layerChangeStart: int, nextLayerChangeStart: int) -> bool:
+  """A layer without periodic color is written in its original order. It can be planned as copied from the input instead of stopping at every feature if the process loop would reach every feature start while reading straight through the layer."""
+  if ps.isPeriodicLine or len(ps.primeTowerFeatures) > 0:
+    return False
+  lastFeatureStart = layerChangeStart
+  for feat in ps.features:
+    if feat.start <= lastFeatureStart:
+      return False
+    lastFeatureStart = feat.start
+  if nextLayerChangeStart != None and lastFeatureStart >= nextLayerChangeStart:
+    return False
+  # A layer end before the last feature would be found as a feature stop
+  if ps.layerEnd > layerChangeStart and ps.layerEnd <= lastFeatureStart:
+    return False
+  return True
+
+def writeLayer(f: GcodeReader, out: GcodeWriter, currentPrint: PrintState, nextLayerChangeStart: int, configuration: MFMConfiguration, toolchangeTemplate: ToolchangeTemplate, profile: ProcessProfile, statusQueue: ProgressReporter) -> bool:
+  """Write the layer that starts at the current file position. Returns False if the end of the file was reached."""
+  profile.count(COUNT_LAYERS)
+  with profile.phase(PHASE_WRITE):
+    passthrough = isPassthroughLayer(currentPrint, f.tell(), nextLayerChangeStart)
+    if passthrough:
+      profile.count(COUNT_LAYERS_COPIED)
+    return renderLayer(f, out, currentPrint, nextLayerChangeStart, configuration, toolchangeTemplate, profile, statusQueue, passthrough)
+
+def carriedPrintState(ps: PrintState) -> PrintState:
+  """Copy of the print state values at the end of a layer that the next layer depends on"""
+  carried = PrintState()
+  carried.printingColor = ps.printingColor
+  carried.printingPeriodicColor = ps.printingPeriodicColor
+  carried.lastFeature = copy.copy(ps.lastFeature)
+  carried.featureWipeEndPrime = copy.copy(ps.featureWipeEndPrime)
+  return carried
+
+# Parts each worker process is given. More parts than workers keep every worker busy when parts take different times.
+PARTS_PER_JOB = 4
+
+# Smallest input file in bytes that is processed with more than 1 job. Starting the worker processes and finding the carried print state take longer than the parallel work saves on smaller files. The 1.5 MB dice samples take 0.97 s with --jobs 4 and 0.69 s with 1 job.
+PARALLEL_MIN_INPUT_BYTES = 16 * 1024 * 1024
+
+# Original color of the layers and features of a scanned part before its first toolchange. The layers before the part are not scanned so it is set when the part is joined to the part before it.
+_UNKNOWN_ORIGINAL_COLOR = -2
+
+class LayerRenderJob:
+  """Consecutive layers rendered in a worker process without rendering the layers before them"""
+  def __init__(self, layers: list[PrintState], layerChangeStarts: list[int], lastPrintStates: list[PrintState], colorSchedule: ColorSchedule):
+    self.layers: list[PrintState] = layers
+    """Layers from the layer index"""
+    self.layerChangeStarts: list[int] = layerChangeStarts
+    """Start position of the layer change line of each layer and of the layer after the last layer. None if the last layer ends at the end of the file."""
+    self.lastPrintStates: list[PrintState] = lastPrintStates
+    """Carried print state at the end of the layer before each layer"""
+    self.colorSchedule: ColorSchedule = colorSchedule
+    """Color schedule section of the layers"""
+
+# Per worker process state set by the layer pool initializer
+_workerInput: GcodeReader = None
+_workerConfiguration: MFMConfiguration = None
+_workerToolchangeTemplate: ToolchangeTemplate = None
+_workerProfileEnabled: bool = False
+
+def _initLayerWorker(configuration: MFMConfiguration, profileEnabled: bool):
+  global _workerInput, _workerConfiguration, _workerToolchangeTemplate, _workerProfileEnabled
+  # Layer details are traced once by the main process
+  packageLog = logging.getLogger(__package__)
+  packageLog.setLevel(max(packageLog.getEffectiveLevel(), logging.INFO))
+  _workerInput = GcodeReader(configuration[CONFIG_INPUT_FILE])
+  _workerConfiguration = configuration
+  _workerToolchangeTemplate = ToolchangeTemplate(configuration[CONFIG_TOOLCHANGE_MINIMAL_FILE], configuration[CONFIG_LINE_ENDING])
+  _workerProfileEnabled = profileEnabled
+
+def layerWorkerPool(configuration: MFMConfiguration, jobs: int, profile: ProcessProfile) -> contextlib.AbstractContextManager:
+  """Pool of jobs worker processes that scan and render parts of the input file. None if jobs is 1."""
+  if jobs <= 1:
+    return contextlib.nullcontext()
+  return multiprocessing.Pool(processes=jobs, initializer=_initLayerWorker, initargs=(configuration, profile.enabled))
+
+def _scanLayerPartJob(part: tuple[int, int | None]) -> tuple[list[tuple[int, PrintState]], int | None, ProcessProfile]:
+  start, end = part
+  profile = ProcessProfile(enabled=_workerProfileEnabled)
+  linesRead = _workerInput.linesRead
+  lastPrintState = None
+  if start > 0:
+    lastPrintState = PrintState()
+    lastPrintState.originalColor = _UNKNOWN_ORIGINAL_COLOR
+  layers = []
+  with profile.phase(PHASE_LAYER_DISCOVERY):
+    scan = scanLayers(_workerInput, _workerConfiguration[CONFIG_GCODE_FLAVOR], None, profile, start, end, lastPrintState)
+    while True:
+      try:
+        layers.append(next(scan))
+      except StopIteration as stop:
+        nextLayerChangeStart = stop.value
+        break
+  profile.count(COUNT_LINES_READ, _workerInput.linesRead - linesRead)
+  return layers, nextLayerChangeStart, profile
+
+def layerScanParts(f: GcodeReader, parts: int) -> list[tuple[int, int | None]]:
+  """Start and end of about parts parts of the file with the same size. Each part after the first starts at a layer change line and each part ends where the next part starts or at None for the end of the file."""
+  starts = [0]
+  firstLayerChangeStart = f.searchStart(LAYER_CHANGE_LINE_RE, 0)
+  if firstLayerChangeStart >= 0:
+    for i in range(1, parts):
+      # The first part has at least the first layer
+      start = f.searchStart(LAYER_CHANGE_LINE_RE, max(f.size * i // parts, firstLayerChangeStart + 1))
+      if start < 0:
+        break
+      if start > starts[-1]:
+        starts.append(start)
+  return list(zip(starts, starts[1:] + [None]))
+
+def joinLayerScanPart(layers: list[tuple[int, PrintState]], lastLayer: PrintState):
+  """Set the state that the layers of a scanned part take from the last layer of the part before it"""
+  originalColor = lastLayer.layerEndOriginalColor if lastLayer.layerEndOriginalColor > -1 else lastLayer.originalColor
+  layers[0][1].previousLayerHeight = lastLayer.layerHeight
+  for _, layer in layers:
+    if layer.originalColor == _UNKNOWN_ORIGINAL_COLOR:
+      layer.originalColor = originalColor
+    for feat in layer.features:
+      if feat.originalColor == _UNKNOWN_ORIGINAL_COLOR:
+        feat.originalColor = originalColor
+    if layer.layerEndOriginalColor == _UNKNOWN_ORIGINAL_COLOR:
+      layer.layerEndOriginalColor = originalColor
+    elif layer.layerEndOriginalColor > -1:
+      # A toolchange was found so the layers after it do not depend on the part before
+      break
+
+def buildLayerIndexInParallel(f: GcodeReader, gf: str, pool: multiprocessing.pool.Pool, parts: int, statusQueue: ProgressReporter, profile: ProcessProfile) -> LayerIndex:
+  """Scan the file for layers and features in a pool of worker processes. The file is split into parts at layer change lines and each part is scanned without the layers before it. The parts are joined in order. The file is scanned in order by buildLayerIndex() instead if the layers of a part do not end where the next part starts."""
+  layerIndex = LayerIndex(f)
+  lastLayer: PrintState = None
+  scanParts = layerScanParts(f, parts)
+  joined = True
+  with profile.phase(PHASE_LAYER_DISCOVERY):
+    for (start, end), (layers, nextLayerChangeStart, partProfile) in zip(scanParts, pool.imap(_scanLayerPartJob, scanParts)):
+      profile.mergeWorker(partProfile)
+      if nextLayerChangeStart != end or (start > 0 and lastLayer == None):
+        log.debug("Layer scan part at %d ended at %s instead of %s", start, nextLayerChangeStart, end)
+        joined = False
+        break
+      if start > 0:
+        joinLayerScanPart(layers, lastLayer)
+      for layerChangeStart, layer in layers:
+        layerIndex.addLayer(layerChangeStart, layer)
+      if layers:
+        lastLayer = layers[-1][1]
+        if statusQueue:
+          statusQueue.progress(end if end != None else f.size, f.size, f"Current Layer {lastLayer.height}", "Analyzing")
+  if not joined:
+    return buildLayerIndex(f, gf, statusQueue, profile)
+  return layerIndex
+
+def _renderLayerPartJob(job: LayerRenderJob) -> tuple[bytes, ProcessProfile]:
+  profile = ProcessProfile(enabled=_workerProfileEnabled)
+  linesRead = _workerInput.linesRead
+  buffer = io.BytesIO()
+  out = GcodeWriter(buffer, _workerConfiguration[CONFIG_LINE_ENDING])
+  for layerNum, layer in enumerate(job.layers):
+    currentPrint = startLayer(layer, layerNum, job.lastPrintStates[layerNum], job.colorSchedule, profile)
+    _workerInput.seek(job.layerChangeStarts[layerNum], os.SEEK_SET)
+    writeLayer(_workerInput, out, currentPrint, job.layerChangeStarts[layerNum+1], _workerConfiguration, _workerToolchangeTemplate, profile, None)
+  profile.count(COUNT_LINES_READ, _workerInput.linesRead - linesRead)
+  profile.count(COUNT_OUTPUT_BYTES, out.bytesCopied + out.bytesWritten)
+  profile.count(COUNT_BYTES_COPIED, out.bytesCopied)
+  profile.count(COUNT_BYTES_REWRITTEN, out.bytesWritten)
+  return buffer.getvalue(), profile
+
+def planCarriedPrintStates(layerIndex: LayerIndex, colorSchedule: ColorSchedule, configuration: MFMConfiguration, currentPrint: PrintState) -> tuple[list[PrintState], PrintState]:
+  """Plan every layer in order without keeping its edits to find the print state carried into each layer. The input file is read with a separate reader so the lines read and position of the reader that writes the output are unchanged. Work done here is counted by the workers that write the layers. Returns the carried print state at the end of the layer before each layer and the print state of the last layer."""
+  layerChangeStarts = layerIndex.layerChangeStarts + [None]
+  lastPrintStates: list[PrintState] = []
+  profile = ProcessProfile(enabled=False)
+  with GcodeReader(configuration[CONFIG_INPUT_FILE]) as f:
+    for layerNum, layer in enumerate(layerIndex.layers):
+      lastPrintStates.append(carriedPrintState(currentPrint))
+      currentPrint = startLayer(layer, layerNum, currentPrint, colorSchedule, profile)
+      f.seek(layerChangeStarts[layerNum], os.SEEK_SET)
+      planLayer(f, currentPrint, layerChangeStarts[layerNum+1], configuration, profile, None, isPassthroughLayer(currentPrint, layerChangeStarts[layerNum], layerChangeStarts[layerNum+1]), keepEdits=False)
+  return lastPrintStates, currentPrint
+
+def renderLayersInParallel(f: GcodeReader, out: GcodeWriter, layerIndex: LayerIndex, colorSchedule: ColorSchedule, configuration: MFMConfiguration, toolchangeTemplate: ToolchangeTemplate, profile: ProcessProfile, pool: multiprocessing.pool.Pool, parts: int, statusQueue: ProgressReporter) -> PrintState:
+  """Render layers in a pool of worker processes. The print state carried from one layer to the next is found first by planning every layer without keeping its edits. Parts of consecutive layers are then planned and written again from their carried state in parallel and written to the output in order. Returns the print state of the last layer."""
+  layers = layerIndex.layers
+  layerChangeStarts = layerIndex.layerChangeStarts + [None]
+
+  # Header before the first layer
+  currentPrint = PrintState()
+  with profile.phase(PHASE_WRITE):
+    renderLayer(f, out, currentPrint, layerChangeStarts[0], configuration, toolchangeTemplate, profile, statusQueue)
+
+  with profile.phase(PHASE_CARRIED_STATE):
+    lastPrintStates, currentPrint = planCarriedPrintStates(layerIndex, colorSchedule, configuration, currentPrint)
+
+  if statusQueue:
+    item = StatusQueueItem()
+    item.statusRight = f"Writing with {configuration[CONFIG_JOBS]} jobs"
+    statusQueue.put(item=item)
+
+  # Parts of about the same number of bytes
+  partStarts = sorted({min(bisect.bisect_left(layerIndex.layerChangeStarts, f.size * i // parts), len(layers) - 1) for i in range(parts)})
+  renderJobs = [LayerRenderJob(layers[first:last], layerChangeStarts[first:last+1], lastPrintStates[first:last], colorSchedule.section(first, last)) for first, last in zip(partStarts, partStarts[1:] + [len(layers)])]
+  for job, (partBytes, partProfile) in zip(renderJobs, pool.imap(_renderLayerPartJob, renderJobs)):
+    out.writeRendered(partBytes)
+    profile.mergeWorker(partProfile)
+    if statusQueue:
+      layer = job.layers[-1]
+      statusQueue.progress(layer.layerStart, f.size, f"Current Layer {layer.height}")
+
+  return currentPrint
+
+def renderLayersFromStream(f: GcodeStreamReader, out: GcodeWriter, configuration: MFMConfiguration, toolchangeTemplate: ToolchangeTemplate, profile: ProcessProfile, statusQueue: ProgressReporter) -> PrintState:
+  """Write each layer as soon as the layer after it is found and then release it from memory. Only the header with the first layer, or a layer and the layer after it, are held in memory at once. Returns the print state of the last layer."""
+  layers = scanLayers(f, configuration[CONFIG_GCODE_FLAVOR], statusQueue, profile)
+  with profile.phase(PHASE_LAYER_DISCOVERY):
+    pending = next(layers, None)
+  # The color schedule grows as each layer is found
+  colorSchedule = ColorSchedule(configuration[CONFIG_PERIODIC_COLORS], configuration[CONFIG_REPLACEMENT_COLORS])
+  layerNum = 0
+
+  # Header before the first layer
+  currentPrint = PrintState()
+  f.seek(0, os.SEEK_SET)
+  with profile.phase(PHASE_WRITE):
+    renderLayer(f, out, currentPrint, pending[0] if pending else None, configuration, toolchangeTemplate, profile, statusQueue)
+
+  while pending:
+    layerChangeStart, layer = pending
+    following = None
+    # The next layer change is the layer end unless the layer scan stopped early
+    nextLayerChangeStart = layer.layerEnd if layer.layerEnd > 0 else None
+    if nextLayerChangeStart == None:
+      with profile.phase(PHASE_LAYER_DISCOVERY):
+        following = next(layers, None)
+      nextLayerChangeStart = following[0] if following else None
+
+    colorSchedule.extend([layer.height], [layer.layerHeight], [layer.previousLayerHeight])
+    currentPrint = startLayer(layer, layerNum, currentPrint, colorSchedule, profile)
+    layerNum += 1
 
-def writeWithFilters(out: typing.TextIO, cl: str, lc: list[PrintColor]):
-  cmdColorIndex = -1
-  #print(f"writewithcolorfilter {cl}")
-  #look for color specific matches to find the original color to check for replacement colors
-  m620Match = re.match(M620, cl)
-  toolchangeMatch = re.match(TOOLCHANGE_T, cl)
-  m621Match = re.match(M621, cl)
-
-  if m620Match:
-    cmdColorIndex = int(m620Match.groups()[0])
-  elif toolchangeMatch:
-    cmdColorIndex = int(toolchangeMatch.groups()[0])
-  elif m621Match:
-    cmdColorIndex = int(m621Match.groups()[0])
-
-  if cmdColorIndex != -1:
-    cl = substituteNewColor(cl, currentPrintingColorIndexForColorIndex(cmdColorIndex,lc))
-  
-  out.write(cl)
-
-def process(configuration: MFMConfiguration, statusQueue: queue.Queue):
+    if statusQueue:
+      item = StatusQueueItem()
+      item.statusLeft = f"Current Layer {currentPrint.height}"
+      item.statusRight = f"Writing"
+      statusQueue.put(item=item)
+
+    f.seek(layerChangeStart, os.SEEK_SET)
+    writeLayer(f, out, currentPrint, nextLayerChangeStart, configuration, toolchangeTemplate, profile, statusQueue)
+    if nextLayerChangeStart != None:
+      f.release(nextLayerChangeStart)
+
+    if following == None:
+      with profile.phase(PHASE_LAYER_DISCOVERY):
+        following = next(layers, None)
+    pending = following
+
+  return currentPrint
+
+def findLayerIndex(f: GcodeReader, configuration: MFMConfiguration, statusQueue: ProgressReporter, profile: ProcessProfile, pool: multiprocessing.pool.Pool = None) -> LayerIndex:
+  """Load the layer index saved by a previous run if CONFIG_LAYER_INDEX is set and it matches the file. Otherwise scan the file for the layer index in the pool of layer workers if there is one."""
+  layerIndex = None
+  layerIndexFile = layerIndexFilename(configuration[CONFIG_INPUT_FILE])
+  if configuration.get(CONFIG_LAYER_INDEX):
+    with profile.phase(PHASE_LAYER_INDEX_LOAD):
+      layerIndex = loadLayerIndex(layerIndexFile, f)
+    if layerIndex:
+      log.info("Loaded layer index %s", layerIndexFile)
+  if layerIndex == None:
+    if pool:
+      layerIndex = buildLayerIndexInParallel(f, configuration[CONFIG_GCODE_FLAVOR], pool, configuration[CONFIG_JOBS] * PARTS_PER_JOB, statusQueue, profile)
+    else:
+      layerIndex = buildLayerIndex(f, configuration[CONFIG_GCODE_FLAVOR], statusQueue, profile)
+    if configuration.get(CONFIG_LAYER_INDEX):
+      saveLayerIndex(layerIndex, layerIndexFile)
+      log.info("Saved layer index %s", layerIndexFile)
+  return layerIndex
+
+def planColorSchedules(configurations: list[MFMConfiguration], statusQueue: queue.Queue) -> list[ColorSchedule]:
+  """Color schedule of each configuration for the same input G-code file without writing any G-code"""
+  profile = ProcessProfile(enabled=False)
+  statusQueue = progressReporter(statusQueue, configurations[0])
+  inputFile = configurations[0][CONFIG_INPUT_FILE]
+  with openGcodeReader(inputFile) as f:
+    if isStreamedGcodeFile(inputFile):
+      layers = []
+      for layerChangeStart, layer in scanLayers(f, configurations[0][CONFIG_GCODE_FLAVOR], statusQueue, profile):
+        layers.append(layer)
+        # Only the layer heights are needed so the layer can be dropped from memory
+        f.release(layerChangeStart)
+    else:
+      layers = findLayerIndex(f, configurations[0], statusQueue, profile).layers
+  if statusQueue:
+    statusQueue.flush()
+  return [buildColorSchedule(layers, configuration[CONFIG_PERIODIC_COLORS], configuration[CONFIG_REPLACEMENT_COLORS]) for configuration in configurations]
+
+def planLayerEdits(configurations: list[MFMConfiguration], statusQueue: queue.Queue) -> list[list[LayerPlan]]:
+  """Layer plans of each configuration for the same input G-code file without writing any G-code. The first plan of each configuration is the header before the first layer. The layers are planned in order so a G-code file read one layer at a time cannot be planned again for each configuration."""
+  profile = ProcessProfile(enabled=False)
+  inputFile = configurations[0][CONFIG_INPUT_FILE]
+  if isStreamedGcodeFile(inputFile):
+    raise ValueError(f"Layer plans cannot be found for {inputFile} because it is read one layer at a time")
+  statusQueue = progressReporter(statusQueue, configurations[0])
+  plans: list[list[LayerPlan]] = []
+  with openGcodeReader(inputFile) as f:
+    layerIndex = findLayerIndex(f, configurations[0], statusQueue, profile)
+    if statusQueue:
+      statusQueue.flush()
+    layerChangeStarts = layerIndex.layerChangeStarts
+    for configuration in configurations:
+      colorSchedule = buildColorSchedule(layerIndex.layers, configuration[CONFIG_PERIODIC_COLORS], configuration[CONFIG_REPLACEMENT_COLORS])
+      currentPrint = PrintState()
+      f.seek(0, os.SEEK_SET)
+      layerPlans = [planLayer(f, currentPrint, layerChangeStarts[0] if len(layerChangeStarts) > 0 else None, configuration, profile, None)]
+      layerNum = 0
+      while layerPlans[-1].reachedNextLayer:
+        currentPrint = startLayer(layerIndex.layers[layerNum], layerNum, currentPrint, colorSchedule, profile)
+        nextLayerChangeStart = layerChangeStarts[layerNum+1] if layerNum+1 < len(layerChangeStarts) else None
+        f.seek(layerChangeStarts[layerNum], os.SEEK_SET)
+        layerPlans.append(planLayer(f, currentPrint, nextLayerChangeStart, configuration, profile, None, isPassthroughLayer(currentPrint, layerChangeStarts[layerNum], nextLayerChangeStart)))
+        layerNum += 1
+      plans.append(layerPlans)
+  return plans
+
+def progressReporter(statusQueue: queue.Queue, configuration: MFMConfiguration) -> ProgressReporter:
+  """Status queue that sends status updates at most CONFIG_PROGRESS_RATE times per second. None if there is no status queue."""
+  if statusQueue == None or isinstance(statusQueue, ProgressReporter):
+    return statusQueue
+  return ProgressReporter(statusQueue, configuration.get(CONFIG_PROGRESS_RATE, PROGRESS_RATE))
+
+def process(configuration: MFMConfiguration, statusQueue: queue.Queue) -> ProcessProfile:
+  """Post process the input G-code file to the output G-code file. STDIO_FILENAME as the input or output file reads from standard input or writes to standard output. Files ending in GZIP_EXTENSION or GCODE_3MF_EXTENSION are read and written as compressed G-code or a Bambu plate package."""
+  return processVariants([configuration], statusQueue)[0]
+
+def processVariants(configurations: list[MFMConfiguration], statusQueue: queue.Queue) -> list[ProcessProfile]:
+  """Post process the same input G-code file once for each configuration. Configurations differ in the output file and options. The layer and feature analysis is done once and shared so each extra variant only costs writing its output. Compressed and package inputs are read again for each variant. Returns the profile of each variant and the analysis is counted in the profile of the first variant."""
+  inputFile = configurations[0][CONFIG_INPUT_FILE]
+  if any(configuration[CONFIG_INPUT_FILE] != inputFile for configuration in configurations):
+    raise ValueError("Every variant must post process the same input G-code file")
+  if len(configurations) > 1 and (inputFile == STDIO_FILENAME or any(configuration[CONFIG_OUTPUT_FILE] == STDIO_FILENAME for configuration in configurations)):
+    raise ValueError("Standard input and standard output can only be used with 1 variant")
+
+  statusQueue = progressReporter(statusQueue, configurations[0])
+  layerIndex = None
+  profiles: list[ProcessProfile] = []
+  for configuration in configurations:
+    if configuration[CONFIG_OUTPUT_FILE] == STDIO_FILENAME:
+      # Printed status cannot share standard output with the G-code
+      output = sys.stdout.buffer
+      with contextlib.redirect_stdout(sys.stderr):
+        profile, layerIndex = _process(configuration, statusQueue, output, layerIndex)
+    else:
+      profile, layerIndex = _process(configuration, statusQueue, configuration[CONFIG_OUTPUT_FILE], layerIndex)
+    profiles.append(profile)
+  if statusQueue:
+    statusQueue.flush()
+  return profiles
+
+def _process(configuration: MFMConfiguration, statusQueue: ProgressReporter, output: str | typing.BinaryIO, layerIndex: LayerIndex = None) -> tuple[ProcessProfile, LayerIndex]:
+  """Post process with the layer index of the input file if it was already built. Returns the profile and the layer index so it can be reused for another variant."""
   startTime = time.monotonic()
+  profile = ProcessProfile(enabled=configuration.get(CONFIG_PROFILE, False))
+  streamInput = isStreamedGcodeFile(configuration[CONFIG_INPUT_FILE])
   try:
-    with open(configuration[CONFIG_INPUT_FILE], mode='r') as f, open(configuration[CONFIG_OUTPUT_FILE], mode='w') as out:
+    # Load the toolchange once per run and stop before writing any output if it cannot be used
+    toolchangeTemplate = ToolchangeTemplate(configuration[CONFIG_TOOLCHANGE_MINIMAL_FILE], configuration[CONFIG_LINE_ENDING])
+    with openGcodeReader(configuration[CONFIG_INPUT_FILE]) as f, openGcodeWriter(output, configuration[CONFIG_LINE_ENDING], configuration[CONFIG_INPUT_FILE]) as out:
       # Persistent variables for the read loop
       
       # The current print state
       currentPrint: PrintState = PrintState()
 
       #Get total length of file
-      f.seek(0, os.SEEK_END)
-      lp = f.tell()
-      f.seek(0, os.SEEK_SET)
-      
-      curFeatureIdx = -1
-      curFeature = None
+      lp = f.size
 
-      # Current line buffer
-      cl = True
-      while cl:
-        cl = f.readline()
-        #clsp = f.tell() - len(cl) - (len(lineEnding)-1) # read line start position
-        cp = f.tell() # position is start of next line after read line. We define in lower scope function as needed for retention.
+      # A stream is written layer by layer while it is read
+      if streamInput:
+        currentPrint = renderLayersFromStream(f, out, configuration, toolchangeTemplate, profile, statusQueue)
+        profile.count(COUNT_STREAM_PEAK_BUFFER_BYTES, f.peakBufferSize)
+      else:
+        # Worker processes scan and write parts of the file with more than 1 job
+        jobs = configuration.get(CONFIG_JOBS) or 1
+        if jobs > 1 and f.size < PARALLEL_MIN_INPUT_BYTES:
+          log.info("Input G-code file is smaller than %d MB so it is processed with 1 job instead of %d", PARALLEL_MIN_INPUT_BYTES // (1024 * 1024), jobs)
+          jobs = 1
+        with layerWorkerPool(configuration, jobs, profile) as pool:
+          # Find all layers and features. Reuse the layer index from a previous variant or a previous run on the same file if available.
+          if layerIndex == None:
+            layerIndex = findLayerIndex(f, configuration, statusQueue, profile, pool)
+          f.seek(0, os.SEEK_SET)
+          colorSchedule = buildColorSchedule(layerIndex.layers, configuration[CONFIG_PERIODIC_COLORS], configuration[CONFIG_REPLACEMENT_COLORS])
+
+          if pool and len(layerIndex.layers) > 0:
+            currentPrint = renderLayersInParallel(f, out, layerIndex, colorSchedule, configuration, toolchangeTemplate, profile, pool, configuration[CONFIG_JOBS] * PARTS_PER_JOB, statusQueue)
+          else:
+            layerChangeStarts = layerIndex.layerChangeStarts
+            # Write the header and then every layer in order. A layer ends where the next layer change line starts.
+            with profile.phase(PHASE_WRITE):
+              foundLayer = renderLayer(f, out, currentPrint, layerChangeStarts[0] if len(layerChangeStarts) > 0 else None, configuration, toolchangeTemplate, profile, statusQueue)
+            layerNum = 0
+            while foundLayer:
+              currentPrint = startLayer(layerIndex.layers[layerNum], layerNum, currentPrint, colorSchedule, profile)
 
-        currentPrint.skipWriteForCurrentLine = False
+              if statusQueue:
+                statusQueue.progress(currentPrint.layerStart, lp, f"Current Layer {currentPrint.height}", "Writing")
 
-        if f.tell() == 30440:
-          0==0
-
-        # Update current print state variables
-        updatePrintState(ps=currentPrint, cl=cl, sw=currentPrint.skipWrite, cp=cp)
-      
-        # If no more features left in stackcheck for new layers
-        # Look for start of a layer CHANGE_LAYER
-        if len(currentPrint.features) == 0:
-          # If no more features and we are at a stop position write the read line and jump to layer end (cursor at start of CHANGE_LAYER line). This is needed required for the case where the last feature original position is not last in the original file. But we write the current last line and seek to layer end everytime so that we can continue the loop without figuring out if write the previous line found after found new layer because we did it here.
-          if f.tell() in currentPrint.stopPositions:
-            if not currentPrint.skipWrite:
-              writeWithFilters(out, cl, loadedColors)
-            f.seek(currentPrint.layerEnd, os.SEEK_SET)
-
-          # Save current pos for restore since findChangeLayer() will change pos
-          cp = f.tell()
-
-          if currentPrint.height == 2.0:
-            0==0
-
-          foundNewLayer = findChangeLayer(f,lastPrintState=currentPrint, gf=configuration[CONFIG_GCODE_FLAVOR], pcs=configuration[CONFIG_PERIODIC_COLORS], rcs=configuration[CONFIG_REPLACEMENT_COLORS], le=configuration[CONFIG_LINE_ENDING])
-          if foundNewLayer:
-            currentPrint = foundNewLayer
-
-            if statusQueue:
-              item = StatusQueueItem()
-              item.statusLeft = f"Current Layer {currentPrint.height}"
-              item.statusRight = f"Analyzing"
-              item.progress = cp/lp * 100
-              statusQueue.put(item=item)
-
-            findLayerFeatures(f=f, gf=configuration[CONFIG_GCODE_FLAVOR], printState=currentPrint, pcs=configuration[CONFIG_PERIODIC_COLORS], le=configuration[CONFIG_LINE_ENDING])
-            # Save reference to last original feature in case it originally continues to next layer
-            if len(currentPrint.features) > 0:
-              currentPrint.lastFeature = currentPrint.features[len(currentPrint.features)-1]
-            reorderFeatures(ps=currentPrint)
-
-            curFeature = None
-            curFeatureIdx = -1
-            
-            currentPrint.skipWrite = False
-
-            # Check if toolchange needed for "next" feature which is index 0
-            nextFeatureNeedsToolchange, _, passedNonTCPrimeTowers = determineIfNextFeatureNeedsToolchange(ps=currentPrint, cfi=-1)
-            if nextFeatureNeedsToolchange: #if printing color before and printing color in next feature do not match, insert a toolchange at start of next feature (or at layer end if this is the last feature)
-              if curFeatureIdx+passedNonTCPrimeTowers+1 < len(currentPrint.features):
-                currentPrint.toolchangeInsertionPoint = currentPrint.features[curFeatureIdx+passedNonTCPrimeTowers+1].start
-              else:
-                currentPrint.toolchangeInsertionPoint = currentPrint.layerEnd
-
-            if statusQueue:
-              item = StatusQueueItem()
-              item.statusRight = f"Writing"
-              item.progress = (currentPrint.layerStart+((currentPrint.layerEnd-currentPrint.layerStart)/2))/lp * 100
-              statusQueue.put(item=item)
-            # join to debug thread queue reading
-            #statusQueue.join()
-            
-          f.seek(cp, os.SEEK_SET)
-
-          # We wrote last line in previous layer (readline for this loop) already if the last feature. 
-          if foundNewLayer:
-            continue
-
-        else: # look for feature stop
-          if cp in currentPrint.stopPositions: # find a stop position to "start" a new feature
-            currentPrint.stopPositions.remove(cp)
-            curFeature = currentPrint.features.pop(0)
-            curFeatureIdx += 1
-
-            #print(f"Starting feature index {curFeatureIdx} {curFeature.featureType} seek to position {curFeature.start}")
-
-            if statusQueue:
-              item = StatusQueueItem()
-              item.statusRight = f"{curFeature.featureType} Writing"
-              statusQueue.put(item=item)
-
-            f.seek(curFeature.start, os.SEEK_SET) # Seek to the start of top feature in the feature list
-            startNewFeature(configuration[CONFIG_GCODE_FLAVOR], currentPrint, f, out, cl, configuration[CONFIG_TOOLCHANGE_MINIMAL_FILE], configuration[CONFIG_PERIODIC_COLORS], curFeature, curFeatureIdx)
-        
-        # Start skip if feature.toolchange is reached and we marked feature as needing original toolchange skipped
-        if curFeature and curFeature.skipType == SkipType.FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END:
-          if curFeature.toolchange and f.tell() == curFeature.toolchange.start:
-            #print(f"Current feature toolchange is redundant. Skipping feature toolchange. Start skip at {f.tell()}")
-            out.write("; MFM Original Feature Toolchange skipped\n")
-            currentPrint.skipWrite = True
-            #print(f"start feature toolchange skip ")
-          
-          if curFeature.wipeEnd and f.tell() == curFeature.wipeEnd.start and curFeature.featureType not in RETAIN_WIPE_END_FEATURE_TYPES:
-            writeWithFilters(out, cl, loadedColors)
-            #print(f"Skipping feature WIPE_END. Start skip at {f.tell()}")
-            out.write(";WIPE_END placeholder for PrusaSlicer Gcode Viewer\n")
-            out.write("; WIPE_END placeholder for BambuStudio Gcode Preview\n")
-            out.write("; MFM Original WIPE_END skipped\n")
-            currentPrint.skipWrite = True
-            # Reference original pos as last wipe end pos for next layer
-            currentPrint.featureWipeEndPrime = currentPrint.originalPosition
-            
-
-        # Write current line
-        if currentPrint.skipWrite == False and currentPrint.skipWriteForCurrentLine == False: 
-          #out.write(cl)
-          writeWithFilters(out, cl, loadedColors)
-
-        if currentPrint.skipWriteForCurrentLine == True:
-          currentPrint.skipWrite = False
-          currentPrint.skipWriteForCurrentLine = False
+              layerNum += 1
+              foundLayer = writeLayer(f, out, currentPrint, layerChangeStarts[layerNum] if layerNum < len(layerChangeStarts) else None, configuration, toolchangeTemplate, profile, statusQueue)
 
       out.write(f'Post Processed with {configuration[CONFIG_APP_NAME]} {configuration[CONFIG_APP_VERSION]}')
 
+      profile.count(COUNT_INPUT_BYTES, f.size)
+      profile.count(COUNT_OUTPUT_BYTES, out.bytesCopied + out.bytesWritten)
+      profile.count(COUNT_LINES_READ, f.linesRead)
+      profile.count(COUNT_BYTES_COPIED, out.bytesCopied)
+      profile.count(COUNT_BYTES_REWRITTEN, out.bytesWritten)
+
       if statusQueue:
         item = StatusQueueItem()
         item.statusLeft = f"Current Layer {currentPrint.height}"
         item.statusRight = f"Completed in {str(datetime.timedelta(seconds=time.monotonic()-startTime))}s"
         item.progress = 99.99
-        statusQueue.put(item=item)
+        statusQueue.put(item=item, force=True)
   except PermissionError as e:
     if statusQueue:
       item = StatusQueueItem()
       item.statusRight = f"Failed to open {e}"
-      statusQueue.put(item=item)
\ No newline at end of file
+      statusQueue.put(item=item, force=True)
+    if configuration.get(CONFIG_RAISE_ERRORS):
+      raise
+  except (ToolchangeTemplateError, GcodePackageError) as e:
+    log.exception(e)
+    if statusQueue:
+      item = StatusQueueItem()
+      item.statusRight = f"{e}"
+      statusQueue.put(item=item, force=True)
+    if configuration.get(CONFIG_RAISE_ERRORS):
+      raise
+
+  profile.totalTime = time.monotonic() - startTime
+  return profile, layerIndex
\ No newline at end of file
@@ -0,0 +1,93 @@
+import copy, logging, re
+
+from .printing_classes import *
+from .line_classifier import *
+from .gcode_file import *
+
+log = logging.getLogger(__name__)
+
+# Finds the lines in a span of raw file bytes that can change the position (G0-G3 moves and M204 acceleration). Matches the lines classifyLine() tags as LineKind.MOVE or LineKind.ACCELERATION.
+POSITION_LINE_RE = re.compile(rb'^(?:G[0-3] |M204)', re.MULTILINE)
+
+# Update position state
+def checkAndUpdatePosition(cl: str, pp: Position, kind: LineKind):
+  # look for movement gcode and record last position before entering a feature
+  if kind == LineKind.MOVE:
+    movementMatch = MOVEMENT_G_RE.match(cl)
+    movementGroups = movementMatch.groups()
+    m = 0
+    travelMove = True
+    while m+1 < len(movementGroups):
+      if movementGroups[m] == None:
+        break
+      axis = movementGroups[m]
+      axisValue = float(movementGroups[m+1])
+      m += 2
+      if axis == 'X':
+        pp.X = axisValue
+      elif axis == 'Y':
+        pp.Y = axisValue
+      elif axis == 'Z':
+        pp.Z = axisValue
+      elif axis == 'I' or axis == 'J' or axis == 'P' or axis == 'R':
+        continue
+      elif axis == 'E':
+        pp.E = axisValue
+        travelMove = False
+      elif axis == 'F':
+        pp.F = axisValue
+      else:
+        log.debug("Unknown movement/feedrate axis %s %s for input %s", axis, axisValue, cl)
+      
+    # If this move did not have extrusion, save the Feedrate as last travel speed
+    if travelMove:
+      if hasattr(pp, 'F'):
+        pp.FTravel = pp.F
+
+  elif kind == LineKind.ACCELERATION:
+    #look for acceleration gcode
+    accelerationMatch = ACCELERATION_M_RE.match(cl)
+    if accelerationMatch:
+      accelerationGroups = accelerationMatch.groups()
+      m = 0
+      while m+1 < len(accelerationGroups):
+        if accelerationGroups[m] == None:
+          break
+        axis = accelerationGroups[m]
+        axisValue = float(accelerationGroups[m+1])
+        m += 2
+        if axis == 'P':
+          pp.P = axisValue
+        elif axis == 'R':
+          pp.R = axisValue
+        elif axis == 'T':
+          pp.T = axisValue
+        elif axis == 'S':
+          pp.P = pp.T = axisValue
+        else:
+          log.debug("Unknown accleration axis %s %s for input %s", axis, axisValue, cl)
+
+class LayerPositions:
+  """Position, feedrate and acceleration at the start of each feature of a layer found on demand. The layer scan does not parse movement lines. They are only parsed from the start of the feature scan up to the furthest feature start asked for, so the movement lines of most layers are never parsed."""
+
+  def __init__(self, featureScanStart: int, featureStarts: list[int]):
+    self._featureStarts: list[int] = sorted(featureStarts)
+    self._nextFeature: int = 0
+    """Index of the first feature start that is not resolved yet"""
+    self._cursor: int = featureScanStart
+    """Lines before the cursor were parsed"""
+    self._position: Position = Position()
+    self._positions: dict[int, Position] = {}
+
+  def positionAt(self, f: GcodeReader, featureStart: int) -> Position:
+    """Position after the first line of the feature that starts at featureStart. This is the position when the feature was found by the layer scan."""
+    while featureStart not in self._positions and self._nextFeature < len(self._featureStarts):
+      stop = self._featureStarts[self._nextFeature]
+      self._nextFeature += 1
+      # The first line of the feature can also change the position when an M204 line starts the feature
+      for lineStart in f.matchStarts(POSITION_LINE_RE, self._cursor, stop) + [stop]:
+        cl = f.lineAt(lineStart)
+        checkAndUpdatePosition(cl=cl, pp=self._position, kind=classifyLine(cl))
+      self._cursor = stop + 1
+      self._positions[stop] = copy.copy(self._position)
+    return self._positions.get(featureStart, Position())
@@ -1,15 +1,23 @@
-import enum
+import bisect, enum, typing
 
 class StatusQueueItem:
   "Status Queue Item properties to send to the user."
+  FIELDS = ('statusLeft', 'statusRight', 'progress', 'bytesPerSecond', 'etaSeconds')
+
   def __init__(self):
     self.statusLeft = None
     self.statusRight = None
     self.progress = None
+    self.bytesPerSecond: float = None
+    """Input G-code bytes processed per second in the current pass over the file"""
+    self.etaSeconds: float = None
+    """Estimated seconds left in the current pass over the file"""
 
 # Position
 class Position:
-  """Position, Feedrate, and Acceleration values for printing"""
+  """Position, Feedrate, and Acceleration values for printing. A value is not set until it is found so hasattr() tells if it is known."""
+  __slots__ = ('X', 'Y', 'Z', 'E', 'F', 'FTravel', 'P', 'R', 'T')
+
   def __init__(self):
     # Position
     self.X: float
@@ -44,6 +52,40 @@ class SkipType(enum.Enum):
   FEATURE_ORIG_TOOLCHANGE_AND_WIPE_END = enum.auto()
   """The original toolchange and Wipe End within a feature."""
 
+class StopPositions:
+  """Stop positions for the process() loop. Membership is constant time. A position can be added more than once and is a stop until it is removed as many times. The distinct positions are also kept in order so the next stop after a position can be found without checking every line."""
+
+  def __init__(self, positions: typing.Iterable[int] = ()):
+    self._counts: dict[int, int] = {}
+    self._ordered: list[int] = []
+    for pos in positions:
+      self.append(pos)
+
+  def append(self, pos: int):
+    count = self._counts.get(pos, 0)
+    if count == 0:
+      bisect.insort(self._ordered, pos)
+    self._counts[pos] = count + 1
+
+  def remove(self, pos: int):
+    count = self._counts[pos]
+    if count == 1:
+      del self._counts[pos]
+      del self._ordered[bisect.bisect_left(self._ordered, pos)]
+    else:
+      self._counts[pos] = count - 1
+
+  def nextAfter(self, pos: int) -> int | None:
+    """First stop position after pos or None"""
+    i = bisect.bisect_right(self._ordered, pos)
+    return self._ordered[i] if i < len(self._ordered) else None
+
+  def __contains__(self, pos: int) -> bool:
+    return pos in self._counts
+
+  def __len__(self) -> int:
+    return sum(self._counts.values())
+
 # State of current Print FILE
 class PrintState:
   """The current state of the processed G-code file."""
@@ -79,22 +121,34 @@ class PrintState:
     """last layer was PeriodicColor?"""
     self.isPeriodicLine: bool = False
     """is this layer supposed to have periodic lines?"""
+    self.periodicColor: PeriodicColor = None
+    """PeriodicColor of the isoline on this layer"""
 
     # Movement info
     self.originalPosition: Position = Position() # Restore original XYZ position after inserting a TC. Then do E2 for minimal TC. Full Prime tower TC already does E.8
     """The position of the extruder in the original print file."""
+    self.featureScanStart: int = 0
+    """The character position where the layer scan started looking for features. The start position of each feature is found from the lines after it."""
+    self.featurePositions: 'LayerPositions' = None
+    """Start positions of the features on the current layer found when a feature position is restored"""
 
     # Prime tower / Toolchange values for current layer
     self.features: list[Feature] = []
     """Printing features found on the current layer"""
     self.primeTowerFeatures: list[Feature] = [] # The available prime tower features.
     """Prime Tower features found on the current layer"""
-    self.stopPositions: list[int] = []
+    self.stopPositions: StopPositions = StopPositions()
     """Stop Positions for process() loop to stop and process next printing feature"""
     self.toolchangeInsertionPoint: int = 0
     """The next toolchange insertion point"""
     self.featureWipeEndPrime: Position = None
     """prime values at end of wipe_end"""
+    self.toolCommandStarts: list[int] = None
+    """Start positions of the M620/T/M621 lines in the layer found by the layer scan. None if the scan did not read the whole layer."""
+    self.toolRemap: list[int] = []
+    """Printing tool index for each original tool index on the current layer"""
+    self.nextFeatureColors: list[int] = [-1]
+    """Target printing color of the next printing feature for each number of features taken from the front of the features list. Found once when the features are ordered."""
 
     #Loop settings
     self.skipWrite: bool = False
@@ -109,11 +163,11 @@ class PrintState:
     #self.skipOriginalToolchangeOnLayer: bool = False
 
 class Feature:
-  """Printing Feature properties"""
+  """Printing Feature properties. There is a Feature for every feature of every layer so the properties are stored in slots instead of a dict."""
+  __slots__ = ('featureType', 'start', 'end', 'toolchange', 'isPeriodicColor', 'originalColor', 'printingColor', 'wipeStart', 'wipeEnd', 'skipType', 'isContinued', 'joinIfContinuedPrimeTower')
 
   def __init__(self):
     """Constructor"""
-    super().__init__()
     self.featureType: str = None
     self.start: int = 0
     self.end: int = 0
@@ -121,10 +175,20 @@ class Feature:
     self.isPeriodicColor: bool = False
     self.originalColor: int = -1
     self.printingColor: int = -1
-    self.startPosition: Position = Position()
     self.wipeStart: Feature = None
     self.wipeEnd: Feature = None
     self.skipType: SkipType = None
+    self.isContinued: bool = False
+    """Feature continues the last feature of the previous layer. The feature type is the previous layer last feature type."""
+    self.joinIfContinuedPrimeTower: bool = False
+    """Prime tower feature that is part of the previous continued feature if the continued feature is a prime tower."""
+
+  def __copy__(self):
+    # Much faster than the generic copy of an object with slots. Every feature is copied each time its layer is printed.
+    feat = Feature.__new__(Feature)
+    for name in Feature.__slots__:
+      setattr(feat, name, getattr(self, name))
+    return feat
 
 class PeriodicColor:
   """A repeating Periodic Color (isoline) properties"""
@@ -136,21 +200,6 @@ class PeriodicColor:
     self.period: float = period
     self.enabledFeatures: list[str] = enabledFeatures
 
-class PrintColor:
-  """Tracks an individual tool and the replacement tool (color) index."""
-  def __init__(self, index=-1, replacementColorIndex=-1, humanColor=None):
-    self.index: int = index
-    self.replacementColorIndex: int = replacementColorIndex #the current replacement color
-    self.humanColor: str = humanColor
-
-loadedColors: list[PrintColor] = [
-  PrintColor(0, -1, 'Base Color'),
-  PrintColor(1, -1, 'River Color'),
-  PrintColor(2, -1, 'Isoline Color'),
-  PrintColor(3, -1, 'High Elevation Color')
-]
-"""All loaded tools (colors)"""
-
 class ReplacementColorAtHeight:
   """A replacement color at height properties"""
   def __init__(self, colorIndex, originalColorIndex, startHeight, endHeight):
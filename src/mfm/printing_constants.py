@@ -6,6 +6,11 @@ CONFIG_TOOLCHANGE_MINIMAL_FILE = 'CONFIG_TOOLCHANGE_MINIMAL_FILE'
 CONFIG_PERIODIC_COLORS = 'CONFIG_PERIODIC_COLORS'
 CONFIG_REPLACEMENT_COLORS = 'CONFIG_REPLACEMENT_COLORS'
 CONFIG_LINE_ENDING = 'CONFIG_LINE_ENDING'
+CONFIG_LAYER_INDEX = 'CONFIG_LAYER_INDEX'
+CONFIG_JOBS = 'CONFIG_JOBS'
+CONFIG_PROFILE = 'CONFIG_PROFILE'
+CONFIG_PROGRESS_RATE = 'CONFIG_PROGRESS_RATE'
+CONFIG_RAISE_ERRORS = 'CONFIG_RAISE_ERRORS'
 CONFIG_APP_NAME = 'CONFIG_APP_NAME'
 CONFIG_APP_VERSION = 'CONFIG_APP_VERSION'
 
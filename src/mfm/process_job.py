@@ -0,0 +1,119 @@
+import multiprocessing, multiprocessing.connection, multiprocessing.synchronize, os, time
+
+from .configuration import *
+from .printing_classes import *
+from .map_post_process import *
+
+PROCESS_JOB_CANCEL_TIMEOUT = 5
+"""Seconds a cancelled job has to stop by itself before its process is terminated"""
+PROCESS_JOB_POLL_LIMIT = 100
+"""Most status updates read by one ProcessJob.poll()"""
+
+class ProcessCancelled(Exception):
+  pass
+
+class ProcessJobResult:
+  """Outcome of a post processing job run in a child process"""
+  def __init__(self, succeeded: bool = False, cancelled: bool = False, error: str = None):
+    self.succeeded: bool = succeeded
+    self.cancelled: bool = cancelled
+    """The job was cancelled and the partial output was deleted"""
+    self.error: str = error
+    """Error that stopped the job"""
+
+class PipeStatusQueue:
+  """Status queue of a job process that sends each status update to the parent process over a pipe. A status update put or checked after the job is cancelled raises ProcessCancelled so the job stops at its next status update."""
+
+  def __init__(self, connection: multiprocessing.connection.Connection, cancelEvent: multiprocessing.synchronize.Event):
+    self._connection = connection
+    self._cancelEvent = cancelEvent
+
+  def checkCancelled(self):
+    """Raise ProcessCancelled if the job was cancelled. Called by ProgressReporter for the status updates it merges instead of sending."""
+    if self._cancelEvent.is_set():
+      raise ProcessCancelled()
+
+  def put(self, item: StatusQueueItem):
+    self.checkCancelled()
+    self._connection.send(item)
+
+def removePartialOutput(fn: str):
+  """Delete the output file left by a job that did not finish"""
+  if fn != STDIO_FILENAME and os.path.isfile(fn):
+    os.remove(fn)
+
+def _runProcessJob(configuration: MFMConfiguration, connection: multiprocessing.connection.Connection, cancelEvent: multiprocessing.synchronize.Event):
+  result = ProcessJobResult()
+  try:
+    process(configuration, PipeStatusQueue(connection, cancelEvent))
+    result.succeeded = True
+  except ProcessCancelled:
+    # The output is closed once the exception leaves process()
+    removePartialOutput(configuration[CONFIG_OUTPUT_FILE])
+    result.cancelled = True
+  except Exception as e:
+    removePartialOutput(configuration[CONFIG_OUTPUT_FILE])
+    result.error = f"{type(e).__name__}: {e}"
+  connection.send(result)
+  connection.close()
+
+class ProcessJob:
+  """Post process in a child process so the caller is not slowed down by the processing. Status updates are sent back over a pipe and read without blocking by poll(), so a GUI can read them from its event loop."""
+
+  def __init__(self, configuration: MFMConfiguration):
+    self.configuration: MFMConfiguration = configuration
+    self.result: ProcessJobResult = None
+    """Outcome of the job once it is done"""
+    self._connection, childConnection = multiprocessing.Pipe(duplex=False)
+    self._cancelEvent = multiprocessing.Event()
+    self._cancelTime: float = None
+    # Not a daemon process so the job can start its own worker processes with CONFIG_JOBS
+    self._process = multiprocessing.Process(target=_runProcessJob, args=(configuration, childConnection, self._cancelEvent))
+    self._process.start()
+    # Only the child process writes to the pipe so reading it ends when the child exits
+    childConnection.close()
+
+  @property
+  def done(self) -> bool:
+    return self.result != None
+
+  def cancel(self):
+    """Ask the job to stop at its next status update and delete the partial output. The job process is terminated if it has not stopped PROCESS_JOB_CANCEL_TIMEOUT seconds later."""
+    if self._cancelTime == None and not self.done:
+      self._cancelEvent.set()
+      self._cancelTime = time.monotonic()
+
+  def terminate(self):
+    """Stop the job process now and delete the partial output"""
+    if self.done:
+      return
+    self._process.terminate()
+    self._finish(ProcessJobResult(cancelled=True))
+
+  def poll(self, limit: int = PROCESS_JOB_POLL_LIMIT) -> list[StatusQueueItem]:
+    """Status updates sent since the last poll, up to limit so a long backlog is read over several polls. result is set once the job is done."""
+    items: list[StatusQueueItem] = []
+    try:
+      while not self.done and len(items) < limit and self._connection.poll():
+        message = self._connection.recv()
+        if isinstance(message, ProcessJobResult):
+          self._finish(message)
+        else:
+          items.append(message)
+    except EOFError:
+      if self._cancelTime != None:
+        self._finish(ProcessJobResult(cancelled=True))
+      else:
+        self._finish(ProcessJobResult(error=f"Post processing stopped with exit code {self._process.exitcode}"))
+
+    if not self.done and self._cancelTime != None and time.monotonic() - self._cancelTime > PROCESS_JOB_CANCEL_TIMEOUT:
+      self.terminate()
+    return items
+
+  def _finish(self, result: ProcessJobResult):
+    self._process.join()
+    self._connection.close()
+    if result.cancelled:
+      # A terminated job cannot delete its own output
+      removePartialOutput(self.configuration[CONFIG_OUTPUT_FILE])
+    self.result = result
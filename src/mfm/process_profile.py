@@ -0,0 +1,159 @@
+import contextlib, json, time
+
+# Phases of process() in the order they are reported
+PHASE_LAYER_INDEX_LOAD = 'layer_index_load'
+PHASE_LAYER_DISCOVERY = 'layer_discovery'
+PHASE_FEATURE_SCAN = 'feature_scan'
+PHASE_REORDER = 'reorder'
+PHASE_CARRIED_STATE = 'carried_state'
+PHASE_PLAN = 'plan'
+PHASE_TOOLCHANGE_INSERTION = 'toolchange_insertion'
+PHASE_PRIME_TOWER_REPLAY = 'prime_tower_replay'
+PHASE_WRITE = 'write'
+
+PHASES = [
+  PHASE_LAYER_INDEX_LOAD,
+  PHASE_LAYER_DISCOVERY,
+  PHASE_FEATURE_SCAN,
+  PHASE_REORDER,
+  PHASE_CARRIED_STATE,
+  PHASE_PLAN,
+  PHASE_TOOLCHANGE_INSERTION,
+  PHASE_PRIME_TOWER_REPLAY,
+  PHASE_WRITE
+]
+
+# Counters
+COUNT_INPUT_BYTES = 'input_bytes'
+COUNT_OUTPUT_BYTES = 'output_bytes'
+COUNT_LINES_READ = 'lines_read'
+COUNT_BYTES_COPIED = 'bytes_copied'
+COUNT_BYTES_REWRITTEN = 'bytes_rewritten'
+COUNT_LAYERS = 'layers'
+COUNT_LAYERS_COPIED = 'layers_copied'
+COUNT_TOOLCHANGES_MINIMAL = 'toolchanges_minimal'
+COUNT_TOOLCHANGES_FULL = 'toolchanges_full'
+COUNT_PRIME_TOWERS_RELOCATED = 'prime_towers_relocated'
+COUNT_STREAM_PEAK_BUFFER_BYTES = 'stream_peak_buffer_bytes'
+
+class _Phase:
+  def __init__(self, profile: 'ProcessProfile', name: str):
+    self._profile = profile
+    self._name = name
+
+  def __enter__(self):
+    self._profile._enterPhase(self._name)
+
+  def __exit__(self, *args):
+    self._profile._exitPhase()
+
+class ProcessProfile:
+  """Time spent in each phase of process() and counts of the work done. Time in a phase does not include time in phases started inside it. Time spent in worker processes is kept apart from the time in this process because workers run at the same time. A disabled profile records nothing."""
+
+  def __init__(self, enabled: bool = True):
+    self.enabled: bool = enabled
+    """Record phases and counts"""
+    self.phaseTimes: dict[str, float] = {}
+    """Seconds spent in each phase"""
+    self.workerPhaseTimes: dict[str, float] = {}
+    """Seconds spent in each phase by worker processes added together"""
+    self.counts: dict[str, int] = {}
+    """Counters by name"""
+    self.totalTime: float = 0
+    """Seconds for the whole run"""
+    self._stack: list[list] = []
+
+  def __getstate__(self):
+    # Only finished measurements are sent between processes
+    state = self.__dict__.copy()
+    state['_stack'] = []
+    return state
+
+  def phase(self, name: str) -> contextlib.AbstractContextManager:
+    """Context manager that adds the time spent inside it to a phase"""
+    if not self.enabled:
+      return contextlib.nullcontext()
+    return _Phase(self, name)
+
+  def _enterPhase(self, name: str):
+    now = time.perf_counter()
+    if self._stack:
+      # Pause the enclosing phase
+      parent = self._stack[-1]
+      self.phaseTimes[parent[0]] = self.phaseTimes.get(parent[0], 0) + now - parent[1]
+    self._stack.append([name, now])
+
+  def _exitPhase(self):
+    now = time.perf_counter()
+    name, start = self._stack.pop()
+    self.phaseTimes[name] = self.phaseTimes.get(name, 0) + now - start
+    if self._stack:
+      # Resume the enclosing phase
+      self._stack[-1][1] = now
+
+  def count(self, name: str, n: int = 1):
+    if self.enabled:
+      self.counts[name] = self.counts.get(name, 0) + n
+
+  def merge(self, other: 'ProcessProfile'):
+    """Add the phases and counts of another profile such as one recorded for another variant"""
+    if not self.enabled:
+      return
+    _addTimes(self.phaseTimes, other.phaseTimes)
+    _addTimes(self.workerPhaseTimes, other.workerPhaseTimes)
+    for name, n in other.counts.items():
+      self.count(name, n)
+
+  def mergeWorker(self, other: 'ProcessProfile'):
+    """Add the phases and counts of a profile recorded in a worker process. Its phases are added to the worker phases."""
+    if not self.enabled:
+      return
+    _addTimes(self.workerPhaseTimes, other.phaseTimes)
+    _addTimes(self.workerPhaseTimes, other.workerPhaseTimes)
+    for name, n in other.counts.items():
+      self.count(name, n)
+
+  def toDict(self) -> dict:
+    totalTime = self.totalTime
+    d = {
+      'total_seconds': totalTime,
+      'phases': {name: self.phaseTimes[name] for name in PHASES if name in self.phaseTimes},
+      'counts': dict(self.counts),
+      'input_mb_per_second': self.counts.get(COUNT_INPUT_BYTES, 0) / 1e6 / totalTime if totalTime > 0 else 0,
+      'lines_per_second': self.counts.get(COUNT_LINES_READ, 0) / totalTime if totalTime > 0 else 0
+    }
+    if self.workerPhaseTimes:
+      d['worker_phases'] = {name: self.workerPhaseTimes[name] for name in PHASES if name in self.workerPhaseTimes}
+    return d
+
+  def toJSON(self) -> str:
+    return json.dumps(self.toDict(), indent=2)
+
+  def formatTable(self) -> str:
+    """Human readable table of the phases and counts"""
+    d = self.toDict()
+    workerPhases = d.get('worker_phases')
+    if workerPhases:
+      # Worker seconds are added together over the workers so they are not a part of the total
+      rows = [f"{'Phase':<24}{'Seconds':>12}{'%':>8}{'Worker s':>12}"]
+      for name in PHASES:
+        if name in d['phases'] or name in workerPhases:
+          t = d['phases'].get(name, 0)
+          rows.append(f"{name:<24}{t:>12.3f}{(t/self.totalTime*100 if self.totalTime > 0 else 0):>8.1f}{workerPhases.get(name, 0):>12.3f}")
+      rows.append(f"{'total':<24}{self.totalTime:>12.3f}{'':>8}{sum(workerPhases.values()):>12.3f}")
+    else:
+      rows = [f"{'Phase':<24}{'Seconds':>12}{'%':>8}"]
+      for name, t in d['phases'].items():
+        rows.append(f"{name:<24}{t:>12.3f}{(t/self.totalTime*100 if self.totalTime > 0 else 0):>8.1f}")
+      rows.append(f"{'total':<24}{self.totalTime:>12.3f}")
+    rows.append('')
+    rows.append(f"{'Count':<24}{'Value':>12}")
+    for name, n in d['counts'].items():
+      rows.append(f"{name:<24}{n:>12}")
+    rows.append(f"{'input_mb_per_second':<24}{d['input_mb_per_second']:>12.2f}")
+    rows.append(f"{'lines_per_second':<24}{d['lines_per_second']:>12.0f}")
+    return '\n'.join(rows)
+
+def _addTimes(times: dict[str, float], other: dict[str, float]):
+  for name, t in other.items():
+    times[name] = times.get(name, 0) + t
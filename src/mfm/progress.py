@@ -0,0 +1,81 @@
+import datetime, queue, time, typing
+
+from .printing_classes import *
+
+PROGRESS_RATE = 10
+"""Default most status updates sent per second"""
+
+class ProgressReporter:
+  """Status queue that sends at most rate status updates per second. Updates put in between are merged into the next update so only the latest status text and progress are sent. Progress reported in bytes of the input G-code file is sent with the bytes per second and the estimated time left. If the status queue has a checkCancelled() method it is called on every update, including merged updates, so it can stop the job by raising an exception."""
+
+  def __init__(self, statusQueue: queue.Queue, rate: float = PROGRESS_RATE, clock: typing.Callable[[], float] = time.monotonic):
+    self.statusQueue: queue.Queue = statusQueue
+    """Queue the merged status updates are sent to"""
+    self.interval: float = 1/rate if rate and rate > 0 else 0
+    """Least seconds between status updates"""
+    self.sent: int = 0
+    """Status updates sent"""
+    self.merged: int = 0
+    """Status updates merged into a later update instead of sent"""
+    self._clock = clock
+    self._checkCancelled: typing.Callable[[], None] = getattr(statusQueue, 'checkCancelled', None)
+    self._pending: StatusQueueItem = None
+    self._lastSent: float = None
+    # Time and bytes done when the current pass over the input started
+    self._passStart: tuple[float, int] = None
+    self._lastBytesDone: int = 0
+
+  def put(self, item: StatusQueueItem, force: bool = False):
+    """Send a status update or merge it into the next one if the last update was sent less than 1/rate seconds ago. force sends it now with any merged updates."""
+    if self._checkCancelled:
+      self._checkCancelled()
+    if self._pending == None:
+      self._pending = StatusQueueItem()
+    else:
+      self.merged += 1
+    for name in StatusQueueItem.FIELDS:
+      value = getattr(item, name)
+      if value != None:
+        setattr(self._pending, name, value)
+
+    now = self._clock()
+    if force or self._lastSent == None or now - self._lastSent >= self.interval:
+      self._send(now)
+
+  def progress(self, bytesDone: int, totalBytes: int, statusLeft: str = None, statusRight: str = None):
+    """Report progress through the input G-code file. Progress that goes back to an earlier position starts a new pass over the file and the bytes per second is measured again."""
+    now = self._clock()
+    if self._passStart == None or bytesDone < self._lastBytesDone:
+      self._passStart = (now, bytesDone)
+    self._lastBytesDone = bytesDone
+
+    item = StatusQueueItem()
+    item.statusLeft = statusLeft
+    item.statusRight = statusRight
+    if totalBytes > 0:
+      item.progress = bytesDone/totalBytes * 100
+    elapsed = now - self._passStart[0]
+    if elapsed > 0 and bytesDone > self._passStart[1]:
+      item.bytesPerSecond = (bytesDone - self._passStart[1]) / elapsed
+      item.etaSeconds = max(totalBytes - bytesDone, 0) / item.bytesPerSecond
+    self.put(item)
+
+  def flush(self):
+    """Send the merged status updates that were not sent yet"""
+    if self._pending != None:
+      self._send(self._clock())
+
+  def _send(self, now: float):
+    self.statusQueue.put(item=self._pending)
+    self.sent += 1
+    self._pending = None
+    self._lastSent = now
+
+def formatProgress(item: StatusQueueItem) -> str:
+  """Progress percentage with the bytes per second and estimated time left if they are known"""
+  s = f"Progress {item.progress:.1f}%"
+  if item.bytesPerSecond != None:
+    s += f" {item.bytesPerSecond/1e6:.1f} MB/s"
+  if item.etaSeconds != None:
+    s += f" ETA {datetime.timedelta(seconds=round(item.etaSeconds))}"
+  return s
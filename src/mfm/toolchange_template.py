@@ -0,0 +1,45 @@
+from .printing_classes import *
+from .line_ending import *
+from .gcode_file import *
+from .line_classifier import *
+
+TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER = 'XX'
+
+class ToolchangeTemplateError(ValueError):
+  """Toolchange G-code file cannot be used as a minimal toolchange"""
+
+class ToolchangeTemplate:
+  """Minimal toolchange G-code read once per run. The template is rendered once for each tool so inserting a toolchange is a single write of already encoded bytes."""
+
+  def __init__(self, fn: str, lineEnding: str = LineEnding.UNIX.value):
+    try:
+      with open(fn, mode='r', encoding=GCODE_ENCODING, errors=GCODE_ENCODING_ERRORS) as tc_bare:
+        self.template: str = tc_bare.read()
+        """Toolchange G-code with the tool index placeholder"""
+    except OSError as e:
+      raise ToolchangeTemplateError(f"Toolchange G-code file {fn} could not be read. {e}")
+    self.lineEnding: str = lineEnding
+    """Line ending of the rendered toolchanges"""
+    self._rendered: dict[int, bytes] = {}
+
+    # Fail before post processing starts instead of at the first inserted toolchange
+    if TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER not in self.template:
+      raise ToolchangeTemplateError(f"Toolchange G-code file {fn} does not contain the tool index placeholder {TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER}")
+    if not any(TOOLCHANGE_T_RE.match(line) for line in self._renderText(0).splitlines()):
+      raise ToolchangeTemplateError(f"Toolchange G-code file {fn} does not contain a T{TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER} tool select command")
+
+  def _renderText(self, toolIndex: int) -> str:
+    return self.template.replace(TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER, str(toolIndex))
+
+  def _renderBytes(self, toolIndex: int) -> bytes:
+    s = self._renderText(toolIndex)
+    if self.lineEnding != LineEnding.UNIX.value:
+      s = s.replace(LineEnding.UNIX.value, self.lineEnding)
+    return s.encode(GCODE_ENCODING, GCODE_ENCODING_ERRORS)
+
+  def render(self, toolIndex: int) -> bytes:
+    """Encoded toolchange G-code for a tool index"""
+    rendered = self._rendered.get(toolIndex)
+    if rendered == None:
+      rendered = self._rendered[toolIndex] = self._renderBytes(toolIndex)
+    return rendered
@@ -1,7 +1,8 @@
-import argparse, enum, shutil, os, logging, sys, threading
+import argparse, contextlib, enum, json, shutil, os, logging, sys, threading, multiprocessing, time
 
 from mfm.line_ending import *
 from mfm.map_post_process import *
+from mfm.batch import *
 
 class LineEndingCommandLineParameter(enum.Enum):
   AUTODETECT = "AUTO"
@@ -10,6 +11,11 @@ class LineEndingCommandLineParameter(enum.Enum):
 
 TEMP_OUTPUT_GCODE_FILE = 'mfm-output.gcode'
 
+def variantOutputFilename(fn: str, optionsFile: str) -> str:
+  """Output G-code filename for one of several options files"""
+  name, extension = splitGcodeExtension(fn)
+  return f"{name}-{os.path.splitext(os.path.basename(optionsFile))[0]}{extension}"
+
 #python ./src/mfm_cmd.py ./sample_models/dual_color_dice/tests/dice_multiple_bambu_prime.gcode -o dice-export.gcode -c ./sample_models/dual_color_dice/config-dice-test.json -t ./minimal_toolchanges/bambu-p1-series.gcode
 
 #python ./src/mfm_cmd.py "C:\Users\ansonl\Downloads\Die and Dots_PLA_3h21m.gcode" -o dice-export.gcode -c ./sample_models/dual_color_dice/config-dice-test.json -t ./minimal_toolchanges/bambu-p1-series.gcode
@@ -21,6 +27,7 @@ TEMP_OUTPUT_GCODE_FILE = 'mfm-output.gcode'
 #"C:\Users\USERNAME\AppData\Local\Microsoft\WindowsApps\python3.11.exe" "C:\Users\USERNAME\topo-map-post-processing\src\mfm_cmd.py" -c "C:\Users\USERNAME\topo-map-post-processing\sample_models\dual_color_dice\config-dice-test.json" -t "C:\Users\USERNAME\topo-map-post-processing\minimal_toolchanges\bambu-p1-series.gcode";
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
 
     redirectSTDERR = open(os.path.join(os.path.expanduser('~'), 'mfm-script-stderr.log'), "w")
     sys.stderr.write = redirectSTDERR.write
@@ -43,8 +50,6 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"Failed to create log file: {e}")
 
-    logging.info(f"Logging started")
-
     # Set up status queue
     statusQueue: queue.Queue[StatusQueueItem] = queue.Queue()
     def worker():
@@ -57,7 +62,7 @@ if __name__ == "__main__":
             if item.statusRight != None:
                 status = item.statusRight
             if item.progress != None:
-                status = f'Progress {item.progress}'
+                status = formatProgress(item)
             logging.info(status)
     threading.Thread(target=worker, daemon=True).start()
 
@@ -66,41 +71,130 @@ if __name__ == "__main__":
         description='3D G-code Map Feature Modifier (MFM)',
         epilog='Report issues and contribute at https://github.com/ansonl/mfm'
     )
-    parser.add_argument('input_gcode', type=str, help='Input G-code file')
-    parser.add_argument('-o', '--output_gcode', help='Output G-code file. Overwrite Input G-code file if no output provided.')
-    parser.add_argument('-c', '--config', required=True, help='Options configuration JSON file')
-    parser.add_argument('-t', '--toolchange', required=True, help='Toolchange G-code file')
+    parser.add_argument('input_gcode', type=str, nargs='?', help=f'Input G-code file. {STDIO_FILENAME} reads the G-code from standard input one layer at a time. A {GZIP_EXTENSION} file or the plate G-code in a Bambu {GCODE_3MF_EXTENSION} package is also read one layer at a time.')
+    parser.add_argument('-o', '--output_gcode', help=f'Output G-code file. Overwrite Input G-code file if no output provided. {STDIO_FILENAME} writes the G-code to standard output. A {GZIP_EXTENSION} file is compressed. A {GCODE_3MF_EXTENSION} package is a copy of the Input {GCODE_3MF_EXTENSION} package with the plate G-code and its MD5 replaced.')
+    parser.add_argument('-c', '--config', nargs='+', help='Options configuration JSON file. With more than 1 options file, the Input G-code file is analyzed once and 1 output is written for each options file with the options filename added to the Output G-code filename.')
+    parser.add_argument('-t', '--toolchange', help='Toolchange G-code file')
     parser.add_argument('-le', choices=[LineEndingCommandLineParameter.AUTODETECT, LineEndingCommandLineParameter.WINDOWS, LineEndingCommandLineParameter.UNIX], default=LineEndingCommandLineParameter.AUTODETECT, help='Line ending style')
+    parser.add_argument('--layer_index', action='store_true', help=f'Save the layer and feature analysis to a {LAYER_INDEX_EXTENSION} file next to the Input G-code file and reuse it on later runs with the same Input G-code file')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help=f'Number of worker processes used to scan and write layers in parallel. Parts of the file are scanned in separate processes, a short sequential pass finds the printing state carried between layers, and parts are then written in separate processes. Only faster for large G-code files on multi-core machines. Input G-code files smaller than {PARALLEL_MIN_INPUT_BYTES // (1024 * 1024)} MB are processed with 1 job.')
+    parser.add_argument('--profile', nargs='?', const='', metavar='PROFILE_JSON', help='Log the time spent in each processing phase and counts of the work done. The profile is also written as JSON to PROFILE_JSON if provided.')
+    parser.add_argument('--color_schedule', metavar='SCHEDULE_JSON', help='Write the isoline and replacement color of every layer for each options file to SCHEDULE_JSON without writing any G-code')
+    parser.add_argument('--layer_plans', metavar='LAYER_PLANS_JSON', help='Write the edits planned for every layer for each options file to LAYER_PLANS_JSON without writing any G-code. Each edit copies, skips or substitutes a tool in a span of the Input G-code file by byte offset, or inserts G-code.')
+    parser.add_argument('--batch', metavar='MANIFEST_OR_GLOB', help=f'Post process many G-code files in a pool of worker processes instead of Input G-code file. A .csv or .json manifest lists the {MANIFEST_INPUT}, {MANIFEST_OUTPUT}, {MANIFEST_OPTIONS} and {MANIFEST_TOOLCHANGE} files of each job. {MANIFEST_OPTIONS} and {MANIFEST_TOOLCHANGE} default to --config and --toolchange. Anything else is a glob of Input G-code files that are written to the --output_gcode directory, or next to each input, with {BATCH_EXPORT_SUFFIX} added to the name.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes for --batch. Defaults to the number of cores.')
+    parser.add_argument('--log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='Least severe messages logged. DEBUG also logs every layer and feature found and written, which slows down large G-code files.')
+    parser.add_argument('--progress_rate', type=float, default=PROGRESS_RATE, metavar='HZ', help=f'Most progress updates logged per second. Updates in between are merged. Defaults to {PROGRESS_RATE}.')
+    parser.add_argument('--batch_summary', default='mfm-batch-summary.csv', help='File the --batch job results with timings and errors are written to. A .json file is written as JSON and anything else as CSV.')
     
     args =  parser.parse_args()
+    logging.getLogger('').setLevel(args.log_level)
+    if args.batch == None and (args.input_gcode == None or args.config == None or args.toolchange == None):
+        parser.error('input_gcode, --config and --toolchange are required without --batch')
+    if args.batch != None and args.input_gcode != None:
+        parser.error('input_gcode cannot be used with --batch')
+
+    if args.output_gcode == STDIO_FILENAME or (args.output_gcode == None and args.input_gcode == STDIO_FILENAME):
+        # Standard output only has G-code
+        for handler in logging.getLogger('').handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream == sys.stdout:
+                handler.setStream(sys.stderr)
+
+    logging.info(f"Logging started")
     logging.info(f'Parsed args {args}')
 
     inputGcodeFile = args.input_gcode
     outputGcodeFile = args.output_gcode
-    configFile = args.config
+    configFiles = args.config or []
     toolchangeFile = args.toolchange
     lineEndingFlavor = args.le
+    useLayerIndex = args.layer_index
+    jobs = max(1, args.jobs)
+    profileFile = args.profile
+
+    if args.batch != None:
+        if len(configFiles) > 1:
+            parser.error('--batch takes 1 --config options file')
+        configFile = configFiles[0] if configFiles else None
+        if args.batch.lower().endswith(('.csv', '.json')):
+            try:
+                batchJobs = readBatchManifest(args.batch, optionsFile=configFile, toolchangeFile=toolchangeFile)
+            except (BatchManifestError, OSError) as e:
+                # Standard error is redirected to a log file so the manifest error is logged to the console instead
+                logging.error(f'Batch manifest could not be read. {e}')
+                sys.exit(1)
+        elif configFile == None or toolchangeFile == None:
+            parser.error('--config and --toolchange are required with a --batch glob')
+        else:
+            batchJobs = globBatchJobs(args.batch, outputGcodeFile, configFile, toolchangeFile)
+            if outputGcodeFile:
+                os.makedirs(outputGcodeFile, exist_ok=True)
+        logging.info(f'Running {len(batchJobs)} batch jobs with {max(1, args.workers)} workers')
+
+        finishedJobs = 0
+        def logBatchJobResult(result: BatchJobResult):
+            global finishedJobs
+            finishedJobs += 1
+            if result.succeeded:
+                logging.info(f'[{finishedJobs}/{len(batchJobs)}] Wrote {result.job.outputFile} in {result.seconds:.2f}s')
+            else:
+                logging.error(f'[{finishedJobs}/{len(batchJobs)}] Failed {result.job.inputFile} after {result.seconds:.2f}s. {result.error}')
+
+        batchStartTime = time.monotonic()
+        batchResults = runBatch(batchJobs, max(1, args.workers), onResult=logBatchJobResult, lineEnding=LineEnding[lineEndingFlavor.name], layerIndex=useLayerIndex, layerJobs=jobs)
+        writeBatchSummary(args.batch_summary, batchResults)
+        failedJobs = sum(1 for result in batchResults if not result.succeeded)
+        logging.info(f'Batch finished in {time.monotonic()-batchStartTime:.2f}s. {len(batchResults)-failedJobs} succeeded and {failedJobs} failed. Wrote summary to {args.batch_summary}')
+        sys.exit(1 if failedJobs else 0)
     
-    if outputGcodeFile == None:     
+    # Standard input can only be written back out to standard output
+    if outputGcodeFile == None and inputGcodeFile == STDIO_FILENAME:
+        outputGcodeFile = STDIO_FILENAME
+
+    if len(configFiles) > 1 and STDIO_FILENAME in (inputGcodeFile, outputGcodeFile):
+        parser.error(f'Several --config options files cannot be used with {STDIO_FILENAME}')
+
+    if args.layer_plans and isStreamedGcodeFile(inputGcodeFile):
+        parser.error(f'--layer_plans cannot be used when reading from standard input, a {GZIP_EXTENSION} file, or a {GCODE_3MF_EXTENSION} package')
+
+    if isStreamedGcodeFile(inputGcodeFile) and (useLayerIndex or jobs > 1):
+        useLayerIndex = False
+        jobs = 1
+        logging.warning(f'--layer_index and --jobs are not used when reading from standard input, a {GZIP_EXTENSION} file, or a {GCODE_3MF_EXTENSION} package')
+
+    if len(configFiles) > 1:
+        # Each variant is written next to the output, or the input if there is no output
+        outputGcodeFiles = [variantOutputFilename(outputGcodeFile or inputGcodeFile, configFile) for configFile in configFiles]
+    elif outputGcodeFile == None:     
+        # Keep the package extension so the temp output is written in the same format as the input
         outputGcodeFile = TEMP_OUTPUT_GCODE_FILE
+        if isGcode3mfFile(inputGcodeFile):
+            outputGcodeFile = TEMP_OUTPUT_GCODE_FILE.removesuffix('.gcode') + GCODE_3MF_EXTENSION
+        elif isGzipFile(inputGcodeFile):
+            outputGcodeFile = TEMP_OUTPUT_GCODE_FILE + GZIP_EXTENSION
         status = f"No Output G-code file provided. Temp output at {outputGcodeFile}. input file will be replaced by temp file."
         logging.info(status)
+    if len(configFiles) == 1:
+        outputGcodeFiles = [outputGcodeFile]
 
     status = f"Input G-code file is {inputGcodeFile}"
     logging.info(status)
 
-    # Load Options from JSON file
-    userOptions = {}
-    loadOptionsError = readUserOptions(userOptions=userOptions, optionsFilename=configFile)
-    if loadOptionsError != None:
-        status = f'Config JSON file could not be parsed. {loadOptionsError}'
-        logging.error(status)
-    status = f'UserOptions are {userOptions}'
-    logging.info(status)
+    variantColors = []
+    for configFile in configFiles:
+        # Load Options from JSON file
+        userOptions = {}
+        loadOptionsError = readUserOptions(userOptions=userOptions, optionsFilename=configFile)
+        if loadOptionsError != None:
+            status = f'Config JSON file could not be parsed. {loadOptionsError}'
+            logging.error(status)
+        status = f'UserOptions are {userOptions}'
+        logging.info(status)
 
-    # Parse colors
-    periodicColors = parsePeriodicColors(userOptions=userOptions)
-    replacementColors = parseReplacementColors(userOptions=userOptions)
+        # Parse colors
+        # Standard output only has G-code
+        with contextlib.redirect_stdout(sys.stderr) if outputGcodeFile == STDIO_FILENAME else contextlib.nullcontext():
+            variantColors.append((parsePeriodicColors(userOptions=userOptions), parseReplacementColors(userOptions=userOptions)))
 
     # Determine line ending
     if lineEndingFlavor == LineEndingCommandLineParameter.AUTODETECT: 
@@ -114,8 +208,12 @@ if __name__ == "__main__":
 
     status = f"User selected {repr(lineEndingFlavor)} line ending."
     logging.info(status)
+    if lineEndingFlavor == LineEnding.AUTODETECT and inputGcodeFile == STDIO_FILENAME:
+        lineEndingFlavor = LineEnding.UNIX
+        status = f"Line ending cannot be detected in standard input. Defaulting to {LINE_ENDING_UNIX_TITLE}"
+        logging.warning(status)
     if lineEndingFlavor == LineEnding.AUTODETECT:
-        lineEndingFlavor = determineLineEndingTypeInFile(inputGcodeFile)
+        lineEndingFlavor = determineLineEndingTypeInGcodeFile(inputGcodeFile)
         status = f"Detected {repr(lineEndingFlavor)} line ending in input G-code file."
         logging.info(status)
         if lineEndingFlavor == LineEnding.UNKNOWN:
@@ -123,25 +221,61 @@ if __name__ == "__main__":
             status = f"Defaulting to {LINE_ENDING_UNIX_TITLE}"
             logging.warning(status)
 
-    # Create config dict that is sent to process loop
-    mfmConfig = MFMConfiguration()
-    mfmConfig[CONFIG_GCODE_FLAVOR] = MARLIN_2_BAMBU_PRUSA_MARKED_GCODE
-    mfmConfig[CONFIG_INPUT_FILE] = inputGcodeFile
-    mfmConfig[CONFIG_OUTPUT_FILE] = outputGcodeFile
-    mfmConfig[CONFIG_TOOLCHANGE_MINIMAL_FILE] = toolchangeFile
-    mfmConfig[CONFIG_PERIODIC_COLORS] = periodicColors
-    mfmConfig[CONFIG_REPLACEMENT_COLORS] = replacementColors
-    mfmConfig[CONFIG_LINE_ENDING] = lineEndingFlavor.value
-    mfmConfig[CONFIG_APP_NAME] = APP_NAME
-    mfmConfig[CONFIG_APP_VERSION] = APP_VERSION
-
-    process(configuration=mfmConfig, statusQueue=statusQueue)
-
-    status = f'Wrote output G-code to {outputGcodeFile}\n'
-    logging.info(status)
+    # Create config dict that is sent to process loop for each variant
+    mfmConfigs = []
+    for variantOutputGcodeFile, (periodicColors, replacementColors) in zip(outputGcodeFiles, variantColors):
+        mfmConfig = MFMConfiguration()
+        mfmConfig[CONFIG_GCODE_FLAVOR] = MARLIN_2_BAMBU_PRUSA_MARKED_GCODE
+        mfmConfig[CONFIG_INPUT_FILE] = inputGcodeFile
+        mfmConfig[CONFIG_OUTPUT_FILE] = variantOutputGcodeFile
+        mfmConfig[CONFIG_TOOLCHANGE_MINIMAL_FILE] = toolchangeFile
+        mfmConfig[CONFIG_PERIODIC_COLORS] = periodicColors
+        mfmConfig[CONFIG_REPLACEMENT_COLORS] = replacementColors
+        mfmConfig[CONFIG_LINE_ENDING] = lineEndingFlavor.value
+        mfmConfig[CONFIG_LAYER_INDEX] = useLayerIndex
+        mfmConfig[CONFIG_JOBS] = jobs
+        mfmConfig[CONFIG_PROFILE] = profileFile != None
+        mfmConfig[CONFIG_PROGRESS_RATE] = args.progress_rate
+        mfmConfig[CONFIG_APP_NAME] = APP_NAME
+        mfmConfig[CONFIG_APP_VERSION] = APP_VERSION
+        mfmConfigs.append(mfmConfig)
+
+    if args.color_schedule:
+        schedules = planColorSchedules(configurations=mfmConfigs, statusQueue=statusQueue)
+        with open(args.color_schedule, 'w') as f:
+            json.dump({configFile: schedule.toDict() for configFile, schedule in zip(configFiles, schedules)}, f, indent=2)
+        logging.info(f'Wrote color schedule to {args.color_schedule}')
+        sys.exit(0)
+
+    if args.layer_plans:
+        plans = planLayerEdits(configurations=mfmConfigs, statusQueue=statusQueue)
+        with open(args.layer_plans, 'w') as f:
+            json.dump({configFile: [plan.toDict() for plan in layerPlans] for configFile, layerPlans in zip(configFiles, plans)}, f, indent=2)
+        logging.info(f'Wrote layer plans to {args.layer_plans}')
+        sys.exit(0)
+
+    profiles = processVariants(configurations=mfmConfigs, statusQueue=statusQueue)
+    # Profile the whole run when there are several variants
+    profile = profiles[0]
+    for variantProfile in profiles[1:]:
+        profile.merge(variantProfile)
+        profile.totalTime += variantProfile.totalTime
+
+    if profileFile != None:
+        logging.info(f'Profile\n{profile.formatTable()}')
+        if profileFile:
+            with open(profileFile, 'w') as f:
+                f.write(profile.toJSON())
+            logging.info(f'Wrote profile JSON to {profileFile}')
+        else:
+            logging.info(f'Profile JSON\n{profile.toJSON()}')
+
+    for variantOutputGcodeFile in outputGcodeFiles:
+        status = f'Wrote output G-code to {variantOutputGcodeFile}\n'
+        logging.info(status)
 
     # Overwrite the input G-code file if no output file was passed
-    if outputGcodeFile == TEMP_OUTPUT_GCODE_FILE:
-        shutil.move(TEMP_OUTPUT_GCODE_FILE, inputGcodeFile)
+    if args.output_gcode == None and len(configFiles) == 1 and outputGcodeFile != STDIO_FILENAME:
+        shutil.move(outputGcodeFile, inputGcodeFile)
         status = f'Moved temp output G-code to {inputGcodeFile}\n'
         logging.info(status)
\ No newline at end of file
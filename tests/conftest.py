@@ -0,0 +1,22 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import pytest
+
+from mfm.batch import *
+from mfm.map_post_process import *
+from bench_process import BAMBU_TOOLCHANGE_FILE, PRUSA_TOOLCHANGE_FILE, REPO_DIR, toolchangeFile
+
+SAMPLE_GCODE_DIR = os.path.join(REPO_DIR, 'sample_models', 'dual_color_dice', 'tests')
+OPTIONS_FILE = os.path.join(REPO_DIR, 'premade_options', 'USAofPlastic-dual-meters.json')
+
+def mfmConfiguration(inputFn: str, outputFn: str, optionsFn: str = OPTIONS_FILE, toolchangeFn: str = None, jobs: int = 1) -> MFMConfiguration:
+  """Configuration built by batchJobConfiguration() like benchmarks/bench_process.py does. The minimal toolchange defaults to the one for the slicer that wrote the Input G-code file."""
+  return batchJobConfiguration(BatchJob(inputFn, outputFn, optionsFn, toolchangeFn or toolchangeFile(inputFn)), LineEnding.UNIX, False, jobs)
+
+@pytest.fixture
+def configuration():
+  """mfmConfiguration() for building the configuration of process() runs in a test"""
+  return mfmConfiguration
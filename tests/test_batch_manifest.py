@@ -0,0 +1,28 @@
+import os, subprocess, sys
+
+import pytest
+
+from mfm.batch import *
+
+MFM_CMD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'mfm_cmd.py')
+
+@pytest.mark.parametrize('name, content', [
+  ('jobs.csv', 'input,output\nmap.gcode\n'),
+  ('jobs.json', '{"input": "map.gcode"}'),
+  ('jobs.json', '[{"input": "map.gcode"'),
+])
+def testMalformedManifest(tmp_path, name: str, content: str):
+  fn = tmp_path / name
+  fn.write_text(content)
+  with pytest.raises(BatchManifestError):
+    readBatchManifest(str(fn), optionsFile='options.json', toolchangeFile='toolchange.gcode')
+
+def testMalformedManifestExitsWithError(tmp_path):
+  fn = tmp_path / 'jobs.json'
+  fn.write_text('[{"input": "map.gcode"}]')
+  # mfm_cmd.py writes its log files to the home directory
+  env = dict(os.environ, HOME=str(tmp_path), USERPROFILE=str(tmp_path))
+  result = subprocess.run([sys.executable, MFM_CMD, '--batch', str(fn), '-c', 'options.json', '-t', 'toolchange.gcode'], capture_output=True, text=True, cwd=tmp_path, env=env)
+  assert result.returncode == 1
+  assert 'Batch manifest could not be read' in result.stdout
+  assert 'Traceback' not in result.stdout
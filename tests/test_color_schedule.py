@@ -0,0 +1,176 @@
+import itertools, math
+
+import pytest
+
+from mfm.color_schedule import *
+from mfm.configuration import *
+
+ISOLINE_PC = PeriodicColor(colorIndex=2, startHeight=1.0, endHeight=8.0, height=0.3, period=1.0)
+
+def layerSequence(layerHeights: list[float], count: int) -> tuple[list[float], list[float], list[float]]:
+  """Heights, layer heights and previous layer heights of count layers cycling through layerHeights"""
+  heights, thicknesses, previous = [], [], []
+  height, previousLayerHeight = 0, 0
+  for layerHeight in itertools.islice(itertools.cycle(layerHeights), count):
+    height = round(height + layerHeight, 3)
+    heights.append(height)
+    thicknesses.append(layerHeight)
+    previous.append(previousLayerHeight)
+    previousLayerHeight = layerHeight
+  return heights, thicknesses, previous
+
+UNIFORM_LAYERS = layerSequence([0.2], 50)
+ADAPTIVE_LAYERS = layerSequence([0.08, 0.12, 0.28, 0.6, 0.4, 0.2, 0.16], 60)
+
+def baselineIsPeriodicLine(height: float, layerHeight: float, previousLayerHeight: float, printingPeriodicColor: bool, periodicLine: PeriodicColor) -> bool:
+  """Isoline decision made for each layer while it was written before the schedule was precomputed"""
+  if height >= periodicLine.startHeight and height <= periodicLine.endHeight:
+    if (height - periodicLine.startHeight) % periodicLine.period <= periodicLine.height:
+      return True
+    elif layerHeight > periodicLine.height:
+      if printingPeriodicColor == True and previousLayerHeight > periodicLine.height:
+        return False
+      if ((height - periodicLine.startHeight) - layerHeight) % periodicLine.period < periodicLine.height:
+        return True
+      elif height - periodicLine.startHeight > math.ceil(((height - periodicLine.startHeight) - layerHeight) / periodicLine.period) * periodicLine.period + periodicLine.height:
+        return True
+  return False
+
+@pytest.mark.parametrize('height, layerHeight, previousLayerHeight, state', [
+  (2.2, 0.2, 0.2, ISOLINE),
+  (2.0, 0.2, 0.2, ISOLINE),
+  (2.6, 0.2, 0.2, ISOLINE_NONE),
+  (3.5, 0.6, 0.2, ISOLINE),
+  (3.5, 0.6, 0.6, ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR),
+  (4.6, 0.6, 0.6, ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR),
+  (3.8, 0.4, 0.6, ISOLINE_NONE),
+  (0.6, 0.2, 0.2, ISOLINE_NONE),
+  (8.2, 0.2, 0.2, ISOLINE_NONE)
+])
+def testIsolineState(height: float, layerHeight: float, previousLayerHeight: float, state: int):
+  assert isolineStates(ISOLINE_PC, [height], [layerHeight], [previousLayerHeight]) == [state]
+
+@pytest.mark.parametrize('layers', [UNIFORM_LAYERS, ADAPTIVE_LAYERS], ids=['uniform', 'adaptive'])
+def testScheduleMatchesPerLayerDecision(layers):
+  heights, layerHeights, previousLayerHeights = layers
+  schedule = ColorSchedule([ISOLINE_PC], [])
+  schedule.extend(heights, layerHeights, previousLayerHeights)
+  assert len(schedule) == len(heights)
+  for layerNum, (height, layerHeight, previousLayerHeight) in enumerate(zip(*layers)):
+    for printingPeriodicColor in (False, True):
+      expected = ISOLINE_PC if baselineIsPeriodicLine(height, layerHeight, previousLayerHeight, printingPeriodicColor, ISOLINE_PC) else None
+      assert schedule.periodicColor(layerNum, printingPeriodicColor) is expected, (height, layerHeight, previousLayerHeight, printingPeriodicColor)
+
+def testAdaptiveLayersUseEveryIsolineState():
+  states = set(isolineStates(ISOLINE_PC, *ADAPTIVE_LAYERS))
+  assert states == {ISOLINE_NONE, ISOLINE, ISOLINE_UNLESS_PRINTING_PERIODIC_COLOR}
+
+def testFirstIsolineHasPriority():
+  wide = PeriodicColor(colorIndex=3, startHeight=0, endHeight=10, height=0.5, period=0.5)
+  schedule = ColorSchedule([ISOLINE_PC, wide], [])
+  schedule.extend(*UNIFORM_LAYERS)
+  for layerNum, states in enumerate(zip(*schedule.isolineStates)):
+    expected = ISOLINE_PC if states[0] == ISOLINE else wide
+    assert schedule.periodicColor(layerNum, False) is expected
+
+def testScheduleExtendedLayerByLayer():
+  # A streamed input adds each layer as it is found
+  whole = ColorSchedule([ISOLINE_PC], [])
+  whole.extend(*ADAPTIVE_LAYERS)
+  byLayer = ColorSchedule([ISOLINE_PC], [])
+  for layer in zip(*ADAPTIVE_LAYERS):
+    byLayer.extend(*([value] for value in layer))
+  assert byLayer.toDict() == whole.toDict()
+
+def testBuildColorScheduleFromLayers():
+  layers = []
+  for height, layerHeight, previousLayerHeight in zip(*ADAPTIVE_LAYERS):
+    layer = PrintState()
+    layer.height, layer.layerHeight, layer.previousLayerHeight = height, layerHeight, previousLayerHeight
+    layers.append(layer)
+  schedule = buildColorSchedule(layers, [ISOLINE_PC], [])
+  assert schedule.heights == ADAPTIVE_LAYERS[0]
+  assert schedule.isolineStates == [isolineStates(ISOLINE_PC, *ADAPTIVE_LAYERS)]
+
+LOW_BAND = ReplacementColorAtHeight(colorIndex=3, originalColorIndex=0, startHeight=2.0, endHeight=5.0)
+HIGH_BAND = ReplacementColorAtHeight(colorIndex=4, originalColorIndex=0, startHeight=4.0, endHeight=8.0)
+INNER_BAND = ReplacementColorAtHeight(colorIndex=5, originalColorIndex=0, startHeight=6.0, endHeight=7.0)
+
+@pytest.mark.parametrize('height, layerHeight, band', [
+  # Outside every band
+  (1.0, 0.2, None),
+  (9.0, 0.2, None),
+  # A layer is in a band when it overlaps the band
+  (2.0, 0.2, None),
+  (2.25, 0.25, LOW_BAND),
+  (2.1, 0.2, LOW_BAND),
+  (3.0, 0.2, LOW_BAND),
+  # Bands later in the list have priority where they overlap
+  (4.0, 0.2, LOW_BAND),
+  (4.2, 0.2, HIGH_BAND),
+  (5.0, 0.2, HIGH_BAND),
+  (5.2, 0.2, HIGH_BAND),
+  (6.4, 0.2, INNER_BAND),
+  (7.25, 0.25, HIGH_BAND),
+  (7.25, 0.5, INNER_BAND),
+  (8.0, 0.2, HIGH_BAND),
+  (8.25, 0.25, None),
+  # A thick layer overlapping 2 bands takes the later band
+  (4.5, 3.0, HIGH_BAND),
+  (2.5, 1.0, LOW_BAND)
+])
+def testReplacementColorBand(height: float, layerHeight: float, band: ReplacementColorAtHeight):
+  assert ReplacementColorIntervals([LOW_BAND, HIGH_BAND, INNER_BAND]).find(height, layerHeight) is band
+
+def testReplacementColorBandPriorityIsListOrder():
+  intervals = ReplacementColorIntervals([HIGH_BAND, LOW_BAND])
+  assert intervals.find(4.4, 0.2) is LOW_BAND
+  assert intervals.find(5.4, 0.2) is HIGH_BAND
+
+def testEmptyReplacementColorBand():
+  empty = ReplacementColorAtHeight(colorIndex=6, originalColorIndex=0, startHeight=3.0, endHeight=3.0)
+  intervals = ReplacementColorIntervals([LOW_BAND, empty])
+  assert intervals.find(3.2, 0.4) is empty
+  assert intervals.find(3.0, 0.2) is LOW_BAND
+  assert intervals.find(3.4, 0.2) is LOW_BAND
+
+def testReplacementColorScheduleByOriginalColor():
+  other = ReplacementColorAtHeight(colorIndex=2, originalColorIndex=1, startHeight=0.0, endHeight=3.0)
+  schedule = ColorSchedule([], [LOW_BAND, other])
+  schedule.extend([1.0, 2.6, 6.0], [0.2, 0.2, 0.2], [0.2, 0.2, 0.2])
+  assert schedule.replacementColorIndexes == [(-1, 2), (3, 2), (-1, -1)]
+  assert schedule.toolRemap(1) == [3, 2]
+  assert schedule.toolRemap(2) == [0, 1]
+
+def testParseReplacementColors():
+  userOptions = {
+    MODEL_TO_REAL_WORLD_DEFAULT_UNITS: 1000,
+    MODEL_ONE_TO_N_VERTICAL_SCALE: 1000,
+    MODEL_SEA_LEVEL_BASE_THICKNESS: 1.0,
+    REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START: 1,
+    REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END: 4,
+    REPLACEMENT_COLOR_INDEX: 3,
+    REPLACEMENT_ORIGINAL_COLOR_INDEX: 0,
+    REPLACEMENT_COLORS: [
+      # Missing options are the same as the first band
+      {REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START: 3, REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END: 7, REPLACEMENT_COLOR_INDEX: 4},
+      {REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START: 5, REPLACEMENT_ORIGINAL_COLOR_INDEX: 1}
+    ]
+  }
+  bands = parseReplacementColors(userOptions)
+  assert [(rc.startHeight, rc.endHeight, rc.colorIndex, rc.originalColorIndex) for rc in bands] == [(2.0, 5.0, 3, 0), (4.0, 8.0, 4, 0), (6.0, 5.0, 3, 1)]
+  # The later band has priority where the first 2 bands overlap
+  assert replacementColorIntervals(bands)[0].find(4.6, 0.2).colorIndex == 4
+
+def testParseReplacementColorsWithoutFirstBand():
+  userOptions = {
+    MODEL_TO_REAL_WORLD_DEFAULT_UNITS: 1000,
+    MODEL_ONE_TO_N_VERTICAL_SCALE: 1000,
+    MODEL_SEA_LEVEL_BASE_THICKNESS: 1.0,
+    REPLACEMENT_ORIGINAL_COLOR_INDEX: 0,
+    REPLACEMENT_COLORS: [
+      {REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_START: 3, REAL_WORLD_ELEVATION_REPLACEMENT_COLOR_END: 7, REPLACEMENT_COLOR_INDEX: 4}
+    ]
+  }
+  assert [(rc.startHeight, rc.endHeight, rc.colorIndex) for rc in parseReplacementColors(userOptions)] == [(4.0, 8.0, 4)]
+  assert parseReplacementColors({}) == []
@@ -0,0 +1,85 @@
+import io, os
+
+import pytest
+
+from mfm.map_post_process import *
+
+FIRST_LAYER = "; FEATURE: Outer wall\n; LINE_WIDTH: 0.42\nG1 X5 Y5 E1\n"
+
+def layer(z: float, body: str) -> str:
+  return f"; CHANGE_LAYER\n; Z_HEIGHT: {z}\n; LAYER_HEIGHT: 0.2\nG1 E-.04 F1800\n; MFM LAYER CHANGE END\nG1 X1 Y1 Z{z}\n" + body
+
+def readers(tmp_path, data: bytes) -> list:
+  fn = str(tmp_path / 'peek.gcode')
+  with open(fn, mode='wb') as f:
+    f.write(data)
+  # A chunk smaller than a line makes the stream reader read ahead while peeking
+  return [GcodeReader(fn), GcodeStreamReader(io.BytesIO(data), chunkSize=4)]
+
+def testPeeklineDoesNotMove(tmp_path):
+  for f in readers(tmp_path, b'G1 X1\r\nM204 S5000\r\n; FEATURE: Inner wall\r\n'):
+    with f:
+      assert f.readline() == 'G1 X1\n'
+      lineStart, pos, linesRead = f.lineStart, f.tell(), f.linesRead
+      assert f.peekline() == 'M204 S5000\n'
+      assert f.peekline() == 'M204 S5000\n'
+      assert (f.lineStart, f.tell(), f.linesRead) == (lineStart, pos, linesRead)
+
+      # The peeked line is returned once by the next readline
+      assert f.readline() == 'M204 S5000\n'
+      assert (f.lineStart, f.linesRead) == (pos, linesRead + 1)
+      assert f.readline() == '; FEATURE: Inner wall\n'
+      assert f.peekline() == ''
+      assert f.readline() == ''
+
+def testPeekedLineIsDroppedBySeek(tmp_path):
+  for f in readers(tmp_path, b'G1 X1\nG1 X2\nG1 X3\n'):
+    with f:
+      f.readline()
+      assert f.peekline() == 'G1 X2\n'
+      f.seek(0, os.SEEK_SET)
+      assert f.readline() == 'G1 X1\n'
+      assert f.readline() == 'G1 X2\n'
+      assert f.readline() == 'G1 X3\n'
+
+# Lines after the layer change end and the first feature expected on the layer
+FIRST_MARKER_CASES = {
+  'feature': ("; FEATURE: Inner wall\n; LINE_WIDTH: 0.45\nG1 X2 E1\n", 0, 'Inner wall', False),
+  'm204 continues feature': ("M204 S5000\nG1 X2 E1\n; FEATURE: Inner wall\nG1 X3 E1\n", 0, None, True),
+  'm204 before feature': ("M204 S5000\n; FEATURE: Inner wall\nG1 X3 E1\n", 1, 'Inner wall', False),
+  'line width continues feature': ("; LINE_WIDTH: 0.45\nG1 X2 E1\n; FEATURE: Inner wall\nG1 X3 E1\n", 0, None, True),
+  'filament end continues feature': ("; filament end gcode \nG1 X2 E1\n; FEATURE: Inner wall\nG1 X3 E1\n", 0, None, True),
+}
+
+@pytest.mark.parametrize('case', FIRST_MARKER_CASES.keys())
+def testFirstFeatureMarker(tmp_path, case: str):
+  body, firstLine, featureType, isContinued = FIRST_MARKER_CASES[case]
+  data = ("; HEADER\nM73 P0\n" + layer(0.2, FIRST_LAYER) + layer(0.4, body) + layer(0.6, FIRST_LAYER)).encode()
+  bodyStart = data.index(body.encode())
+  expectedStart = bodyStart + sum(len(line) + 1 for line in body.split('\n')[:firstLine])
+
+  layerFeatures = []
+  for f in readers(tmp_path, data):
+    with f:
+      layers = [layer for _, layer in scanLayers(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, ProcessProfile(enabled=False))]
+      assert [layer.height for layer in layers] == [0.2, 0.4, 0.6]
+      first = layers[1].features[0]
+      assert first.start == expectedStart
+      assert first.isContinued == isContinued
+      if featureType:
+        assert first.featureType == featureType
+      # The feature after a continued feature is the FEATURE tag
+      assert layers[1].features[-1].featureType == 'Inner wall'
+      layerFeatures.append([(feat.featureType, feat.start, feat.end) for feat in layers[1].features])
+  # The memory mapped and stream readers find the same features
+  assert layerFeatures[0] == layerFeatures[1]
+
+def testNoFirstFeatureMarker(tmp_path):
+  data = ("; HEADER\nM73 P0\n" + layer(0.2, FIRST_LAYER) + layer(0.4, "G1 X2 E1\n") + layer(0.6, FIRST_LAYER)).encode()
+  f = readers(tmp_path, data)[0]
+  with f:
+    layerIndex = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, ProcessProfile(enabled=False))
+  assert layerIndex.layers[1].features == []
+  # The next layer is looked for from the layer start
+  assert layerIndex.layers[1].toolCommandStarts == None
+  assert layerIndex.layers[2].height == 0.6
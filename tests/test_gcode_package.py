@@ -0,0 +1,74 @@
+import gzip, hashlib, os, shutil, zipfile
+
+import pytest
+
+from mfm.map_post_process import *
+from conftest import BAMBU_TOOLCHANGE_FILE, SAMPLE_GCODE_DIR
+
+GCODE_FILE = os.path.join(SAMPLE_GCODE_DIR, 'dice_multiple_bambu_prime.gcode')
+PLATE_GCODE = 'Metadata/plate_1.gcode'
+
+def plainOutput(tmp_path, configuration) -> bytes:
+  """Output of the uncompressed G-code file"""
+  outputFn = str(tmp_path / 'plain-output.gcode')
+  process(configuration(GCODE_FILE, outputFn, toolchangeFn=BAMBU_TOOLCHANGE_FILE), None)
+  with open(outputFn, mode='rb') as f:
+    return f.read()
+
+def writePackage(fn: str, plateGcode: bytes, md5: str | None, plates: int = 1):
+  """Package laid out like a Bambu Studio .gcode.3mf with the plate G-code MD5 after the plate G-code"""
+  with zipfile.ZipFile(fn, mode='w', compression=zipfile.ZIP_DEFLATED) as package:
+    package.writestr('[Content_Types].xml', '<?xml version="1.0" encoding="UTF-8"?>\n<Types/>\n')
+    package.writestr('Metadata/plate_1.png', bytes(range(256)))
+    for plate in range(1, plates + 1):
+      package.writestr(f'Metadata/plate_{plate}.gcode', plateGcode)
+    if md5 != None:
+      package.writestr(PLATE_GCODE + PLATE_GCODE_MD5_EXTENSION, md5)
+    package.writestr('Metadata/slice_info.config', '<config/>\n')
+
+@pytest.mark.parametrize('inputName,outputName', [('input.gcode.gz', 'output.gcode.gz'), ('input.gcode.gz', 'output.gcode'), ('input.gcode', 'output.gcode.gz')])
+def testGzipRoundTrip(tmp_path, configuration, inputName: str, outputName: str):
+  expected = plainOutput(tmp_path, configuration)
+  inputFn = str(tmp_path / inputName)
+  if isGzipFile(inputFn):
+    with open(GCODE_FILE, mode='rb') as src, gzip.open(inputFn, mode='wb') as dst:
+      shutil.copyfileobj(src, dst)
+  else:
+    shutil.copyfile(GCODE_FILE, inputFn)
+
+  outputFn = str(tmp_path / outputName)
+  process(configuration(inputFn, outputFn, toolchangeFn=BAMBU_TOOLCHANGE_FILE), None)
+  with (gzip.open if isGzipFile(outputFn) else open)(outputFn, mode='rb') as f:
+    assert f.read() == expected
+
+@pytest.mark.parametrize('uppercase', [True, False], ids=['uppercase md5', 'lowercase md5'])
+def testGcode3mfRoundTrip(tmp_path, configuration, uppercase: bool):
+  expected = plainOutput(tmp_path, configuration)
+  with open(GCODE_FILE, mode='rb') as f:
+    plateGcode = f.read()
+  md5 = hashlib.md5(plateGcode).hexdigest()
+  inputFn = str(tmp_path / 'input.gcode.3mf')
+  writePackage(inputFn, plateGcode, md5.upper() if uppercase else md5)
+
+  outputFn = str(tmp_path / 'output.gcode.3mf')
+  process(configuration(inputFn, outputFn, toolchangeFn=BAMBU_TOOLCHANGE_FILE), None)
+  with zipfile.ZipFile(inputFn) as source, zipfile.ZipFile(outputFn) as package:
+    assert package.namelist() == source.namelist()
+    outputGcode = package.read(PLATE_GCODE)
+    assert outputGcode == expected
+    outputMD5 = package.read(PLATE_GCODE + PLATE_GCODE_MD5_EXTENSION).decode()
+    assert outputMD5.lower() == hashlib.md5(outputGcode).hexdigest()
+    assert outputMD5 == (outputMD5.upper() if uppercase else outputMD5.lower())
+    for name in source.namelist():
+      if name not in (PLATE_GCODE, PLATE_GCODE + PLATE_GCODE_MD5_EXTENSION):
+        assert package.read(name) == source.read(name)
+
+def testGcode3mfOutputNeedsPackageInput(tmp_path, configuration):
+  with pytest.raises(GcodePackageError):
+    process(configuration(GCODE_FILE, str(tmp_path / 'output.gcode.3mf'), toolchangeFn=BAMBU_TOOLCHANGE_FILE), None)
+
+def testGcode3mfWithSeveralPlatesIsRejected(tmp_path, configuration):
+  inputFn = str(tmp_path / 'input.gcode.3mf')
+  writePackage(inputFn, b'; plate\n', None, plates=2)
+  with pytest.raises(GcodePackageError):
+    process(configuration(inputFn, str(tmp_path / 'output.gcode.3mf'), toolchangeFn=BAMBU_TOOLCHANGE_FILE), None)
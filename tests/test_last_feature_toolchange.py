@@ -0,0 +1,22 @@
+import glob, os
+
+import pytest
+
+from mfm.map_post_process import *
+from conftest import REPO_DIR, SAMPLE_GCODE_DIR
+
+GCODE_FILE = os.path.join(SAMPLE_GCODE_DIR, 'dice_single_bambu_prime.gcode')
+OPTIONS_FILES = sorted(glob.glob(os.path.join(REPO_DIR, 'premade_options', '*.json')))
+
+@pytest.mark.parametrize('optionsFn', OPTIONS_FILES, ids=os.path.basename)
+def testNoToolchangeWithoutPrintingFeature(tmp_path, configuration, optionsFn: str):
+  outputFn = str(tmp_path / 'output.gcode')
+  profile = process(configuration(GCODE_FILE, outputFn, optionsFn), None)
+
+  with open(outputFn, mode='r', encoding=GCODE_ENCODING) as f:
+    lines = f.read().splitlines()
+  assert 'T-1' not in lines
+  assert not any(line.startswith(('M620 S-1', 'M621 S-1')) for line in lines)
+  inserted = [line for line in lines if line.startswith('; MFM Toolchange (minimal) inserted to ')]
+  assert not any(line.startswith('; MFM Toolchange (minimal) inserted to -1 ') for line in inserted)
+  assert len(inserted) == profile.counts[COUNT_TOOLCHANGES_MINIMAL]
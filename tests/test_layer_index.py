@@ -0,0 +1,114 @@
+import json, os, shutil, zlib
+
+import pytest
+
+import mfm.layer_index
+from mfm.map_post_process import *
+
+SAMPLE_GCODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_models', 'dual_color_dice', 'tests', 'dice_multiple_bambu_prime.gcode')
+
+LAYER_FIELDS = ('layerStart', 'layerEnd', 'height', 'layerHeight', 'previousLayerHeight', 'originalColor', 'layerEndOriginalColor', 'featureScanStart', 'toolCommandStarts')
+
+@pytest.fixture
+def gcodeFile(tmp_path) -> str:
+  fn = str(tmp_path / 'dice.gcode')
+  shutil.copyfile(SAMPLE_GCODE, fn)
+  return fn
+
+def scanAndSave(fn: str) -> LayerIndex:
+  with GcodeReader(fn) as f:
+    layerIndex = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, ProcessProfile(enabled=False))
+    saveLayerIndex(layerIndex, layerIndexFilename(fn))
+  return layerIndex
+
+def load(fn: str) -> LayerIndex | None:
+  with GcodeReader(fn) as f:
+    return loadLayerIndex(layerIndexFilename(fn), f)
+
+def layerValues(layerIndex: LayerIndex) -> list:
+  return [[layerChangeStart] + [getattr(layer, name) for name in LAYER_FIELDS] + [[mfm.layer_index._encodeFeature(feat) for feat in layer.features]] for layerChangeStart, layer in zip(layerIndex.layerChangeStarts, layerIndex.layers)]
+
+def rewriteIndex(fn: str, **changes):
+  indexFn = layerIndexFilename(fn)
+  with open(indexFn, 'rb') as f:
+    data = json.loads(zlib.decompress(f.read()))
+  data.update(changes)
+  with open(indexFn, 'wb') as f:
+    f.write(zlib.compress(json.dumps(data).encode()))
+
+def changeMtime(fn: str):
+  stat = os.stat(fn)
+  os.utime(fn, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def testRoundTrip(gcodeFile):
+  scanned = scanAndSave(gcodeFile)
+  loaded = load(gcodeFile)
+  assert loaded != None
+  assert len(loaded.layers) > 0
+  assert layerValues(loaded) == layerValues(scanned)
+  assert (loaded.fileSize, loaded.fileMtime, loaded.fileHash) == (scanned.fileSize, scanned.fileMtime, scanned.fileHash)
+  assert loaded.layerAt(loaded.layerChangeStarts[-1]) is loaded.layers[-1]
+
+def testMissingIndex(gcodeFile):
+  assert load(gcodeFile) == None
+
+def testSizeChanged(gcodeFile):
+  scanAndSave(gcodeFile)
+  with open(gcodeFile, 'ab') as f:
+    f.write(b'G1 X1\n')
+  assert load(gcodeFile) == None
+
+def testContentChangedWithSameSize(gcodeFile):
+  scanAndSave(gcodeFile)
+  with open(gcodeFile, 'r+b') as f:
+    first = f.read(1)
+    f.seek(0)
+    f.write(b'#' if first != b'#' else b';')
+  changeMtime(gcodeFile)
+  assert load(gcodeFile) == None
+
+def testMtimeChangedWithSameContent(gcodeFile):
+  # Only the content hash decides once the modification time changed, so a copied or touched file keeps its index
+  scanAndSave(gcodeFile)
+  changeMtime(gcodeFile)
+  assert load(gcodeFile) != None
+
+def testHashChanged(gcodeFile):
+  scanAndSave(gcodeFile)
+  rewriteIndex(gcodeFile, hash='0' * 32)
+  changeMtime(gcodeFile)
+  assert load(gcodeFile) == None
+
+def testVersionChanged(gcodeFile, monkeypatch):
+  scanAndSave(gcodeFile)
+  monkeypatch.setattr(mfm.layer_index, 'LAYER_INDEX_VERSION', LAYER_INDEX_VERSION + 1)
+  assert load(gcodeFile) == None
+
+def testCorruptIndex(gcodeFile):
+  scanAndSave(gcodeFile)
+  with open(layerIndexFilename(gcodeFile), 'wb') as f:
+    f.write(b'not a layer index')
+  assert load(gcodeFile) == None
+
+def testTruncatedIndex(gcodeFile):
+  scanAndSave(gcodeFile)
+  indexFn = layerIndexFilename(gcodeFile)
+  with open(indexFn, 'rb') as f:
+    data = f.read()
+  with open(indexFn, 'wb') as f:
+    f.write(data[:len(data)//2])
+  assert load(gcodeFile) == None
+
+@pytest.mark.parametrize('layers', [None, [[1, 2, 3]], [[0] * 10 + [[['Outer wall', 0]]]]])
+def testMalformedLayers(gcodeFile, layers):
+  scanAndSave(gcodeFile)
+  rewriteIndex(gcodeFile, layers=layers)
+  assert load(gcodeFile) == None
+
+@pytest.mark.parametrize('parts', [2, 7, 40])
+def testParallelScanMatchesScan(gcodeFile, configuration, parts):
+  profile = ProcessProfile(enabled=False)
+  with GcodeReader(gcodeFile) as f, layerWorkerPool(configuration(gcodeFile, None), 2, profile) as pool:
+    scanned = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, profile)
+    assert len(layerScanParts(f, parts)) > 1
+    assert layerValues(buildLayerIndexInParallel(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, pool, parts, None, profile)) == layerValues(scanned)
@@ -0,0 +1,90 @@
+import pytest
+
+from mfm.line_classifier import *
+from mfm.gcode_file import *
+
+BAMBU_LINES = [
+  ('G1 X108.5 Y112.3 E.0421', LineKind.MOVE),
+  ('G0 X10 Y10', LineKind.MOVE),
+  ('G2 Z0.6 I0.86 J0.86 P1 F20000 ; spiral lift a little', LineKind.MOVE),
+  ('G92 E0', LineKind.OTHER),
+  ('M204 S10000', LineKind.ACCELERATION),
+  ('M204 P20000 R5000 T20000', LineKind.ACCELERATION),
+  ('; CHANGE_LAYER', LineKind.LAYER_CHANGE),
+  ('; Z_HEIGHT: 0.2', LineKind.COMMENT),
+  ('; LAYER_HEIGHT: 0.2', LineKind.COMMENT),
+  ('; MFM LAYER CHANGE END', LineKind.LAYER_CHANGE_END),
+  ('; FEATURE: Outer wall', LineKind.FEATURE),
+  ('; MFM TOOLCHANGE START', LineKind.TOOLCHANGE_START),
+  ('; MFM TOOLCHANGE END', LineKind.TOOLCHANGE_END),
+  ('; WIPE_END', LineKind.WIPE_END),
+  ('; filament end gcode ', LineKind.FILAMENT_END),
+  ('; LINE_WIDTH: 0.42', LineKind.LINE_WIDTH),
+  ('; line_width = 0.42', LineKind.COMMENT),
+  ('; filament_end_gcode = "; filament end gcode \\nM106 P3 S0\\n"', LineKind.COMMENT),
+  ('M620 S1A', LineKind.M620),
+  ('M620 S0A   ; switch material if AMS exist', LineKind.M620),
+  ('M620 M', LineKind.OTHER),
+  ('M620.1 E F523 T240', LineKind.OTHER),
+  ('M621 S1A', LineKind.M621),
+  ('T1', LineKind.TOOL),
+  ('T255', LineKind.OTHER),
+  ('T1000', LineKind.OTHER),
+  ('T1100', LineKind.OTHER)
+]
+
+PRUSA_LINES = [
+  (';LAYER_CHANGE', LineKind.LAYER_CHANGE),
+  (';Z:0.2', LineKind.COMMENT),
+  (';HEIGHT:0.2', LineKind.COMMENT),
+  (';TYPE:External perimeter', LineKind.FEATURE),
+  (';WIDTH:0.705534', LineKind.LINE_WIDTH),
+  (';WIPE_END', LineKind.WIPE_END),
+  (';filament end gcode', LineKind.FILAMENT_END),
+  ('; MFM TOOLCHANGE START', LineKind.TOOLCHANGE_START),
+  ('T1 S1 L0 D0', LineKind.TOOL),
+  ('M204 P4000 R1200 T5000 ; sets acceleration (P, T) and retract acceleration (R), mm/sec^2', LineKind.ACCELERATION)
+]
+
+EDGE_CASE_LINES = [
+  # Leading whitespace is only allowed before a tool command, the same as the line patterns
+  ('    T0', LineKind.TOOL),
+  ('  G1 X1 Y2', LineKind.OTHER),
+  (' ; CHANGE_LAYER', LineKind.OTHER),
+  # A comment after a command does not make it a comment line
+  ('G1 X1 Y2 ; FEATURE: Outer wall', LineKind.MOVE),
+  ('G1 Z5 F300;', LineKind.MOVE),
+  ('', LineKind.OTHER),
+  ('\n', LineKind.OTHER),
+  ('G1X1', LineKind.OTHER)
+]
+
+@pytest.mark.parametrize('line, kind', BAMBU_LINES + PRUSA_LINES + EDGE_CASE_LINES)
+def testClassifyLine(line: str, kind: LineKind):
+  assert classifyLine(line) == kind
+  assert classifyLine(line + '\n') == kind
+
+def testClassifyWindowsLineEndingLines(tmp_path):
+  # GcodeReader returns a Windows line ending as '\n' so the lines are classified the same way
+  lines = BAMBU_LINES + PRUSA_LINES
+  fn = tmp_path / 'windows.gcode'
+  fn.write_bytes(''.join(line + '\r\n' for line, kind in lines).encode())
+  with GcodeReader(str(fn)) as f:
+    assert [classifyLine(f.readline()) for _ in lines] == [kind for line, kind in lines]
+
+@pytest.mark.parametrize('line, pattern, value', [
+  ('; Z_HEIGHT: 0.2\r\n', LAYER_Z_HEIGHT_RE, '0.2'),
+  (';Z:0.2\n', LAYER_Z_HEIGHT_RE, '0.2'),
+  ('; LAYER_HEIGHT: 0.12\n', LAYER_HEIGHT_RE, '0.12'),
+  (';HEIGHT:0.12\r\n', LAYER_HEIGHT_RE, '0.12'),
+  ('; FEATURE: Outer wall\n', FEATURE_TYPE_RE, 'Outer wall'),
+  ('M620 S3A\n', M620_RE, '3'),
+  ('  T2\r\n', TOOLCHANGE_T_RE, '2')
+])
+def testLineValues(line: str, pattern, value: str):
+  assert pattern.match(line).groups()[0] == value
+
+def testToolCommandLineCandidates():
+  gcode = b'M620 S1A\nG1 X1\n  T1\nM621 S1A\nM620.1 E\nG1 T1\n'
+  starts = [m.start() for m in TOOL_COMMAND_LINE_RE.finditer(gcode)]
+  assert starts == [0, gcode.index(b'  T1'), gcode.index(b'M621')]
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+import mfm.map_post_process
+from mfm.map_post_process import *
+from conftest import SAMPLE_GCODE_DIR
+
+@pytest.mark.parametrize('gcodeFn', ['dice_multiple_bambu_prime.gcode', 'dice_single_bambu_prime.gcode', 'dice_multiple_prusa_prime.gcode'])
+def testParallelOutputMatchesSerial(tmp_path, monkeypatch, configuration, gcodeFn: str):
+  monkeypatch.setattr(mfm.map_post_process, 'PARALLEL_MIN_INPUT_BYTES', 0)
+  outputs = {}
+  for jobs in (1, 2):
+    outputFn = str(tmp_path / f'output-j{jobs}.gcode')
+    process(configuration(os.path.join(SAMPLE_GCODE_DIR, gcodeFn), outputFn, jobs=jobs), None)
+    with open(outputFn, 'rb') as f:
+      outputs[jobs] = f.read()
+  assert outputs[2] == outputs[1]
+
+@pytest.mark.parametrize('gcodeFn', ['dice_multiple_bambu_prime.gcode', 'dice_single_bambu_prime.gcode'])
+def testParallelProfileCountsMatchSerial(tmp_path, monkeypatch, configuration, gcodeFn: str):
+  monkeypatch.setattr(mfm.map_post_process, 'PARALLEL_MIN_INPUT_BYTES', 0)
+  profiles = {jobs: process(configuration(os.path.join(SAMPLE_GCODE_DIR, gcodeFn), str(tmp_path / f'output-j{jobs}.gcode'), jobs=jobs), None) for jobs in (1, 2)}
+  assert profiles[2].counts == profiles[1].counts
+  assert profiles[2].counts[COUNT_OUTPUT_BYTES] == os.path.getsize(tmp_path / 'output-j2.gcode')
+  # Worker time is not part of the phases timed in the main process
+  assert profiles[1].workerPhaseTimes == {}
+  assert PHASE_FEATURE_SCAN in profiles[2].workerPhaseTimes
+  assert PHASE_FEATURE_SCAN not in profiles[2].phaseTimes
+
+def testSmallInputIsProcessedWithOneJob(tmp_path, configuration):
+  gcodeFn = os.path.join(SAMPLE_GCODE_DIR, 'dice_multiple_bambu_prime.gcode')
+  assert os.path.getsize(gcodeFn) < PARALLEL_MIN_INPUT_BYTES
+  profile = process(configuration(gcodeFn, str(tmp_path / 'output.gcode'), jobs=2), None)
+  assert profile.workerPhaseTimes == {}
+  assert PHASE_CARRIED_STATE not in profile.phaseTimes
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from mfm.map_post_process import *
+from mfm.position_resolver import *
+from conftest import SAMPLE_GCODE_DIR
+
+GCODE_FILES = ['dice_multiple_bambu_prime.gcode', 'dice_multiple_prusa_prime.gcode', 'dice_single_bambu_no_prime.gcode']
+
+class CountingReader(GcodeReader):
+  """Reader that counts the lines parsed for positions"""
+  def __init__(self, fn: str):
+    super().__init__(fn)
+    self.linesParsed: int = 0
+
+  def lineAt(self, start: int) -> str:
+    self.linesParsed += 1
+    return super().lineAt(start)
+
+def positionValues(p: Position) -> tuple:
+  return tuple(getattr(p, name, None) for name in Position.__slots__)
+
+def eagerPositions(f: GcodeReader, featureScanStart: int, featureStarts: list[int]) -> dict[int, tuple]:
+  """Position after the first line of each feature found by parsing every line from the feature scan start"""
+  positions = {}
+  position = Position()
+  f.seek(featureScanStart, os.SEEK_SET)
+  while len(positions) < len(featureStarts):
+    cl = f.readline()
+    if cl == '':
+      break
+    checkAndUpdatePosition(cl=cl, pp=position, kind=classifyLine(cl))
+    if f.lineStart in featureStarts:
+      positions[f.lineStart] = positionValues(position)
+  return positions
+
+@pytest.mark.parametrize('gcodeFn', GCODE_FILES)
+def testPositionsMatchEagerParsing(gcodeFn: str):
+  with GcodeReader(os.path.join(SAMPLE_GCODE_DIR, gcodeFn)) as f:
+    layerIndex = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, ProcessProfile(enabled=False))
+    for layer in layerIndex.layers:
+      featureStarts = [feat.start for feat in layer.features]
+      expected = eagerPositions(f, layer.featureScanStart, featureStarts)
+      # Positions asked for in order and with the last feature first
+      for order in (featureStarts, list(reversed(featureStarts))):
+        positions = LayerPositions(layer.featureScanStart, featureStarts)
+        assert {start: positionValues(positions.positionAt(f, start)) for start in order} == expected
+
+def testPositionsParsedOnlyUpToFeatureAskedFor():
+  with CountingReader(os.path.join(SAMPLE_GCODE_DIR, 'dice_multiple_bambu_prime.gcode')) as f:
+    layerIndex = buildLayerIndex(f, MARLIN_2_BAMBU_PRUSA_MARKED_GCODE, None, ProcessProfile(enabled=False))
+    layer = max(layerIndex.layers, key=lambda layer: len(layer.features))
+    featureStarts = sorted(feat.start for feat in layer.features)
+    assert len(featureStarts) > 2
+    positions = LayerPositions(layer.featureScanStart, featureStarts)
+    f.linesParsed = 0
+
+    positions.positionAt(f, featureStarts[0])
+    firstParsed = f.linesParsed
+    assert 0 < firstParsed == len(f.matchStarts(POSITION_LINE_RE, layer.featureScanStart, featureStarts[0])) + 1
+
+    # Resolved positions are kept
+    first = positions.positionAt(f, featureStarts[0])
+    assert f.linesParsed == firstParsed
+
+    # A later feature continues from the furthest feature start resolved
+    positions.positionAt(f, featureStarts[1])
+    assert f.linesParsed == firstParsed + len(f.matchStarts(POSITION_LINE_RE, featureStarts[0] + 1, featureStarts[1])) + 1
+    assert positions.positionAt(f, featureStarts[0]) is first
+
+def testUnknownFeatureStart(tmp_path):
+  fn = str(tmp_path / 'layer.gcode')
+  with open(fn, mode='w') as f:
+    f.write('G1 X1 Y2 F600\n; FEATURE: Outer wall\nG1 X3 E1\n')
+  with GcodeReader(fn) as f:
+    positions = LayerPositions(0, [14])
+    assert positionValues(positions.positionAt(f, 14))[:2] == (1.0, 2.0)
+    assert positionValues(positions.positionAt(f, 5)) == positionValues(Position())
@@ -0,0 +1,70 @@
+import glob, io, os
+
+import pytest
+
+from mfm.map_post_process import *
+from conftest import REPO_DIR, SAMPLE_GCODE_DIR
+
+OPTIONS_FILES = sorted(glob.glob(os.path.join(REPO_DIR, 'premade_options', '*.json')))
+
+def lineByLinePrimeTower(f: GcodeReader, primeTower: Feature, newColorIndex: int, toolRemap: list[int]) -> bytes:
+  """Relocated prime tower written one line at a time. Every tool command is changed to newColorIndex except on the line before WIPE_END, and the WIPE_END and lines after it are skipped."""
+  buffer = io.BytesIO()
+  out = GcodeWriter(buffer, LineEnding.UNIX.value)
+  end = primeTower.wipeEnd.start if primeTower.wipeEnd else primeTower.end
+  f.seek(primeTower.start, os.SEEK_SET)
+  while f.tell() < end:
+    cl = f.readline()
+    kind = classifyLine(cl)
+    if kind in TOOL_COMMAND_KINDS:
+      colorIndex = toolCommandIndex(cl, kind) if primeTower.wipeEnd and f.tell() == end else newColorIndex
+      cl = substituteNewColor(cl, currentPrintingColorIndexForColorIndex(colorIndex, toolRemap))
+    out.write(cl)
+  if primeTower.wipeEnd:
+    out.write(";WIPE_END placeholder for PrusaSlicer Gcode Viewer\n")
+    out.write("; WIPE_END placeholder for BambuStudio Gcode Preview\n")
+    out.write("; MFM Original WIPE_END skipped for inserted Prime Tower\n")
+  return buffer.getvalue()
+
+def writtenEdits(f: GcodeReader, edits: list[LayerEdit]) -> bytes:
+  buffer = io.BytesIO()
+  plan = LayerPlan(-1, 0)
+  plan.edits = edits
+  executeLayerPlan(f, GcodeWriter(buffer, LineEnding.UNIX.value), plan, None, ProcessProfile(enabled=False))
+  return buffer.getvalue()
+
+@pytest.mark.parametrize('gcodeFn', ['dice_multiple_bambu_prime.gcode', 'dice_multiple_prusa_prime.gcode'])
+@pytest.mark.parametrize('optionsFn', OPTIONS_FILES, ids=os.path.basename)
+def testRelocatedPrimeTowerMatchesLineByLineCopy(configuration, gcodeFn: str, optionsFn: str):
+  mfmConfig = configuration(os.path.join(SAMPLE_GCODE_DIR, gcodeFn), None, optionsFn)
+  profile = ProcessProfile(enabled=False)
+  relocated = 0
+  with GcodeReader(mfmConfig[CONFIG_INPUT_FILE]) as f:
+    layerIndex = buildLayerIndex(f, mfmConfig[CONFIG_GCODE_FLAVOR], None, profile)
+    colorSchedule = buildColorSchedule(layerIndex.layers, mfmConfig[CONFIG_PERIODIC_COLORS], mfmConfig[CONFIG_REPLACEMENT_COLORS])
+    layerChangeStarts = layerIndex.layerChangeStarts + [None]
+    currentPrint = PrintState()
+    for layerNum, layer in enumerate(layerIndex.layers):
+      currentPrint = startLayer(layer, layerNum, currentPrint, colorSchedule, profile)
+      # Prime towers are taken from the print state as they are relocated
+      primeTowers = {feat.start: feat for feat in currentPrint.primeTowerFeatures}
+      f.seek(layerChangeStarts[layerNum], os.SEEK_SET)
+      edits = planLayer(f, currentPrint, layerChangeStarts[layerNum+1], mfmConfig, profile, None, isPassthroughLayer(currentPrint, layerChangeStarts[layerNum], layerChangeStarts[layerNum+1])).edits
+
+      for i, edit in enumerate(edits):
+        if edit.type != EditType.TOOLCHANGE or edit.toolchangeType != ToolchangeType.FULL:
+          continue
+        primeTower = primeTowers[edit.start]
+        # The color before replacement is only in the comment written before the toolchange
+        newColorIndex = int(edits[i-1].text.split(' inserted to ')[1].split(' ')[0])
+        # Edits of the relocated prime tower follow the toolchange
+        j = i + 1
+        while j < len(edits) and edits[j].type in (EditType.COPY, EditType.SUBSTITUTE_TOOL) and primeTower.start <= edits[j].start < primeTower.end:
+          j += 1
+        if primeTower.wipeEnd:
+          # Followed by the WIPE_END placeholders
+          assert edits[j].type == EditType.TEXT
+          j += 1
+        assert writtenEdits(f, edits[i+1:j]) == lineByLinePrimeTower(f, primeTower, newColorIndex, currentPrint.toolRemap)
+        relocated += 1
+  assert relocated > 0
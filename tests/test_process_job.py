@@ -0,0 +1,72 @@
+import multiprocessing, os, time
+
+import pytest
+
+import mfm.process_job
+from mfm.process_job import *
+from synthetic_gcode import *
+
+# Large enough that the job is still writing when it is cancelled
+SYNTHETIC_SIZE = 4_000_000
+CANCEL_DELAY = 0.15
+JOB_TIMEOUT = 60
+
+@pytest.fixture(scope='module')
+def gcodeFile(tmp_path_factory) -> str:
+  spec = SyntheticGcodeSpec()
+  spec.sizeBytes = SYNTHETIC_SIZE
+  fn = str(tmp_path_factory.mktemp('process_job') / 'synthetic.gcode')
+  writeSyntheticGcode(fn, spec)
+  return fn
+
+def waitUntilDone(job: ProcessJob) -> list[StatusQueueItem]:
+  items = []
+  deadline = time.monotonic() + JOB_TIMEOUT
+  while not job.done:
+    assert time.monotonic() < deadline
+    items += job.poll()
+    time.sleep(0.01)
+  return items
+
+def testJobSucceeds(tmp_path, configuration, gcodeFile):
+  outputFn = str(tmp_path / 'output.gcode')
+  job = ProcessJob(configuration(gcodeFile, outputFn))
+  items = waitUntilDone(job)
+  assert job.result.succeeded
+  assert not job.result.cancelled and job.result.error == None
+  assert items[-1].progress == 99.99
+  assert os.path.getsize(outputFn) > 0
+
+def testCancelledJobRemovesPartialOutput(tmp_path, configuration, gcodeFile):
+  outputFn = str(tmp_path / 'output.gcode')
+  job = ProcessJob(configuration(gcodeFile, outputFn))
+  time.sleep(CANCEL_DELAY)
+  job.cancel()
+  waitUntilDone(job)
+  assert job.result.cancelled
+  assert not job.result.succeeded
+  assert not os.path.exists(outputFn)
+
+def testTerminatedJobRemovesPartialOutput(tmp_path, configuration, gcodeFile):
+  outputFn = str(tmp_path / 'output.gcode')
+  job = ProcessJob(configuration(gcodeFile, outputFn))
+  time.sleep(CANCEL_DELAY)
+  job.terminate()
+  assert job.done
+  assert job.result.cancelled
+  assert not job._process.is_alive()
+  assert not os.path.exists(outputFn)
+
+def testFailedJobRemovesPartialOutput(tmp_path, monkeypatch, configuration, gcodeFile):
+  outputFn = str(tmp_path / 'output.gcode')
+  def failingProcess(configuration: MFMConfiguration, statusQueue: PipeStatusQueue):
+    with open(configuration[CONFIG_OUTPUT_FILE], mode='w') as f:
+      f.write('; partial output')
+    raise ValueError('Layer could not be written')
+  monkeypatch.setattr(mfm.process_job, 'process', failingProcess)
+  connection, childConnection = multiprocessing.Pipe(duplex=False)
+  mfm.process_job._runProcessJob(configuration(gcodeFile, outputFn), childConnection, multiprocessing.Event())
+  result = connection.recv()
+  assert result.error == 'ValueError: Layer could not be written'
+  assert not result.succeeded and not result.cancelled
+  assert not os.path.exists(outputFn)
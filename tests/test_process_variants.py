@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from mfm.map_post_process import *
+from conftest import OPTIONS_FILE, REPO_DIR, SAMPLE_GCODE_DIR
+
+GCODE_FILE = os.path.join(SAMPLE_GCODE_DIR, 'dice_multiple_bambu_prime.gcode')
+VARIANT_OPTIONS_FILES = [OPTIONS_FILE, os.path.join(REPO_DIR, 'options-isoline.json'), os.path.join(REPO_DIR, 'premade_options', 'USAofPlastic-single-meters.json')]
+
+def read(fn: str) -> bytes:
+  with open(fn, mode='rb') as f:
+    return f.read()
+
+def testVariantsMatchSeparateRuns(tmp_path, configuration):
+  configurations = [configuration(GCODE_FILE, str(tmp_path / f'variant-{i}.gcode'), optionsFn) for i, optionsFn in enumerate(VARIANT_OPTIONS_FILES)]
+  profiles = processVariants(configurations, None)
+  assert len(profiles) == len(configurations)
+
+  outputs = [read(c[CONFIG_OUTPUT_FILE]) for c in configurations]
+  assert len(set(outputs)) == len(outputs)
+  for i, optionsFn in enumerate(VARIANT_OPTIONS_FILES):
+    separateFn = str(tmp_path / f'separate-{i}.gcode')
+    process(configuration(GCODE_FILE, separateFn, optionsFn), None)
+    assert outputs[i] == read(separateFn)
+
+  # The layer and feature analysis is done once for the first variant
+  assert PHASE_LAYER_DISCOVERY in profiles[0].phaseTimes
+  for profile in profiles[1:]:
+    assert PHASE_LAYER_DISCOVERY not in profile.phaseTimes
+    assert profile.counts[COUNT_LAYERS] == profiles[0].counts[COUNT_LAYERS]
+
+def testVariantsNeedTheSameInput(tmp_path, configuration):
+  configurations = [configuration(GCODE_FILE, str(tmp_path / 'a.gcode')), configuration(os.path.join(SAMPLE_GCODE_DIR, 'dice_single_bambu_prime.gcode'), str(tmp_path / 'b.gcode'))]
+  with pytest.raises(ValueError):
+    processVariants(configurations, None)
+  assert not os.path.exists(tmp_path / 'a.gcode')
+
+def testStandardOutputHasOneVariant(tmp_path, configuration):
+  configurations = [configuration(GCODE_FILE, STDIO_FILENAME), configuration(GCODE_FILE, str(tmp_path / 'b.gcode'))]
+  with pytest.raises(ValueError):
+    processVariants(configurations, None)
@@ -0,0 +1,29 @@
+import pytest
+
+from mfm.progress import *
+
+class CancellableQueue:
+  """Status queue that is cancelled after a number of checks"""
+  def __init__(self, checksBeforeCancel: int):
+    self.items: list[StatusQueueItem] = []
+    self.checks: int = 0
+    self._checksBeforeCancel = checksBeforeCancel
+
+  def checkCancelled(self):
+    self.checks += 1
+    if self.checks > self._checksBeforeCancel:
+      raise InterruptedError()
+
+  def put(self, item: StatusQueueItem):
+    self.items.append(item)
+
+def testCancelCheckedOnMergedUpdates():
+  statusQueue = CancellableQueue(checksBeforeCancel=3)
+  # The clock does not move so every update after the first is merged
+  reporter = ProgressReporter(statusQueue, rate=1, clock=lambda: 0)
+  for bytesDone in range(3):
+    reporter.progress(bytesDone, 10, statusLeft=f"Layer {bytesDone}")
+  assert len(statusQueue.items) == 1
+  with pytest.raises(InterruptedError):
+    reporter.progress(3, 10)
+  assert statusQueue.checks == 4
@@ -0,0 +1,50 @@
+import pytest
+
+from mfm.printing_classes import *
+
+def testEmpty():
+  stops = StopPositions()
+  assert len(stops) == 0
+  assert not stops
+  assert 0 not in stops
+  assert stops.nextAfter(0) == None
+
+def testDuplicatePositions():
+  stops = StopPositions([10, 10])
+  assert len(stops) == 2
+  stops.remove(10)
+  # A position added twice is a stop until it is removed twice
+  assert 10 in stops
+  assert len(stops) == 1
+  assert stops
+  stops.remove(10)
+  assert 10 not in stops
+  assert len(stops) == 0
+  assert not stops
+
+def testRemoveMissingPosition():
+  stops = StopPositions([10, 20])
+  with pytest.raises(KeyError):
+    stops.remove(15)
+  assert len(stops) == 2
+  assert 10 in stops and 20 in stops
+  assert stops.nextAfter(10) == 20
+
+def testNextAfter():
+  stops = StopPositions([30, 10, 20, 20])
+  assert stops.nextAfter(0) == 10
+  assert stops.nextAfter(10) == 20
+  assert stops.nextAfter(25) == 30
+  assert stops.nextAfter(30) == None
+  stops.remove(20)
+  assert stops.nextAfter(10) == 20
+  stops.remove(20)
+  assert stops.nextAfter(10) == 30
+
+def testAppendAfterRemove():
+  stops = StopPositions()
+  stops.append(5)
+  stops.remove(5)
+  stops.append(5)
+  assert 5 in stops
+  assert len(stops) == 1
@@ -0,0 +1,38 @@
+import functools, io, os, sys
+
+import pytest
+
+import mfm.gcode_package
+from mfm.map_post_process import *
+from synthetic_gcode import *
+from check_stream_memory import streamBufferBound, OPTIONS_FILE
+from bench_process import BAMBU_TOOLCHANGE_FILE, PRUSA_TOOLCHANGE_FILE
+
+SYNTHETIC_SIZE = 300_000
+SMALL_CHUNK_SIZE = 4096
+
+@pytest.mark.parametrize('flavor', [BAMBU, PRUSA])
+@pytest.mark.parametrize('chunkSize', [SMALL_CHUNK_SIZE, GCODE_STREAM_CHUNK_SIZE])
+def testStreamedInputIsBoundedByLayers(tmp_path, monkeypatch, configuration, flavor: str, chunkSize: int):
+  spec = SyntheticGcodeSpec()
+  spec.flavor = flavor
+  spec.sizeBytes = SYNTHETIC_SIZE
+  gcodeFn = str(tmp_path / 'synthetic.gcode')
+  assert writeSyntheticGcode(gcodeFn, spec) > 2
+  toolchangeFn = PRUSA_TOOLCHANGE_FILE if flavor == PRUSA else BAMBU_TOOLCHANGE_FILE
+
+  fileOutputFn = str(tmp_path / 'file-output.gcode')
+  process(configuration(gcodeFn, fileOutputFn, OPTIONS_FILE, toolchangeFn), None)
+
+  streamOutputFn = str(tmp_path / 'stream-output.gcode')
+  monkeypatch.setattr(mfm.gcode_package, 'GcodeStreamReader', functools.partial(GcodeStreamReader, chunkSize=chunkSize))
+  with open(gcodeFn, mode='rb') as stdin:
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(stdin))
+    profile = process(configuration(STDIO_FILENAME, streamOutputFn, OPTIONS_FILE, toolchangeFn), None)
+
+  peakBuffer = profile.counts[COUNT_STREAM_PEAK_BUFFER_BYTES]
+  assert peakBuffer <= streamBufferBound(gcodeFn, chunkSize)
+  if chunkSize < SYNTHETIC_SIZE:
+    assert peakBuffer < os.path.getsize(gcodeFn)
+  with open(streamOutputFn, mode='rb') as streamed, open(fileOutputFn, mode='rb') as fromFile:
+    assert streamed.read() == fromFile.read()
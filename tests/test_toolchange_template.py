@@ -0,0 +1,38 @@
+import glob, os
+
+import pytest
+
+from mfm.map_post_process import *
+from mfm.toolchange_template import *
+from conftest import REPO_DIR, SAMPLE_GCODE_DIR
+
+TOOLCHANGE_FILES = sorted(glob.glob(os.path.join(REPO_DIR, 'minimal_toolchanges', '*.gcode')))
+
+@pytest.mark.parametrize('template', ['G1 E-.1 F1800\nT1\nG1 E.1 F1800\n', 'M620 SXXA\nG1 E-.1 F1800\nM621 SXXA\n'], ids=['no placeholder', 'no tool select'])
+def testUnusableTemplateRaisesBeforeOutputIsWritten(tmp_path, configuration, template: str):
+  toolchangeFn = str(tmp_path / 'toolchange.gcode')
+  with open(toolchangeFn, mode='w') as f:
+    f.write(template)
+  with pytest.raises(ToolchangeTemplateError):
+    ToolchangeTemplate(toolchangeFn)
+
+  outputFn = str(tmp_path / 'output.gcode')
+  with pytest.raises(ToolchangeTemplateError):
+    process(configuration(os.path.join(SAMPLE_GCODE_DIR, 'dice_multiple_bambu_prime.gcode'), outputFn, toolchangeFn=toolchangeFn), None)
+  assert not os.path.exists(outputFn)
+
+def testMissingTemplateFileRaises(tmp_path):
+  with pytest.raises(ToolchangeTemplateError):
+    ToolchangeTemplate(str(tmp_path / 'missing.gcode'))
+
+@pytest.mark.parametrize('lineEnding', [LineEnding.UNIX, LineEnding.WINDOWS])
+@pytest.mark.parametrize('toolchangeFn', TOOLCHANGE_FILES, ids=os.path.basename)
+def testRenderReplacesPlaceholder(toolchangeFn: str, lineEnding: LineEnding):
+  with open(toolchangeFn, mode='r', encoding=GCODE_ENCODING) as f:
+    template = f.read()
+  toolchangeTemplate = ToolchangeTemplate(toolchangeFn, lineEnding.value)
+  for toolIndex in (0, 1, 9, 15):
+    expected = template.replace(TOOLCHANGE_TEMPLATE_TOOL_PLACEHOLDER, str(toolIndex)).replace(LineEnding.UNIX.value, lineEnding.value)
+    assert toolchangeTemplate.render(toolIndex) == expected.encode(GCODE_ENCODING)
+    # Rendered once and reused
+    assert toolchangeTemplate.render(toolIndex) is toolchangeTemplate.render(toolIndex)